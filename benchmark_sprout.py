@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+""" Benchmark sprout's own orchestration overhead.
+
+Runs sprout.main() against synthetic configs of 10/100/1000
+terraform_sets with a stub terraform executable that sleeps for a
+configurable time, and reports end-to-end makespan, orchestration
+overhead over the ideal schedule, and peak memory.
+
+Each size runs in a fresh interpreter so peak memory is per size.
+
+    ./benchmark_sprout.py --sizes 10 100 --parallel 8 --runtime 0.05
+    ./benchmark_sprout.py --output bench.json
+    ./benchmark_sprout.py --baseline bench.json --tolerance 0.2
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+import resource
+import subprocess
+import tracemalloc
+
+from time import monotonic
+
+FAKE_TERRAFORM = '''#!{python}
+""" Stub terraform for benchmark_sprout.py. """
+import os
+import sys
+import json
+import time
+import random
+
+args = sys.argv[1:]
+command = args[0] if args else ''
+if command == 'version':
+    print('Terraform v0.0.0-sprout-benchmark')
+    sys.exit(0)
+
+env = os.environ
+runtime = float(env.get('SPROUT_FAKE_TF_RUNTIME_' + command.upper(), env.get('SPROUT_FAKE_TF_RUNTIME', '0')))
+failure_rate = float(env.get('SPROUT_FAKE_TF_FAILURE_RATE', '0'))
+change_rate = float(env.get('SPROUT_FAKE_TF_CHANGE_RATE', '1'))
+for n in range(int(env.get('SPROUT_FAKE_TF_OUTPUT_LINES', '0'))):
+    print('fake {{}} output line {{}}'.format(command, n))
+time.sleep(runtime)
+
+if random.random() < failure_rate:
+    print('Error: simulated failure', file=sys.stderr)
+    sys.exit(1)
+
+options = dict(arg.lstrip('-').split('=', 1) for arg in args[1:] if arg.startswith('-') and '=' in arg)
+if command == 'init':
+    os.makedirs('.terraform', exist_ok=True)
+    print('Terraform has been successfully initialized!')
+elif command == 'plan':
+    changes = random.random() < change_rate
+    if 'out' in options:
+        os.makedirs(os.path.dirname(options['out']) or '.', exist_ok=True)
+        with open(options['out'], 'w') as fh:
+            fh.write('fake plan')
+    if changes:
+        print('Plan: 1 to add, 0 to change, 0 to destroy.')
+    else:
+        print('No changes. Infrastructure is up-to-date.')
+    if changes and '-detailed-exitcode' in args:
+        sys.exit(2)
+elif command in ['apply', 'destroy']:
+    state_file = options.get('state')
+    if state_file:
+        serial = 0
+        if os.path.exists(state_file):
+            with open(state_file) as fh:
+                serial = json.load(fh).get('serial', 0)
+        os.makedirs(os.path.dirname(state_file) or '.', exist_ok=True)
+        with open(state_file, 'w') as fh:
+            json.dump({{'lineage': 'benchmark', 'serial': serial + 1}}, fh)
+    if command == 'apply':
+        print('Apply complete! Resources: 1 added, 0 changed, 0 destroyed.')
+    else:
+        print('Destroy complete! Resources: 1 destroyed.')
+'''
+
+def write_fake_terraform(bin_dir):
+    """ Write the stub terraform executable into bin_dir.
+    """
+    path = os.path.join(bin_dir, 'terraform')
+    with open(path, 'w') as fh:
+        fh.write(FAKE_TERRAFORM.format(python = sys.executable))
+    os.chmod(path, 0o755)
+    return path
+
+def write_config(directory, sets, roots=None, dependency_rate=0.0, seed=0):
+    """ Generate a sprout config with synthetic terraform_sets.
+
+    args:
+        directory (str): Where to create roots and the config file
+        sets (int): Number of terraform_sets
+        roots (int): Number of distinct roots; defaults to one per set
+        dependency_rate (float): Chance that a set depends on an earlier one
+        seed (int): Random seed for dependencies
+
+    returns:
+        path to the config file
+    """
+    rng = random.Random(seed)
+    roots = roots or sets
+    for index in range(roots):
+        root = os.path.join(directory, 'root-{}'.format(index))
+        os.makedirs(root, exist_ok=True)
+        with open(os.path.join(root, 'main.tf'), 'w') as fh:
+            fh.write('resource "null_resource" "node" {}\n')
+        with open(os.path.join(root, 'generic.tfvars'), 'w') as fh:
+            fh.write('project = "benchmark"\n')
+
+    terraform_sets = []
+    for index in range(sets):
+        root = os.path.join(directory, 'root-{}'.format(index % roots))
+        terraform_set = {
+                         'name': 'set-{}'.format(index),
+                         'load-balancer': False,
+                         'root': root,
+                         'var-files': ['generic.tfvars'],
+                         'state-file': 'tfstate-files/set-{}.tfstate'.format(index)
+                        }
+        if index and rng.random() < dependency_rate:
+            terraform_set['depends-on'] = ['set-{}'.format(rng.randrange(index))]
+        terraform_sets.append(terraform_set)
+
+    path = os.path.join(directory, 'benchmark.yaml')
+    with open(path, 'w') as fh:
+        json.dump({'terraform_sets': terraform_sets}, fh, indent=1)
+    return path
+
+def ideal_makespan(config, phase_seconds, parallel):
+    """ Lower bound on the makespan for the work that actually ran.
+
+    The larger of the critical path and total work / parallel, using
+    the measured Terraform phase durations of each set.
+    """
+    finish = {}
+    for terraform_set in config['terraform_sets']:
+        start = max([finish[name] for name in terraform_set.get('depends-on', [])] + [0])
+        finish[terraform_set['name']] = start + phase_seconds.get(terraform_set['name'], 0)
+    total = sum(phase_seconds.values())
+    return max(list(finish.values()) + [total / parallel])
+
+def run_one(args):
+    """ Run sprout once in this interpreter and print a JSON result.
+    """
+    import sprout
+
+    with tempfile.TemporaryDirectory() as directory:
+        bin_dir = os.path.join(directory, 'bin')
+        os.makedirs(bin_dir)
+        write_fake_terraform(bin_dir)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['SPROUT_FAKE_TF_RUNTIME'] = str(args.runtime)
+        os.environ['SPROUT_FAKE_TF_FAILURE_RATE'] = str(args.failure_rate)
+        os.environ['SPROUT_FAKE_TF_CHANGE_RATE'] = str(args.change_rate)
+        os.environ['SPROUT_FAKE_TF_OUTPUT_LINES'] = str(args.output_lines)
+
+        config_file = write_config(
+                                   directory,
+                                   args.sets,
+                                   roots = args.roots,
+                                   dependency_rate = args.dependency_rate)
+        with open(config_file) as fh:
+            config = json.load(fh)
+
+        sys.argv = [
+                    'sprout.py',
+                    '--config', config_file,
+                    '--parallel', str(args.parallel),
+                    '--state-dir', os.path.join(directory, '.sprout'),
+                    '--force']
+        if args.tracemalloc:
+            tracemalloc.start()
+        failed = False
+        with open(os.devnull, 'w') as devnull:
+            stdout = sys.stdout
+            sys.stdout = devnull
+            start = monotonic()
+            try:
+                sprout.main()
+            except Exception:
+                failed = True
+            finally:
+                makespan = monotonic() - start
+                sys.stdout = stdout
+
+    # main() drains the spans into the history; the summary keeps their totals
+    phase_seconds = {}
+    for total in sprout.metrics.summary():
+        if total['kind'] == 'phase':
+            name = total['labels']['set']
+            phase_seconds[name] = phase_seconds.get(name, 0) + total['seconds']
+    ideal = ideal_makespan(config, phase_seconds, args.parallel)
+
+    result = {
+              'sets': args.sets,
+              'parallel': args.parallel,
+              'runtime': args.runtime,
+              'change_rate': args.change_rate,
+              'failed': failed,
+              'makespan': makespan,
+              'ideal': ideal,
+              'overhead': makespan - ideal,
+              'overhead_per_set': (makespan - ideal) / args.sets,
+              'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+             }
+    if args.tracemalloc:
+        result['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1024.0 / 1024.0
+    print(json.dumps(result))
+
+def compare(results, baseline_file, tolerance):
+    """ Print regressions against a baseline file.
+
+    returns:
+        True if no size regressed by more than tolerance
+    """
+    with open(baseline_file) as fh:
+        baseline = {result['sets']: result for result in json.load(fh)}
+    ok = True
+    for result in results:
+        previous = baseline.get(result['sets'])
+        if previous is None:
+            continue
+        for field in ['overhead_per_set', 'peak_rss_mb']:
+            limit = previous[field] * (1 + tolerance)
+            if result[field] > limit and result[field] - previous[field] > 0.001:
+                print("REGRESSION: {} sets {} {:.4f} > {:.4f}".format(
+                                                                      result['sets'],
+                                                                      field,
+                                                                      result[field],
+                                                                      limit))
+                ok = False
+    return ok
+
+def parse_args(args):
+
+    parser = argparse.ArgumentParser(description = 'Benchmark sprout orchestration overhead.')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [10, 100, 1000],
+                        help = 'Numbers of terraform_sets to benchmark.')
+    parser.add_argument('--sets', type = int, default = None, help = argparse.SUPPRESS)
+    parser.add_argument('--parallel', type = int, default = 16,
+                        help = 'Value passed to sprout --parallel.')
+    parser.add_argument('--roots', type = int, default = None,
+                        help = 'Number of distinct Terraform roots (default one per set).')
+    parser.add_argument('--dependency-rate', type = float, default = 0.0,
+                        help = 'Chance that a set depends on an earlier one.')
+    parser.add_argument('--runtime', type = float, default = 0.0,
+                        help = 'Seconds each stub terraform command sleeps.')
+    parser.add_argument('--failure-rate', type = float, default = 0.0,
+                        help = 'Chance that a stub terraform command fails.')
+    parser.add_argument('--change-rate', type = float, default = 1.0,
+                        help = 'Chance that a stub terraform plan reports changes; 0 benchmarks the no-changes path.')
+    parser.add_argument('--output-lines', type = int, default = 0,
+                        help = 'Lines of output each stub terraform command prints.')
+    parser.add_argument('--tracemalloc', default = False, action = 'store_true',
+                        help = 'Also report peak traced Python allocations (slower).')
+    parser.add_argument('--output', type = str, default = None,
+                        help = 'Write results as JSON to this file.')
+    parser.add_argument('--baseline', type = str, default = None,
+                        help = 'Fail if overhead or memory regressed against this results file.')
+    parser.add_argument('--tolerance', type = float, default = 0.2,
+                        help = 'Allowed relative regression against the baseline.')
+    return parser.parse_args(args)
+
+def main():
+
+    args = parse_args(sys.argv[1:])
+    if args.sets is not None:
+        run_one(args)
+        return
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    print("{:>6} {:>10} {:>10} {:>10} {:>14} {:>10}".format(
+                                                          'sets', 'makespan', 'ideal', 'overhead',
+                                                          'overhead/set', 'peak MB'))
+    for sets in args.sizes:
+        command = [sys.executable, os.path.abspath(__file__), '--sets', str(sets)] + sys.argv[1:]
+        output = subprocess.run(
+                                command,
+                                cwd = here,
+                                stdout = subprocess.PIPE,
+                                universal_newlines = True,
+                                check = True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print("{:>6} {:>10.3f} {:>10.3f} {:>10.3f} {:>14.5f} {:>10.1f}{}".format(
+                                                                           sets,
+                                                                           result['makespan'],
+                                                                           result['ideal'],
+                                                                           result['overhead'],
+                                                                           result['overhead_per_set'],
+                                                                           result['peak_rss_mb'],
+                                                                           '  (failed)' if result['failed'] else ''))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    if args.baseline and not compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,964 @@
+#!/usr/bin/env python3
+""" Local stand-in for the subset of the Compute Engine API sprout uses.
+
+Serves instances stop/delete, disk snapshots, images
+insert/delete/list/deprecate, instanceGroups listInstances, the
+instanceGroupManagers calls used by rolling rollouts, zone/global
+operations get/wait, batch requests and a minimal discovery document,
+so ComputeOperator and AsyncComputeOperator can run against it offline:
+
+    ./fake_compute.py --port 8089 --instance gims-source --group gims-group:200
+    ./sprout.py --config staging.yaml --compute-url http://127.0.0.1:8089/
+
+Operations take --operation-seconds (or --duration TYPE=SECONDS) to
+finish. Missing resources return 404, --rate-limit returns 429
+rateLimitExceeded once the token bucket is empty, --quota NAME=N returns
+403 quotaExceeded, and --error-rate injects 503 backendError responses.
+List methods page with maxResults/pageToken and every method honours
+the "fields" partial response mask. GET /fake/stats reports request
+counts.
+"""
+
+import re
+import sys
+import json
+import uuid
+import random
+import argparse
+import threading
+import email.parser
+
+from time import monotonic, sleep, strftime, gmtime
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+API_PREFIX = '/compute/v1/'
+BATCH_PATH = '/batch/compute/v1'
+DISCOVERY_PATH = '/discovery/v1/apis/compute/v1/rest'
+STATS_PATH = '/fake/stats'
+
+# resource, method, HTTP method, path, query parameters, request schema, response schema
+METHODS = [
+           ('instances', 'get', 'GET',
+            'projects/{project}/zones/{zone}/instances/{instance}',
+            [], None, 'Instance'),
+           ('instances', 'stop', 'POST',
+            'projects/{project}/zones/{zone}/instances/{instance}/stop',
+            ['requestId'], None, 'Operation'),
+           ('instances', 'delete', 'DELETE',
+            'projects/{project}/zones/{zone}/instances/{instance}',
+            ['requestId'], None, 'Operation'),
+           ('disks', 'createSnapshot', 'POST',
+            'projects/{project}/zones/{zone}/disks/{disk}/createSnapshot',
+            ['guestFlush', 'requestId'], 'Snapshot', 'Operation'),
+           ('snapshots', 'get', 'GET',
+            'projects/{project}/global/snapshots/{snapshot}',
+            [], None, 'Snapshot'),
+           ('snapshots', 'delete', 'DELETE',
+            'projects/{project}/global/snapshots/{snapshot}',
+            ['requestId'], None, 'Operation'),
+           ('images', 'get', 'GET',
+            'projects/{project}/global/images/{image}',
+            [], None, 'Image'),
+           ('images', 'getFromFamily', 'GET',
+            'projects/{project}/global/images/family/{family}',
+            [], None, 'Image'),
+           ('images', 'list', 'GET',
+            'projects/{project}/global/images',
+            ['filter', 'maxResults', 'orderBy', 'pageToken'], None, 'ImageList'),
+           ('images', 'deprecate', 'POST',
+            'projects/{project}/global/images/{image}/deprecate',
+            ['requestId'], 'DeprecationStatus', 'Operation'),
+           ('images', 'insert', 'POST',
+            'projects/{project}/global/images',
+            ['forceCreate', 'requestId'], 'Image', 'Operation'),
+           ('images', 'delete', 'DELETE',
+            'projects/{project}/global/images/{image}',
+            ['requestId'], None, 'Operation'),
+           ('instanceGroups', 'listInstances', 'POST',
+            'projects/{project}/zones/{zone}/instanceGroups/{instanceGroup}/listInstances',
+            ['filter', 'maxResults', 'orderBy', 'pageToken'],
+            'InstanceGroupsListInstancesRequest', 'InstanceGroupsListInstances'),
+           ('instanceGroupManagers', 'get', 'GET',
+            'projects/{project}/zones/{zone}/instanceGroupManagers/{instanceGroupManager}',
+            [], None, 'InstanceGroupManager'),
+           ('instanceGroupManagers', 'listManagedInstances', 'POST',
+            'projects/{project}/zones/{zone}/instanceGroupManagers/{instanceGroupManager}/listManagedInstances',
+            ['filter', 'maxResults', 'orderBy', 'pageToken'],
+            None, 'InstanceGroupManagersListManagedInstancesResponse'),
+           ('instanceGroupManagers', 'resize', 'POST',
+            'projects/{project}/zones/{zone}/instanceGroupManagers/{instanceGroupManager}/resize',
+            ['size', 'requestId'], None, 'Operation'),
+           ('instanceGroupManagers', 'deleteInstances', 'POST',
+            'projects/{project}/zones/{zone}/instanceGroupManagers/{instanceGroupManager}/deleteInstances',
+            ['requestId'], 'InstanceGroupManagersDeleteInstancesRequest', 'Operation'),
+           ('zoneOperations', 'get', 'GET',
+            'projects/{project}/zones/{zone}/operations/{operation}',
+            [], None, 'Operation'),
+           ('zoneOperations', 'wait', 'POST',
+            'projects/{project}/zones/{zone}/operations/{operation}/wait',
+            [], None, 'Operation'),
+           ('globalOperations', 'get', 'GET',
+            'projects/{project}/global/operations/{operation}',
+            [], None, 'Operation'),
+           ('globalOperations', 'wait', 'POST',
+            'projects/{project}/global/operations/{operation}/wait',
+            [], None, 'Operation')
+          ]
+
+PARAMETER_TYPES = {
+                   'size': 'integer',
+                   'maxResults': 'integer',
+                   'forceCreate': 'boolean',
+                   'guestFlush': 'boolean'
+                  }
+
+GLOBAL_PARAMETERS = {
+                     'alt': {'type': 'string', 'location': 'query', 'default': 'json'},
+                     'fields': {'type': 'string', 'location': 'query'},
+                     'key': {'type': 'string', 'location': 'query'},
+                     'oauth_token': {'type': 'string', 'location': 'query'},
+                     'prettyPrint': {'type': 'boolean', 'location': 'query'},
+                     'quotaUser': {'type': 'string', 'location': 'query'},
+                     'userIp': {'type': 'string', 'location': 'query'}
+                    }
+
+def discovery_document(root_url):
+    """ Minimal Compute discovery document describing METHODS.
+
+    Enough for googleapiclient.discovery to build a client whose
+    requests all go to root_url. It only describes this server, not
+    the real Compute API.
+    """
+    resources = {}
+    schemas = {}
+    for resource, name, http_method, path, query, request, response in METHODS:
+        parameters = {}
+        order = []
+        for parameter in re.findall(r'{(\w+)}', path):
+            parameters[parameter] = {'type': 'string', 'required': True, 'location': 'path'}
+            order.append(parameter)
+        for parameter in query:
+            parameters[parameter] = {'type': PARAMETER_TYPES.get(parameter, 'string'), 'location': 'query'}
+            if parameter == 'size':
+                parameters[parameter]['required'] = True
+                order.append(parameter)
+        method = {
+                  'id': 'compute.{}.{}'.format(resource, name),
+                  'path': path,
+                  'httpMethod': http_method,
+                  'parameters': parameters,
+                  'parameterOrder': order
+                 }
+        for key, schema in [('request', request), ('response', response)]:
+            if schema:
+                method[key] = {'$ref': schema}
+                schemas.setdefault(schema, {'id': schema, 'type': 'object', 'properties': {}})
+        # googleapiclient adds <method>_next for paged responses
+        if 'pageToken' in query:
+            schemas[response]['properties']['nextPageToken'] = {'type': 'string'}
+        resources.setdefault(resource, {'methods': {}})['methods'][name] = method
+
+    return {
+            'kind': 'discovery#restDescription',
+            'discoveryVersion': 'v1',
+            'id': 'compute:v1',
+            'name': 'compute',
+            'version': 'v1',
+            'title': 'Compute Engine API (sprout fake)',
+            'protocol': 'rest',
+            'rootUrl': root_url,
+            'servicePath': 'compute/v1/',
+            'baseUrl': root_url + 'compute/v1/',
+            'basePath': '/compute/v1/',
+            'batchPath': 'batch/compute/v1',
+            'parameters': GLOBAL_PARAMETERS,
+            'schemas': schemas,
+            'resources': resources
+           }
+
+def parse_fields(mask):
+    """ Parse a partial response mask such as "items/instance,nextPageToken"
+    or "items(name,status)" into a tree of field names; None selects everything.
+    """
+    items = []
+    depth = 0
+    start = 0
+    for index, char in enumerate(mask):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            items.append(mask[start:index])
+            start = index + 1
+    items.append(mask[start:])
+
+    tree = {}
+    for item in items:
+        item = item.strip()
+        if not item:
+            continue
+        subtree = None
+        if '(' in item:
+            item, _, inner = item.partition('(')
+            subtree = parse_fields(inner[:-1])
+        names = item.split('/')
+        node = tree
+        for name in names[:-1]:
+            if node.get(name, {}) is None:
+                break
+            node = node.setdefault(name, {})
+        else:
+            last = names[-1]
+            if subtree is None or node.get(last, {}) is None:
+                node[last] = None
+            else:
+                node.setdefault(last, {}).update(subtree)
+    return tree
+
+def select_fields(value, mask):
+    """ Keep only the fields of a response named by a partial response mask.
+    """
+    def select(value, tree):
+        if tree is None:
+            return value
+        if isinstance(value, list):
+            return [select(item, tree) for item in value]
+        if isinstance(value, dict):
+            return {name: select(value[name], subtree) for name, subtree in tree.items() if name in value}
+        return value
+    return select(value, parse_fields(mask))
+
+def _timestamp(seconds=None):
+    return strftime('%Y-%m-%dT%H:%M:%S.000-00:00', gmtime(seconds))
+
+
+class ApiError(Exception):
+
+    def __init__(self, code, reason, message, domain='global'):
+        super().__init__(message)
+        self.code = code
+        self.reason = reason
+        self.domain = domain
+
+    def body(self):
+        return {
+                'error': {
+                          'code': self.code,
+                          'message': str(self),
+                          'errors': [{'domain': self.domain, 'reason': self.reason, 'message': str(self)}]
+                         }
+               }
+
+
+class FakeCompute:
+
+    def __init__(self, root_url='http://127.0.0.1/', operation_seconds=1.0, durations=None,
+                 boot_seconds=1.0, wait_window=120, rate_limit=None, burst=None,
+                 quotas=None, error_rate=0.0, seed=None):
+        """ In-memory Compute Engine state with timed operations.
+
+        args:
+            root_url (str): URL the server is reachable at; used in selfLinks
+            operation_seconds (float): Default operation duration
+            durations (dict): Duration per operationType, e.g. {'insert': 5}
+            boot_seconds (float): Time new group instances spend STAGING
+            wait_window (float): Longest an operations.wait call blocks
+            rate_limit (float): API requests per second before 429s
+            burst (int): Token bucket size for rate_limit
+            quotas (dict): Limits on 'images' and 'instances' per project
+            error_rate (float): Chance of a 503 backendError per request
+            seed (int): Random seed
+        """
+        self.root_url = root_url
+        self.operation_seconds = operation_seconds
+        self.durations = durations or {}
+        self.boot_seconds = boot_seconds
+        self.wait_window = wait_window
+        self.rate_limit = rate_limit
+        self.burst = burst if burst else (rate_limit or 0)
+        self.quotas = quotas or {}
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+        self.lock = threading.RLock()
+        self.instances = {}
+        self.images = {}
+        self.snapshots = {}
+        self.groups = {}
+        self.operations = {}
+        self.request_ids = {}
+        self.stats = {'requests': 0, 'rate_limited': 0, 'errors': 0, 'methods': {}}
+        self._tokens = float(self.burst)
+        self._refilled = monotonic()
+        self._next_id = 1000
+
+        self._routes = []
+        for resource, name, http_method, path, query, request, response in METHODS:
+            pattern = re.sub(r'{(\w+)}', r'(?P<\1>[^/]+)', path)
+            self._routes.append((http_method, re.compile('^' + pattern + '$'), resource, name))
+
+    # Resources
+
+    def _id(self):
+        self._next_id += 1
+        return str(self._next_id)
+
+    def _link(self, path):
+        return self.root_url + API_PREFIX.lstrip('/') + path
+
+    def add_instance(self, project, zone, name, status='RUNNING', ready_at=None):
+        """ Create an instance (and its boot disk of the same name).
+        """
+        with self.lock:
+            self.instances[(project, zone, name)] = {
+                                                     'id': self._id(),
+                                                     'name': name,
+                                                     'status': status,
+                                                     'ready_at': ready_at or 0,
+                                                     'creationTimestamp': _timestamp(),
+                                                     'selfLink': self._link('projects/{}/zones/{}/instances/{}'.format(
+                                                                                                                       project,
+                                                                                                                       zone,
+                                                                                                                       name))}
+
+    def add_image(self, project, name, family=None):
+        with self.lock:
+            image = {
+                     'id': self._id(),
+                     'name': name,
+                     'status': 'READY',
+                     'creationTimestamp': _timestamp(),
+                     'selfLink': self._link('projects/{}/global/images/{}'.format(project, name))}
+            if family:
+                image['family'] = family
+            self.images[(project, name)] = image
+
+    def add_group(self, project, zone, name, size, base_instance_name=None):
+        """ Create a managed instance group with size RUNNING instances.
+        """
+        with self.lock:
+            self.groups[(project, zone, name)] = {
+                                                  'name': name,
+                                                  'targetSize': size,
+                                                  'baseInstanceName': base_instance_name or name,
+                                                  'members': []}
+            self._reconcile(monotonic(), boot = False)
+
+    def _instance_status(self, instance, now):
+        if instance['status'] == 'RUNNING' and instance['ready_at'] > now:
+            return 'STAGING'
+        return instance['status']
+
+    def _instance_view(self, key, now):
+        instance = self.instances[key]
+        view = {field: value for field, value in instance.items() if field != 'ready_at'}
+        view['status'] = self._instance_status(instance, now)
+        view['kind'] = 'compute#instance'
+        view['disks'] = [{'boot': True, 'source': instance['selfLink'].replace('/instances/', '/disks/')}]
+        return view
+
+    def _reconcile(self, now, boot=True):
+        """ Make each managed instance group match its target size.
+
+        Members deleted outside the group manager are recreated under
+        the same name with a new id, as Compute does.
+        """
+        ready_at = now + self.boot_seconds if boot else 0
+        for (project, zone, name), group in self.groups.items():
+            for member in group['members']:
+                if not (project, zone, member) in self.instances:
+                    self.add_instance(project, zone, member, ready_at = ready_at)
+            while len(group['members']) < group['targetSize']:
+                self._check_quota(project, 'instances', 1)
+                member = '{}-{}'.format(group['baseInstanceName'], uuid.uuid4().hex[:4])
+                group['members'].append(member)
+                self.add_instance(project, zone, member, ready_at = ready_at)
+            while len(group['members']) > group['targetSize']:
+                member = group['members'].pop()
+                self.instances.pop((project, zone, member), None)
+
+    def _check_quota(self, project, resource, extra):
+        limit = self.quotas.get(resource)
+        if limit is None:
+            return
+        if resource == 'images':
+            used = len([key for key in self.images if key[0] == project])
+        else:
+            used = len([key for key in self.instances if key[0] == project])
+        if used + extra > limit:
+            raise ApiError(
+                           403,
+                           'quotaExceeded',
+                           "Quota '{}' exceeded. Limit: {} globally.".format(resource.upper(), limit),
+                           domain = 'usageLimits')
+
+    # Operations
+
+    def _operation(self, project, zone, operation_type, target_link, effect, request_id=None):
+        """ Start a timed operation; effect runs under the lock when it is done.
+        """
+        if request_id and request_id in self.request_ids:
+            return self._operation_view(self.request_ids[request_id], monotonic())
+        now = monotonic()
+        name = 'operation-{}'.format(uuid.uuid4())
+        if zone:
+            path = 'projects/{}/zones/{}/operations/{}'.format(project, zone, name)
+        else:
+            path = 'projects/{}/global/operations/{}'.format(project, name)
+        duration = self.durations.get(operation_type, self.operation_seconds)
+        operation = {
+                     'kind': 'compute#operation',
+                     'id': self._id(),
+                     'name': name,
+                     'operationType': operation_type,
+                     'targetLink': target_link,
+                     'insertTime': _timestamp(),
+                     'selfLink': self._link(path),
+                     '_started': now,
+                     '_done_at': now + duration,
+                     '_effect': effect,
+                     '_applied': False
+                    }
+        if zone:
+            operation['zone'] = self._link('projects/{}/zones/{}'.format(project, zone))
+        self.operations[(project, zone, name)] = operation
+        if request_id:
+            self.request_ids[request_id] = operation
+        return self._operation_view(operation, now)
+
+    def _operation_view(self, operation, now):
+        view = {key: value for key, value in operation.items() if not key.startswith('_')}
+        if operation['_applied']:
+            view['status'] = 'DONE'
+            view['progress'] = 100
+        elif now < operation['_started'] + 0.1 * (operation['_done_at'] - operation['_started']):
+            view['status'] = 'PENDING'
+            view['progress'] = 0
+        else:
+            view['status'] = 'RUNNING'
+            view['progress'] = 50
+        return view
+
+    def tick(self):
+        """ Finish due operations and reconcile instance groups.
+        """
+        with self.lock:
+            now = monotonic()
+            for operation in self.operations.values():
+                if not operation['_applied'] and operation['_done_at'] <= now:
+                    operation['_applied'] = True
+                    operation['endTime'] = _timestamp()
+                    try:
+                        operation['_effect']()
+                    except ApiError as err:
+                        operation['error'] = {'errors': [{'code': err.reason.upper(), 'message': str(err)}]}
+            try:
+                self._reconcile(now)
+            except ApiError:
+                pass
+
+    def _get_operation(self, project, zone, name):
+        operation = self.operations.get((project, zone, name))
+        if operation is None:
+            raise ApiError(404, 'notFound', "The resource 'operations/{}' was not found".format(name))
+        return operation
+
+    # Request handling
+
+    def _throttle(self):
+        if not self.rate_limit:
+            return
+        now = monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate_limit)
+        self._refilled = now
+        if self._tokens < 1:
+            self.stats['rate_limited'] += 1
+            raise ApiError(429, 'rateLimitExceeded', 'Rate Limit Exceeded', domain = 'usageLimits')
+        self._tokens -= 1
+
+    def handle(self, http_method, path, query, body):
+        """ Handle one API call.
+
+        args:
+            http_method (str): GET, POST or DELETE
+            path (str): Path below /compute/v1/
+            query (dict): Query parameters, one value each
+            body (dict): JSON request body
+
+        returns:
+            tuple of (HTTP status, response dict)
+        """
+        for method, pattern, resource, name in self._routes:
+            match = pattern.match(path)
+            if method == http_method and match:
+                break
+        else:
+            return 404, ApiError(404, 'notFound', 'Unknown method {} {}'.format(http_method, path)).body()
+
+        key = '{}.{}'.format(resource, name)
+        try:
+            with self.lock:
+                self.stats['requests'] += 1
+                self.stats['methods'][key] = self.stats['methods'].get(key, 0) + 1
+                self._throttle()
+                if self.error_rate and self.random.random() < self.error_rate:
+                    self.stats['errors'] += 1
+                    raise ApiError(503, 'backendError', 'Backend Error')
+            self.tick()
+            handler = getattr(self, '_{}_{}'.format(resource, name))
+            response = handler(query = query, body = body or {}, **match.groupdict())
+            if query.get('fields'):
+                response = select_fields(response, query['fields'])
+            return 200, response
+        except ApiError as err:
+            return err.code, err.body()
+
+    def _instances_get(self, project, zone, instance, query, body):
+        with self.lock:
+            if not (project, zone, instance) in self.instances:
+                raise ApiError(404, 'notFound', "The resource 'instances/{}' was not found".format(instance))
+            return self._instance_view((project, zone, instance), monotonic())
+
+    def _instances_stop(self, project, zone, instance, query, body):
+        with self.lock:
+            key = (project, zone, instance)
+            if not key in self.instances:
+                raise ApiError(404, 'notFound', "The resource 'instances/{}' was not found".format(instance))
+
+            def effect():
+                if key in self.instances:
+                    self.instances[key]['status'] = 'TERMINATED'
+            return self._operation(project, zone, 'stop', self.instances[key]['selfLink'], effect, query.get('requestId'))
+
+    def _instances_delete(self, project, zone, instance, query, body):
+        with self.lock:
+            key = (project, zone, instance)
+            if not key in self.instances:
+                raise ApiError(404, 'notFound', "The resource 'instances/{}' was not found".format(instance))
+
+            def effect():
+                self.instances.pop(key, None)
+            return self._operation(project, zone, 'delete', self.instances[key]['selfLink'], effect, query.get('requestId'))
+
+    @staticmethod
+    def _image_view(image):
+        view = {key: value for key, value in image.items() if not key.startswith('_')}
+        view['kind'] = 'compute#image'
+        return view
+
+    def _family_images(self, project, family):
+        """ Images of a family, oldest first.
+        """
+        images = [image for (image_project, name), image in self.images.items()
+                  if image_project == project and image.get('family') == family]
+        return sorted(images, key = lambda image: int(image['id']))
+
+    def _images_get(self, project, image, query, body):
+        with self.lock:
+            if not (project, image) in self.images:
+                raise ApiError(404, 'notFound', "The resource 'images/{}' was not found".format(image))
+            return self._image_view(self.images[(project, image)])
+
+    def _images_getFromFamily(self, project, family, query, body):
+        with self.lock:
+            images = [image for image in self._family_images(project, family) if not 'deprecated' in image]
+            if not images:
+                raise ApiError(404, 'notFound', "The resource 'images/family/{}' was not found".format(family))
+            return self._image_view(images[-1])
+
+    def _images_list(self, project, query, body):
+        with self.lock:
+            match = re.match(r'^\s*family\s*=\s*"?([^"\s]+)"?\s*$', query.get('filter', ''))
+            if match:
+                images = self._family_images(project, match.group(1))
+            else:
+                images = sorted([image for key, image in self.images.items() if key[0] == project],
+                                key = lambda image: int(image['id']))
+            return self._page([self._image_view(image) for image in images], query, 'items',
+                              {'kind': 'compute#imageList'})
+
+    def _images_deprecate(self, project, image, query, body):
+        with self.lock:
+            key = (project, image)
+            if not key in self.images:
+                raise ApiError(404, 'notFound', "The resource 'images/{}' was not found".format(image))
+
+            def effect():
+                if not key in self.images:
+                    return
+                if body.get('state'):
+                    self.images[key]['deprecated'] = dict(body)
+                else:
+                    self.images[key].pop('deprecated', None)
+            return self._operation(project, None, 'deprecate', self.images[key]['selfLink'], effect, query.get('requestId'))
+
+    def _images_insert(self, project, query, body):
+        with self.lock:
+            name = body.get('name')
+            if not name:
+                raise ApiError(400, 'required', 'Required field name not specified')
+            if (project, name) in self.images:
+                raise ApiError(409, 'alreadyExists', "The resource 'images/{}' already exists".format(name))
+            self._check_quota(project, 'images', 1)
+            source_disk = body.get('sourceDisk', '')
+            match = re.search(r'zones/([^/]+)/disks/([^/]+)$', source_disk)
+            snapshot = re.search(r'snapshots/([^/]+)$', body.get('sourceSnapshot', ''))
+            if snapshot:
+                if not (project, snapshot.group(1)) in self.snapshots:
+                    raise ApiError(404, 'notFound', "The resource 'snapshots/{}' was not found".format(snapshot.group(1)))
+            elif match:
+                instance = self.instances.get((project, match.group(1), match.group(2)))
+                if instance is None:
+                    raise ApiError(404, 'notFound', "The resource '{}' was not found".format(source_disk))
+                force = str(query.get('forceCreate', 'false')).lower() == 'true'
+                if instance['status'] != 'TERMINATED' and not force:
+                    raise ApiError(
+                                   400,
+                                   'resourceInUseByAnotherResource',
+                                   "The disk resource '{}' is already being used by a running instance".format(source_disk))
+            link = self._link('projects/{}/global/images/{}'.format(project, name))
+
+            def effect():
+                self.add_image(project, name, family = body.get('family'))
+            return self._operation(project, None, 'insert', link, effect, query.get('requestId'))
+
+    def _images_delete(self, project, image, query, body):
+        with self.lock:
+            key = (project, image)
+            if not key in self.images:
+                raise ApiError(404, 'notFound', "The resource 'images/{}' was not found".format(image))
+
+            def effect():
+                self.images.pop(key, None)
+            return self._operation(project, None, 'delete', self.images[key]['selfLink'], effect, query.get('requestId'))
+
+    def _disks_createSnapshot(self, project, zone, disk, query, body):
+        with self.lock:
+            if not (project, zone, disk) in self.instances:
+                raise ApiError(404, 'notFound', "The resource 'disks/{}' was not found".format(disk))
+            name = body.get('name')
+            if not name:
+                raise ApiError(400, 'required', 'Required field name not specified')
+            if (project, name) in self.snapshots:
+                raise ApiError(409, 'alreadyExists', "The resource 'snapshots/{}' already exists".format(name))
+            link = self._link('projects/{}/global/snapshots/{}'.format(project, name))
+
+            def effect():
+                self.snapshots[(project, name)] = {
+                                                   'kind': 'compute#snapshot',
+                                                   'id': self._id(),
+                                                   'name': name,
+                                                   'status': 'READY',
+                                                   'sourceDisk': self._link('projects/{}/zones/{}/disks/{}'.format(
+                                                                                                                   project,
+                                                                                                                   zone,
+                                                                                                                   disk)),
+                                                   'creationTimestamp': _timestamp(),
+                                                   'selfLink': link}
+            return self._operation(project, zone, 'createSnapshot', link, effect, query.get('requestId'))
+
+    def _snapshots_get(self, project, snapshot, query, body):
+        with self.lock:
+            if not (project, snapshot) in self.snapshots:
+                raise ApiError(404, 'notFound', "The resource 'snapshots/{}' was not found".format(snapshot))
+            return self.snapshots[(project, snapshot)]
+
+    def _snapshots_delete(self, project, snapshot, query, body):
+        with self.lock:
+            key = (project, snapshot)
+            if not key in self.snapshots:
+                raise ApiError(404, 'notFound', "The resource 'snapshots/{}' was not found".format(snapshot))
+
+            def effect():
+                self.snapshots.pop(key, None)
+            return self._operation(project, None, 'delete', self.snapshots[key]['selfLink'], effect, query.get('requestId'))
+
+    def _group(self, project, zone, name):
+        group = self.groups.get((project, zone, name))
+        if group is None:
+            raise ApiError(404, 'notFound', "The resource 'instanceGroups/{}' was not found".format(name))
+        return group
+
+    @staticmethod
+    def _page(items, query, key, extra=None):
+        """ Paginate items with maxResults/pageToken like the real API.
+        """
+        start = int(query.get('pageToken') or 0)
+        size = int(query.get('maxResults') or 500)
+        response = dict(extra or {})
+        if items[start:start + size]:
+            response[key] = items[start:start + size]
+        if start + size < len(items):
+            response['nextPageToken'] = str(start + size)
+        return response
+
+    def _instanceGroups_listInstances(self, project, zone, instanceGroup, query, body):
+        with self.lock:
+            now = monotonic()
+            group = self._group(project, zone, instanceGroup)
+            items = []
+            for member in group['members']:
+                key = (project, zone, member)
+                if not key in self.instances:
+                    continue
+                status = self._instance_status(self.instances[key], now)
+                if body.get('instanceState', 'ALL') == 'RUNNING' and status != 'RUNNING':
+                    continue
+                items.append({'instance': self.instances[key]['selfLink'], 'status': status})
+            return self._page(items, query, 'items', {'kind': 'compute#instanceGroupsListInstances'})
+
+    def _instanceGroupManagers_get(self, project, zone, instanceGroupManager, query, body):
+        with self.lock:
+            group = self._group(project, zone, instanceGroupManager)
+            managed = self._managed_instances(project, zone, group, monotonic())
+            stable = all(instance['currentAction'] == 'NONE' for instance in managed)
+            return {
+                    'kind': 'compute#instanceGroupManager',
+                    'name': group['name'],
+                    'baseInstanceName': group['baseInstanceName'],
+                    'targetSize': group['targetSize'],
+                    'status': {'isStable': stable}
+                   }
+
+    def _managed_instances(self, project, zone, group, now):
+        managed = []
+        for member in group['members']:
+            key = (project, zone, member)
+            if not key in self.instances:
+                managed.append({'instance': self._link('projects/{}/zones/{}/instances/{}'.format(project, zone, member)),
+                                'currentAction': 'RECREATING'})
+                continue
+            instance = self.instances[key]
+            status = self._instance_status(instance, now)
+            managed.append({
+                            'instance': instance['selfLink'],
+                            'id': instance['id'],
+                            'instanceStatus': status,
+                            'currentAction': 'CREATING' if status == 'STAGING' else 'NONE'})
+        return managed
+
+    def _instanceGroupManagers_listManagedInstances(self, project, zone, instanceGroupManager, query, body):
+        with self.lock:
+            group = self._group(project, zone, instanceGroupManager)
+            managed = self._managed_instances(project, zone, group, monotonic())
+            return self._page(managed, query, 'managedInstances')
+
+    def _instanceGroupManagers_resize(self, project, zone, instanceGroupManager, query, body):
+        with self.lock:
+            group = self._group(project, zone, instanceGroupManager)
+            size = int(query['size'])
+            extra = size - len(group['members'])
+            if extra > 0:
+                self._check_quota(project, 'instances', extra)
+
+            def effect():
+                group['targetSize'] = size
+            link = self._link('projects/{}/zones/{}/instanceGroupManagers/{}'.format(project, zone, group['name']))
+            return self._operation(project, zone, 'compute.instanceGroupManagers.resize', link, effect, query.get('requestId'))
+
+    def _instanceGroupManagers_deleteInstances(self, project, zone, instanceGroupManager, query, body):
+        with self.lock:
+            group = self._group(project, zone, instanceGroupManager)
+            names = [url.split('/')[-1] for url in body.get('instances', [])]
+            names = [name for name in names if name in group['members']]
+            for name in names:
+                group['members'].remove(name)
+            group['targetSize'] -= len(names)
+
+            def effect():
+                for name in names:
+                    self.instances.pop((project, zone, name), None)
+            link = self._link('projects/{}/zones/{}/instanceGroupManagers/{}'.format(project, zone, group['name']))
+            return self._operation(project, zone, 'compute.instanceGroupManagers.deleteInstances', link, effect,
+                                   query.get('requestId'))
+
+    def _wait(self, project, zone, name):
+        with self.lock:
+            operation = self._get_operation(project, zone, name)
+            until = min(operation['_done_at'], monotonic() + self.wait_window)
+        sleep(max(0, until - monotonic()))
+        self.tick()
+        with self.lock:
+            return self._operation_view(operation, monotonic())
+
+    def _zoneOperations_get(self, project, zone, operation, query, body):
+        with self.lock:
+            return self._operation_view(self._get_operation(project, zone, operation), monotonic())
+
+    def _zoneOperations_wait(self, project, zone, operation, query, body):
+        return self._wait(project, zone, operation)
+
+    def _globalOperations_get(self, project, operation, query, body):
+        with self.lock:
+            return self._operation_view(self._get_operation(project, None, operation), monotonic())
+
+    def _globalOperations_wait(self, project, operation, query, body):
+        return self._wait(project, None, operation)
+
+
+class FakeComputeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    compute = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, payload, content_type='application/json'):
+        if isinstance(payload, (dict, list)):
+            payload = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _call(self, http_method, target, body):
+        parts = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        if not parts.path.startswith(API_PREFIX):
+            return 404, ApiError(404, 'notFound', 'Unknown path {}'.format(parts.path)).body()
+        try:
+            data = json.loads(body.decode('utf-8')) if body else {}
+        except ValueError:
+            return 400, ApiError(400, 'parseError', 'Invalid JSON body').body()
+        return self.compute.handle(http_method, parts.path[len(API_PREFIX):], query, data)
+
+    def _batch(self, body):
+        """ Handle a multipart/mixed batch request like googleapiclient sends.
+        """
+        content_type = self.headers.get('Content-Type', '')
+        message = email.parser.BytesParser().parsebytes(
+                                                        b'Content-Type: ' + content_type.encode('utf-8') +
+                                                        b'\r\n\r\n' + body)
+        boundary = 'batch_' + uuid.uuid4().hex
+        chunks = []
+        for part in message.get_payload():
+            payload = part.get_payload(decode = False)
+            head, _, part_body = payload.replace('\r\n', '\n').partition('\n\n')
+            request_line = head.split('\n', 1)[0]
+            http_method, target = request_line.split(' ')[:2]
+            status, response = self._call(http_method, target, part_body.strip().encode('utf-8'))
+            content_id = part.get('Content-ID', '<+>')
+            chunks.append(
+                          '--{}\r\nContent-Type: application/http\r\nContent-ID: <response-{}>\r\n\r\n'.format(
+                                                                                                           boundary,
+                                                                                                           content_id[1:-1]) +
+                          'HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n\r\n{}\r\n'.format(
+                                                                                                  status,
+                                                                                                  'OK' if status == 200 else 'Error',
+                                                                                                  json.dumps(response)))
+        chunks.append('--{}--\r\n'.format(boundary))
+        self._send(200, ''.join(chunks).encode('utf-8'), 'multipart/mixed; boundary={}'.format(boundary))
+
+    def _dispatch(self):
+        body = self._body()
+        path = urlsplit(self.path).path
+        if self.command == 'GET' and path == DISCOVERY_PATH:
+            self._send(200, discovery_document(self.compute.root_url))
+        elif self.command == 'GET' and path == STATS_PATH:
+            with self.compute.lock:
+                self._send(200, self.compute.stats)
+        elif self.command == 'POST' and path == BATCH_PATH:
+            self._batch(body)
+        else:
+            status, response = self._call(self.command, self.path, body)
+            self._send(status, response)
+
+    do_GET = _dispatch
+    do_POST = _dispatch
+    do_DELETE = _dispatch
+
+
+def start_server(compute, host='127.0.0.1', port=0):
+    """ Serve a FakeCompute from a background thread.
+
+    returns:
+        the server; server.root_url is the base URL to give ComputeOperator
+    """
+    handler = type('Handler', (FakeComputeHandler,), {'compute': compute})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.root_url = 'http://{}:{}/'.format(host, server.server_address[1])
+    compute.root_url = server.root_url
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def _pairs(values, cast):
+    pairs = {}
+    for value in values or []:
+        key, _, number = value.partition('=')
+        pairs[key] = cast(number)
+    return pairs
+
+def parse_args(args):
+
+    parser = argparse.ArgumentParser(description = 'Local stand-in for the Compute Engine API.')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8089)
+    parser.add_argument('--project', default = 'sprout-fake-project')
+    parser.add_argument('--zone', default = 'us-central1-a')
+    parser.add_argument('--instance', action = 'append', default = [],
+                        help = 'Create a standalone instance (e.g. the image source). Repeatable.')
+    parser.add_argument('--image', action = 'append', default = [],
+                        help = 'Create an image. Repeatable.')
+    parser.add_argument('--group', action = 'append', default = [],
+                        help = 'Create a managed instance group as NAME:SIZE. Repeatable.')
+    parser.add_argument('--operation-seconds', type = float, default = 1.0,
+                        help = 'Default time operations take to finish.')
+    parser.add_argument('--duration', action = 'append', default = [],
+                        help = 'Override operation time as TYPE=SECONDS, e.g. insert=30. Repeatable.')
+    parser.add_argument('--boot-seconds', type = float, default = 1.0,
+                        help = 'Time new group instances spend STAGING.')
+    parser.add_argument('--wait-window', type = float, default = 120,
+                        help = 'Longest an operations.wait call blocks.')
+    parser.add_argument('--rate-limit', type = float, default = None,
+                        help = 'API requests per second before 429 rateLimitExceeded.')
+    parser.add_argument('--burst', type = int, default = None,
+                        help = 'Token bucket size for --rate-limit.')
+    parser.add_argument('--quota', action = 'append', default = [],
+                        help = 'Quota as images=N or instances=N. Repeatable.')
+    parser.add_argument('--error-rate', type = float, default = 0.0,
+                        help = 'Chance of a 503 backendError per request.')
+    parser.add_argument('--seed', type = int, default = None)
+    return parser.parse_args(args)
+
+def main():
+
+    args = parse_args(sys.argv[1:])
+    compute = FakeCompute(
+                          operation_seconds = args.operation_seconds,
+                          durations = _pairs(args.duration, float),
+                          boot_seconds = args.boot_seconds,
+                          wait_window = args.wait_window,
+                          rate_limit = args.rate_limit,
+                          burst = args.burst,
+                          quotas = _pairs(args.quota, int),
+                          error_rate = args.error_rate,
+                          seed = args.seed)
+    for name in args.instance:
+        compute.add_instance(args.project, args.zone, name)
+    for name in args.image:
+        compute.add_image(args.project, name)
+    for group in args.group:
+        name, _, size = group.partition(':')
+        compute.add_group(args.project, args.zone, name, int(size or 1))
+
+    server = start_server(compute, args.host, args.port)
+    print("Fake Compute API for project {} zone {} at {}".format(args.project, args.zone, server.root_url))
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -1,94 +1,843 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import sys
-import hcl
-import pdb
+import json
 import uuid
-import yaml
+import queue
+import random
+import hashlib
 import argparse
+import functools
+import signal
+import threading
+import contextvars
 import subprocess
+import urllib.parse
 
-from time import sleep
+from time import sleep, monotonic, time, strftime, gmtime
 from pprint import pprint
+from functools import lru_cache
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-import googleapiclient.discovery
-from oauth2client.client import GoogleCredentials
-from googleapiclient.errors import HttpError
+# googleapiclient, oauth2client, httplib2, hcl and yaml are imported where
+# they are used: most runs never touch the Compute API, and importing them
+# would triple sprout's startup time (see TestImportTime).
+
+# Innermost timing span of the current thread or asyncio task
+_current_span = contextvars.ContextVar('sprout_span', default=None)
+
+class RunMetrics:
+
+    def __init__(self):
+        """ Collect timing spans for Terraform phases and Compute API calls.
+
+        Each span records wall time plus the API requests, poll
+        iterations and idle sleep seconds that happened inside it,
+        including inside nested spans. Totals per kind, name and labels
+        are kept as spans finish, so drain() can hand spans off without
+        losing them from the summary.
+        """
+        self.started = time()
+        self.spans = []
+        self._totals = {}
+        # Run-wide counters by name and labels, e.g. per rate limit bucket
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, kind, name, **labels):
+        """ Time a block of code.
+
+        args:
+            kind (str): "set", "phase" or "compute"
+            name (str): Phase or API call name
+            labels (dict): Extra labels; the enclosing span's labels are inherited
+        """
+        parent = _current_span.get()
+        merged = dict(parent['labels']) if parent else {}
+        merged.update(labels)
+        record = {
+                  'kind': kind,
+                  'name': name,
+                  'labels': merged,
+                  'start': round(time() - self.started, 3),
+                  'duration': None,
+                  'requests': 0,
+                  'polls': 0,
+                  'sleep': 0.0,
+                  'throttle': 0.0,
+                  'rate_limited': 0,
+                  'parent': parent
+                 }
+        token = _current_span.set(record)
+        start = monotonic()
+        try:
+            yield record
+        finally:
+            record['duration'] = monotonic() - start
+            _current_span.reset(token)
+            with self._lock:
+                self.spans.append(record)
+                self._add_total(record)
+
+    def _add_total(self, span):
+        key = (span['kind'], span['name'], tuple(sorted(span['labels'].items())))
+        total = self._totals.setdefault(key, {
+                                              'kind': span['kind'],
+                                              'name': span['name'],
+                                              'labels': span['labels'],
+                                              'count': 0,
+                                              'seconds': 0.0,
+                                              'requests': 0,
+                                              'polls': 0,
+                                              'sleep': 0.0,
+                                              'throttle': 0.0,
+                                              'rate_limited': 0})
+        total['count'] += 1
+        total['seconds'] += span['duration']
+        for field in ['requests', 'polls', 'sleep', 'throttle', 'rate_limited']:
+            total[field] += span[field]
+
+    def summary(self):
+        """ Spans aggregated by kind, name and labels, slowest first.
+
+        Drained spans are included.
+        """
+        with self._lock:
+            totals = [dict(total) for total in self._totals.values()]
+        return sorted(totals, key = lambda total: -total['seconds'])
+
+    def drain(self):
+        """ Remove and return the spans finished so far.
+
+        A daemon drains after every request so memory, and the cost of
+        each metrics write, stay bounded; the summary keeps their totals.
+        """
+        with self._lock:
+            spans = self.spans
+            self.spans = []
+        return spans
+
+    def add(self, name, amount=1, **labels):
+        """ Add to a run-wide counter.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def write_json(self, path):
+        """ Write the aggregated summary, counters and the spans not yet drained as JSON.
+        """
+        with self._lock:
+            spans = [
+                     {key: value for key, value in span.items() if key != 'parent'}
+                     for span in self.spans]
+            counters = [
+                        {'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+        report = {
+                  'started': self.started,
+                  'duration': time() - self.started,
+                  'summary': self.summary(),
+                  'counters': counters,
+                  'spans': spans
+                 }
+        _write_atomic(path, json.dumps(report, indent=2, sort_keys=True))
+
+    def write_prometheus(self, path):
+        """ Write the summary in the Prometheus textfile collector format.
+        """
+        series = [
+                  ('sprout_span_seconds', 'seconds', 'Wall time of sprout phases and Compute API calls.'),
+                  ('sprout_span_count', 'count', 'Number of times the phase or call ran.'),
+                  ('sprout_span_api_requests', 'requests', 'Compute API requests made inside the span.'),
+                  ('sprout_span_polls', 'polls', 'Operation poll iterations inside the span.'),
+                  ('sprout_span_sleep_seconds', 'sleep', 'Seconds spent sleeping between polls inside the span.'),
+                  ('sprout_span_throttle_seconds', 'throttle', 'Seconds API requests waited on the rate limiter inside the span.'),
+                  ('sprout_span_rate_limited', 'rate_limited', 'Rate limit responses from the API inside the span.')]
+        summary = self.summary()
+        lines = []
+        for metric, field, help_text in series:
+            lines.append("# HELP {} {}".format(metric, help_text))
+            lines.append("# TYPE {} gauge".format(metric))
+            for total in summary:
+                labels = dict(total['labels'], kind = total['kind'], name = total['name'])
+                label_text = ",".join(
+                                      '{}="{}"'.format(key, _prometheus_escape(value))
+                                      for key, value in sorted(labels.items()))
+                lines.append("{}{{{}}} {}".format(metric, label_text, total[field]))
+        with self._lock:
+            counters = sorted(self.counters.items())
+        for name in sorted(set(name for (name, labels), value in counters)):
+            lines.append("# TYPE sprout_{} counter".format(name))
+            for (counter, labels), value in counters:
+                if counter == name:
+                    label_text = ",".join('{}="{}"'.format(key, _prometheus_escape(label)) for key, label in labels)
+                    lines.append("sprout_{}{{{}}} {}".format(name, label_text, value))
+        lines.append("# HELP sprout_run_timestamp_seconds Start time of the sprout run.")
+        lines.append("# TYPE sprout_run_timestamp_seconds gauge")
+        lines.append("sprout_run_timestamp_seconds {}".format(self.started))
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+def _prometheus_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _write_atomic(path, text):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as fh:
+        fh.write(text)
+    os.replace(temp_path, path)
+
+def _count(field, amount=1):
+    """ Add to a counter of the current span and every span enclosing it.
+    """
+    span = _current_span.get()
+    while span is not None:
+        span[field] += amount
+        span = span['parent']
+
+def count_request():
+    _count('requests')
+
+def count_poll():
+    _count('polls')
+
+def idle(seconds):
+    """ Sleep between polls, recording the idle time.
+    """
+    _count('sleep', seconds)
+    sleep(seconds)
+
+# Spans of this run; exported at the end of main()
+metrics = RunMetrics()
+
+def timed_call(method):
+    """ Record a span for every call of a ComputeOperator method.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with metrics.span('compute', method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def async_timed_call(method):
+    """ Record a span for every call of an AsyncComputeOperator coroutine.
+    """
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        with metrics.span('compute', method.__name__):
+            return await method(self, *args, **kwargs)
+    return wrapper
+
+
+class RateLimiter:
+
+    def __init__(self, project_rate=20.0, region_rate=None, burst=None):
+        """ Token buckets shared by every Compute API request.
+
+        Each request takes a token from its project's bucket and, for
+        zonal or regional resources, from the project's bucket for that
+        region. Requests reserve tokens ahead of time, so concurrent
+        callers are spaced out instead of all retrying at once. A rate
+        limit response blocks the bucket for the backoff delay.
+
+        args:
+            project_rate (float): Requests per second per project, None for no limit
+            region_rate (float): Requests per second per project and region
+            burst (int): Bucket size; defaults to one second of requests
+        """
+        self._lock = threading.Lock()
+        self.configure(project_rate, region_rate, burst)
+
+    def configure(self, project_rate=20.0, region_rate=None, burst=None):
+        with self._lock:
+            self.rates = {'project': project_rate, 'region': region_rate}
+            self.burst = burst
+            self._buckets = {}
+
+    @staticmethod
+    def keys(uri):
+        """ Bucket keys for a Compute API URL.
+        """
+        keys = []
+        project = re.search(r'/projects/([^/?]+)', uri)
+        if project:
+            keys.append(('project', project.group(1)))
+            zone = re.search(r'/zones/([^/?]+)', uri)
+            region = re.search(r'/regions/([^/?]+)', uri)
+            if zone:
+                keys.append(('region', "{}/{}".format(project.group(1), zone.group(1).rsplit('-', 1)[0])))
+            elif region:
+                keys.append(('region', "{}/{}".format(project.group(1), region.group(1))))
+        return keys
+
+    def reserve(self, keys, count=1):
+        """ Take count tokens from each bucket.
+
+        returns:
+            seconds the caller must wait before sending
+        """
+        with self._lock:
+            now = monotonic()
+            start = now
+            buckets = []
+            for scope, name in keys:
+                rate = self.rates.get(scope)
+                if not rate:
+                    continue
+                burst = self.burst or max(1, rate)
+                bucket = self._buckets.get((scope, name))
+                if bucket is None:
+                    bucket = self._buckets[(scope, name)] = {'tokens': burst, 'updated': now, 'blocked': now}
+                bucket['tokens'] = min(burst, bucket['tokens'] + (now - bucket['updated']) * rate)
+                bucket['updated'] = now
+                ready = now + max(0, count - bucket['tokens']) / rate
+                start = max(start, ready, bucket['blocked'])
+                buckets.append(bucket)
+            for bucket in buckets:
+                bucket['tokens'] -= count
+        return start - now
+
+    def block(self, keys, seconds):
+        """ Hold back every request to these buckets for seconds.
+        """
+        with self._lock:
+            until = monotonic() + seconds
+            for key in keys:
+                bucket = self._buckets.get(key)
+                if bucket is not None:
+                    bucket['blocked'] = max(bucket['blocked'], until)
+
+    def record(self, keys, waited):
+        """ Count time spent throttled, in the current span and per bucket.
+        """
+        if waited <= 0:
+            return
+        _count('throttle', waited)
+        for scope, name in keys:
+            metrics.add('api_throttled_seconds_total', waited, scope = scope, bucket = name)
+
+    def acquire(self, keys, count=1):
+        """ Wait until count requests may be sent to these buckets.
+        """
+        waited = self.reserve(keys, count)
+        self.record(keys, waited)
+        if waited > 0:
+            sleep(waited)
+
+    async def acquire_async(self, keys, count=1):
+        import asyncio
+        waited = self.reserve(keys, count)
+        self.record(keys, waited)
+        if waited > 0:
+            await asyncio.sleep(waited)
+
+    def rate_limited(self, keys, attempt):
+        """ Back off every bucket of a request the API rate limited.
+
+        returns:
+            the backoff delay in seconds
+        """
+        delay = backoff_delay(attempt, base = 1, cap = 60)
+        _count('rate_limited')
+        for scope, name in keys:
+            metrics.add('api_rate_limited_total', scope = scope, bucket = name)
+        self.block(keys, delay)
+        return delay
+
+# Shared by every ComputeOperator and AsyncComputeOperator; see --api-rate
+rate_limiter = RateLimiter()
+
+def is_http_error(error):
+    """ isinstance(error, HttpError) without importing googleapiclient;
+    nothing can raise an HttpError before it has been imported.
+    """
+    errors = sys.modules.get('googleapiclient.errors')
+    return errors is not None and isinstance(error, errors.HttpError)
+
+def is_rate_limited(error):
+    """ True for 429 and 403 rateLimitExceeded API errors.
+    """
+    if not is_http_error(error):
+        return False
+    status = error.resp.status
+    return status == 429 or (status == 403 and b'ateLimitExceeded' in (error.content or b''))
+
+# Terraform output that means a retry may succeed
+TRANSIENT_OUTPUT = re.compile(
+                              r'Error acquiring the state lock|'
+                              r'googleapi: Error (429|5\d\d)|'
+                              r'rateLimitExceeded|backendError|'
+                              r'connection reset by peer|TLS handshake timeout|i/o timeout|unexpected EOF',
+                              re.IGNORECASE)
+
+def is_transient_error(error):
+    """ True if error is worth retrying: Terraform timeouts, API 429/5xx,
+    dropped connections and Terraform failures whose output shows rate
+    limits, server errors, network errors or state lock contention.
+
+    A TimeoutError from waiting on operations or an instance group is
+    not transient: the work behind it is still running or stuck.
+    """
+    if isinstance(error, subprocess.TimeoutExpired):
+        return True
+    if isinstance(error, subprocess.CalledProcessError):
+        return bool(TRANSIENT_OUTPUT.search(error.output or ''))
+    if is_http_error(error):
+        return is_rate_limited(error) or error.resp.status >= 500
+    return isinstance(error, ConnectionError)
+
+def backoff_delay(attempt, base=5, cap=120):
+    """ Exponential backoff with full jitter for the given retry attempt.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def retry_transient(function, tries=3, log=print, before_retry=None):
+    """ Call function, retrying transient errors with backoff.
+
+    Permanent errors, and the last transient one, are raised.
+
+    args:
+        function (callable): Work to run
+        tries (int): Total attempts
+        log (callable): Receives retry messages
+        before_retry (callable): Run before each retry
+
+    returns:
+        what function returns
+    """
+    for attempt in range(tries):
+        try:
+            return function()
+        except Exception as err:
+            if attempt == tries - 1 or not is_transient_error(err):
+                raise
+            delay = backoff_delay(attempt)
+            log("WARNING: transient error: {}; retrying in {:.1f}s ({} tries left).".format(
+                                                                                         str(err).splitlines()[0] if str(err) else type(err).__name__,
+                                                                                         delay,
+                                                                                         tries - attempt - 1))
+            idle(delay)
+            if before_retry is not None:
+                before_retry()
+
+
+# Terraform's own default -parallelism
+TERRAFORM_PARALLELISM = 10
+
+class ParallelismBudget:
+
+    def __init__(self, total, concurrency=1, maximum=None, history=None):
+        """ Terraform -parallelism values sharing one global budget.
+
+        Every running plan, apply or destroy holds a share of total
+        concurrent resource operations. A command asks for as many as
+        it has operations to do, up to maximum, and waits until at
+        least its fair share (total / concurrency) of that is free.
+
+        args:
+            total (int): Resource operations across all running sets
+            concurrency (int): Sets run at once, as --parallel
+            maximum (int): Largest -parallelism for one set; defaults to total
+            history (RunHistory): Past resource counts for commands
+                                  without a plan or state to go by
+        """
+        if total < 1:
+            raise ValueError("The parallelism budget must be at least 1.")
+        self.total = total
+        self.maximum = min(maximum or total, total)
+        self.fair = max(1, total // max(1, concurrency))
+        self.history = history
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    def want(self, demand, name=None, phase=None):
+        """ -parallelism a command would like for demand resource operations.
+
+        Without a demand, the median count of the set's past runs of the
+        phase is used, or Terraform's default of 10 up to the fair share.
+        """
+        if not demand and self.history is not None and name is not None:
+            demand, source = self.history.estimate('resources', phase, name)
+            if source != 'history':
+                # Other sets' sizes say nothing about this one
+                demand = None
+        if not demand:
+            demand = min(TERRAFORM_PARALLELISM, self.fair)
+        return max(1, min(int(round(demand)), self.maximum))
+
+    @contextmanager
+    def share(self, want):
+        """ Hold up to want of the budget while a command runs.
+
+        yields:
+            the -parallelism granted
+        """
+        with self._condition:
+            while self.total - self.in_use < min(want, self.fair):
+                self._condition.wait()
+            granted = min(want, self.total - self.in_use)
+            self.in_use += granted
+        try:
+            yield granted
+        finally:
+            with self._condition:
+                self.in_use -= granted
+                self._condition.notify_all()
+
+DEPLOY_MODES = ('minimal', 'full')
 
 class BaseDeployment:
 
-    def __init__(self, root, state_file, var_files):
+    def __init__(self, root, state_file, var_files, name=None, depends_on=None, network=None,
+                 mode='minimal', replace=None, target=None):
         """ Manage Terraform deployment process.
 
-            name(str): Arbitrary name of this deployment process
+            root(str): Directory with Terraform configuration files
             state_file(str): Path to tfstate file
             var_files(list): List of tfvars files
+            name(str): Arbitrary name of this deployment process
+            depends_on(list): Names of deployments that must finish first
+            network(str): Network/project key used to cap concurrency
+            mode(str): 'minimal' applies a plan in place; 'full' destroys
+                       the whole stack first
+            replace(list): Resource addresses to recreate in minimal mode
+            target(list): Resource addresses to limit minimal mode to
         """
+        if not mode in DEPLOY_MODES:
+            raise ValueError("Unknown mode {}; expected one of {}.".format(mode, DEPLOY_MODES))
         self.root = root
         self.state_file = state_file
         self.var_files = var_files
+        self.name = name if name else root
+        self.depends_on = depends_on if depends_on else []
+        self.network = network
+        self.mode = mode
+        self.replace = replace if replace else []
+        self.target = target if target else []
+        self.plan_file = os.path.splitext(state_file)[0] + '.tfplan'
+        # Extra environment variables for Terraform commands
+        self.env = {}
+        # OutputWriter for prefixed console output, logs and events
+        self.output = None
+        # Last lines of output and resource counts of the latest command
+        self.output_tail = deque(maxlen=50)
+        self.resources = {}
+        # Resource counts of the latest saved plan
+        self.planned = {}
+        # Timeout of the latest saved plan, reused to plan again before an apply retry
+        self.plan_timeout = 60
+        # ParallelismBudget choosing -parallelism; None leaves Terraform's default
+        self.parallelism = None
 
-    def _launch(self, tf_commands, dry_run, timeout=3600):
+    def _launch(self, tf_commands, dry_run, timeout=3600, use_var_files=True,
+                use_state=True, plan_file=None, ok_returncodes=(0,), tries=3, before_retry=None):
         """ Launch Terraform deployment process.
 
+        Timeouts and transient failures (see is_transient_error) are
+        retried with exponential backoff; other failures raise at once.
+
         args:
             tf_command (str): Terraform command to run
             dry_run (bool): If true will just print command
             timeout (int): Command timeout in seconds
+            use_var_files (bool): Pass -var-file options; not allowed with a saved plan
+            use_state (bool): Pass the -state option
+            plan_file (str): Saved plan to apply, passed as the last argument
+            ok_returncodes (tuple): Exit codes that are not errors
+            tries (int): Attempts for transient failures
+            before_retry (callable): Run before each retry
+
+        returns:
+            Terraform exit code; 0 for a dry run
+        """
+        arguments = self.command(tf_commands, use_var_files, use_state, plan_file)
+
+        if dry_run:
+            self.log("Command: {} cwd= {}".format(arguments, self.root))
+            return 0
+
+        phase = tf_commands[0]
+        want = None
+        if self.parallelism is not None and phase in ['plan', 'apply', 'destroy']:
+            want = self.parallelism.want(self.resource_demand(phase), self.name, phase)
+
+        def run():
+            command = arguments
+            with self.parallelism.share(want) if want else nullcontext() as parallelism:
+                if parallelism:
+                    command = self.command(
+                                           tf_commands + ['-parallelism={}'.format(parallelism)],
+                                           use_var_files,
+                                           use_state,
+                                           plan_file)
+                # Logged once the -parallelism share is known
+                self.log("Command: {} cwd= {}".format(command, self.root))
+                returncode = self._run_command(command, phase, timeout)
+            if not returncode in ok_returncodes:
+                raise subprocess.CalledProcessError(returncode, command, output = "\n".join(self.output_tail))
+            return returncode
+
+        with metrics.span('phase', phase, set = self.name) as span:
+            returncode = retry_transient(run, tries = tries, log = self.log, before_retry = before_retry)
+            span['resources'] = sum(self.resources.values())
+            return returncode
+
+    def resource_demand(self, phase):
+        """ Resource operations a command is expected to do.
+
+        apply does what the saved plan counted; plan refreshes and
+        destroy deletes every resource instance in the state.
+
+        returns:
+            count, or 0 if unknown
+        """
+        if phase == 'apply':
+            return sum(self.planned.values())
+        try:
+            with open(os.path.join(self.root, self.state_file)) as fh:
+                state = json.load(fh)
+        except (OSError, ValueError):
+            return 0
+        return sum(len(resource.get('instances', [])) for resource in state.get('resources', []))
+
+    def command(self, tf_commands, use_var_files=True, use_state=True, plan_file=None):
+        """ Terraform command line for tf_commands; see _launch.
+
+        returns:
+            list of arguments
         """
         arguments = ['terraform']
         for option in tf_commands:
             arguments.append(option)
-        for var_file in self.var_files:
-            arguments.append("-var-file={}".format(var_file))
-        arguments.append("-state={}".format(self.state_file))
+        if use_var_files:
+            for var_file in self.var_files:
+                arguments.append("-var-file={}".format(var_file))
+        if use_state:
+            arguments.append("-state={}".format(self.state_file))
+        if plan_file:
+            arguments.append(plan_file)
+        return arguments
 
-        print("Command: ", arguments, "cwd=", self.root)
-        if dry_run:
-            sys.exit(0)
+    def log(self, message):
+        """ Print a message prefixed with the deployment name.
+        """
+        if self.output is not None:
+            self.output.write(self.name, message)
+        else:
+            print("[{}] {}".format(self.name, message))
 
-        deploy_complete = False
-        tries = 3
-        while deploy_complete == False and tries > 0:
-            try:
-                subprocess.run(
-                               arguments,
-                               cwd = self.root,
-                               timeout = timeout,
-                               check = True)
-            except subprocess.TimeoutExpired as err:
-                tries -= 1
-                print("WARNING: deployment operations failed to complete ",
-                      "within timeout period. ")
-                print("Command: ", err.cmd)
-                print("Timeout: ", err.timeout)
-                print("Tries remaining: ", tries)
-            deploy_complete = True
+    def _run_command(self, arguments, phase, timeout):
+        """ Run a Terraform command, streaming its output line by line.
+
+        A reader thread drains the child's combined stdout/stderr and
+        hands each line to the OutputWriter queue, so heavy output never
+        blocks the child on a full pipe or a slow console.
+
+        returns:
+            exit code
+        """
+        self.output_tail.clear()
+        self.resources = {}
+        if self.output is not None:
+            self.output.event(self.name, 'phase_start', phase = phase, command = arguments)
+        start = monotonic()
+
+        process = subprocess.Popen(
+                                   arguments,
+                                   cwd = self.root,
+                                   env = dict(os.environ, **self.env),
+                                   stdout = subprocess.PIPE,
+                                   stderr = subprocess.STDOUT)
+        reader = threading.Thread(target = self._read_output, args = (process.stdout,))
+        reader.daemon = True
+        reader.start()
+        try:
+            returncode = process.wait(timeout = timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            reader.join()
+            if self.output is not None:
+                self.output.event(
+                                  self.name,
+                                  'phase_end',
+                                  phase = phase,
+                                  exit_code = process.returncode,
+                                  duration = round(monotonic() - start, 3),
+                                  resources = self.resources)
+        return returncode
+
+    def _read_output(self, pipe):
+        for raw_line in iter(pipe.readline, b''):
+            line = raw_line.decode('utf-8', errors = 'replace').rstrip('\r\n')
+            self.output_tail.append(line)
+            self.resources.update(parse_resource_counts(line))
+            self.log(line)
+        pipe.close()
+
+    def init(self, dry_run, timeout):
+        """ Call Terraform with 'init' command.
+        """
+        self._launch(
+                     tf_commands = ['init', '-input=false'],
+                     dry_run = dry_run,
+                     timeout = timeout,
+                     use_var_files = False,
+                     use_state = False)
 
     def destroy(self, dry_run, timeout):
         """ Call Terraform with 'destroy' command.
         """
         self._launch(
-                    tf_commands = ['destroy', '-force'],
+                    tf_commands = ['destroy', '-auto-approve'],
                     dry_run = dry_run,
                     timeout = timeout)
 
-    def plan(self, dry_run, timeout):
+    def plan(self, dry_run, timeout, plan_file=None):
         """ Call Terraform with 'plan' command.
+
+        With plan_file the plan is saved for apply and the command runs
+        with -detailed-exitcode and, in minimal mode, the -replace and
+        -target options.
+
+        returns:
+            False if Terraform reported no changes, otherwise True
         """
-        self._launch(
-                     tf_commands = ['plan'],
-                     dry_run = dry_run,
-                     timeout = timeout)
+        if plan_file is None:
+            self._launch(
+                         tf_commands = ['plan'],
+                         dry_run = dry_run,
+                         timeout = timeout)
+            return True
+
+        self.plan_timeout = timeout
+        returncode = self._launch(
+                                  tf_commands = [
+                                                 'plan',
+                                                 '-detailed-exitcode',
+                                                 '-out={}'.format(plan_file)] + self.plan_options(),
+                                  dry_run = dry_run,
+                                  timeout = timeout,
+                                  ok_returncodes = (0, 2))
+        self.planned = dict(self.resources)
+        return returncode != 0
 
-    def apply(self, dry_run, timeout):
+    def apply(self, dry_run, timeout, plan_file=None):
         """ Call Terraform with 'apply' command.
+
+        With plan_file the saved plan is applied as-is and then removed,
+        since Terraform will not apply a saved plan twice. A failed apply
+        leaves the plan stale, so it is planned again before a retry,
+        with the timeout the saved plan was made with.
         """
+        if plan_file is None:
+            self._launch(
+                         tf_commands = ['apply', '-auto-approve'],
+                         dry_run = dry_run,
+                         timeout = timeout)
+            return
+
         self._launch(
                      tf_commands = ['apply'],
                      dry_run = dry_run,
-                     timeout = timeout)
+                     timeout = timeout,
+                     use_var_files = False,
+                     plan_file = plan_file,
+                     before_retry = lambda: self.plan(dry_run, self.plan_timeout, plan_file))
+        self.remove_plan(plan_file)
+
+    def plan_options(self):
+        """ -replace and -target options for a minimal mode plan.
+        """
+        if self.mode != 'minimal':
+            return []
+        options = ["-replace={}".format(address) for address in self.replace]
+        options += ["-target={}".format(address) for address in self.target]
+        return options
+
+    def steps(self):
+        """ What run_deployment would do, assuming the plan has changes.
+
+        returns:
+            list of step dicts with the phase, kind ("terraform"), name
+            and command line of each Terraform command
+        """
+        def terraform(phase, tf_commands, **options):
+            return {
+                    'phase': phase,
+                    'kind': 'terraform',
+                    'name': tf_commands[0],
+                    'command': self.command(tf_commands, **options)}
+
+        plan = terraform(
+                         'plan',
+                         ['plan', '-detailed-exitcode', '-out={}'.format(self.plan_file)] + self.plan_options())
+        steps = [plan]
+        if self.mode == 'full':
+            steps.append(terraform('destroy', ['destroy', '-auto-approve']))
+            steps.append(dict(plan, phase = 'apply'))
+        steps.append(terraform('apply', ['apply'], use_var_files = False, plan_file = self.plan_file))
+        return steps
+
+    def fingerprint(self, version=None):
+        """ Hash everything that decides what this deployment would do.
+
+        Covers the .tf files under root, the var-files contents, the
+        Terraform version, the state file's lineage and serial, and the
+        mode with its replace and target lists.
+
+        args:
+            version (str): Terraform version to hash instead of running
+                           "terraform version"
+
+        returns:
+            hex digest string
+        """
+        digest = hashlib.sha256()
+        tf_files = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = sorted(name for name in dirnames if not name.startswith('.'))
+            for filename in sorted(filenames):
+                if filename.endswith('.tf'):
+                    tf_files.append(os.path.join(dirpath, filename))
+        for path in tf_files + [os.path.join(self.root, var_file) for var_file in self.var_files]:
+            digest.update(os.path.relpath(path, self.root).encode('utf-8'))
+            with open(path, 'rb') as fh:
+                digest.update(hashlib.sha256(fh.read()).digest())
+
+        if version is None:
+            version = terraform_version()
+        digest.update(version.encode('utf-8'))
+        digest.update(self.state_serial().encode('utf-8'))
+        digest.update(json.dumps([self.mode] + self.plan_options()).encode('utf-8'))
+        return digest.hexdigest()
+
+    def state_serial(self):
+        """ Lineage and serial of the state file, or empty if there is none.
+        """
+        try:
+            with open(os.path.join(self.root, self.state_file)) as fh:
+                state = json.load(fh)
+        except (OSError, ValueError):
+            return ''
+        return "{}:{}".format(state.get('lineage', ''), state.get('serial', ''))
+
+    def remove_plan(self, plan_file):
+        """ Delete a saved plan file if it exists.
+        """
+        path = os.path.join(self.root, plan_file)
+        if os.path.exists(path):
+            os.remove(path)
 
     def full_run(self, dry_run):
         """ Run full deployment pipeline.
@@ -100,25 +849,158 @@ class BaseDeployment:
         self.apply(dry_run)
 
 
+class TfvarsCache:
+
+    def __init__(self, path=None):
+        """ Parse each tfvars file once and share the results.
+
+        Files are keyed by path, mtime and size, so an edited file is
+        parsed again. Merged variables are computed once per unique
+        list of var files.
+
+        args:
+            path (str): Optional JSON file to persist parsed files between runs
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._files = {}
+        self._merged = {}
+        if path:
+            try:
+                with open(path) as fh:
+                    for entry in json.load(fh):
+                        self._files[tuple(entry['key'])] = entry['vars']
+            except (OSError, ValueError, KeyError, TypeError):
+                self._files = {}
+
+    @staticmethod
+    def _key(var_file):
+        path = os.path.abspath(var_file)
+        stat = os.stat(path)
+        return (path, stat.st_mtime_ns, stat.st_size)
+
+    def load(self, var_file):
+        """ Parsed contents of a single tfvars file.
+        """
+        key = self._key(var_file)
+        with self._lock:
+            if not key in self._files:
+                import hcl
+                with open(var_file, 'r') as fh:
+                    self._files[key] = hcl.load(fh)
+            return self._files[key]
+
+    def merged(self, var_files):
+        """ Variables from var_files, later files overriding earlier ones.
+
+        The returned dictionary is shared; do not modify it.
+        """
+        keys = tuple(self._key(var_file) for var_file in var_files)
+        with self._lock:
+            if keys in self._merged:
+                return self._merged[keys]
+        merged = {}
+        for var_file in var_files:
+            merged.update(self.load(var_file))
+        with self._lock:
+            return self._merged.setdefault(keys, merged)
+
+    def save(self):
+        """ Write parsed files that still exist unchanged to path.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            entries = []
+            for key, variables in self._files.items():
+                try:
+                    current = self._key(key[0])
+                except OSError:
+                    continue
+                if current == key:
+                    entries.append({'key': list(key), 'vars': variables})
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as fh:
+            json.dump(entries, fh)
+        os.replace(temp_path, self.path)
+
+
+IMAGE_SOURCES = ('stopped', 'snapshot', 'live')
+
 class BalancerDeployment(BaseDeployment):
 
-    def __init__(self, compute, root, state_file, var_files):
-        super().__init__(root, state_file, var_files)
-        
+    def __init__(self, compute, root, state_file, var_files, rollout='recreate',
+                 max_surge=1, max_unavailable=0, tfvars=None, image_family=None,
+                 image_retention=3, image_source='stopped', flush_command=None,
+                 guest_flush=False, stable_timeout=1200, stable_interval=10, refresh=False, **kwargs):
+        """ Terraform deployment whose instance image is loaded into an instance group.
+
+            compute(ComputeOperator): Google compute API operator
+            tfvars(TfvarsCache): Parsed tfvars shared between deployments
+            rollout(str): "recreate" deletes every group instance at once,
+                          "rolling" replaces them in surge-based batches
+            max_surge(int): Extra instances created above the group size per batch
+            max_unavailable(int): Instances allowed below the group size per batch
+            image_family(str): Bake uniquely named images into this family
+                               instead of replacing template_image
+            image_retention(int): Newest family images kept by garbage collection
+            image_source(str): "stopped" stops the source instance before
+                               imaging its disk, "snapshot" images a disk
+                               snapshot and "live" force-creates the image
+                               from the running disk after flush_command
+            flush_command(str or list): Flushes the source's filesystems
+                                        before a live image, e.g. over ssh
+            guest_flush(bool): Ask the guest agent for an application
+                               consistent snapshot
+            stable_timeout(int): Seconds to wait for recreated instances
+                                 to be RUNNING and healthy
+            stable_interval(int): Seconds between polls of the group
+            refresh(bool): Bake the image and replace the group's
+                           instances after apply; off by default since
+                           it stops the source and deletes instances
+        """
+        super().__init__(root, state_file, var_files, **kwargs)
+
+        if image_family and image_retention < 2:
+            raise ValueError("image-retention must keep at least 2 images to allow rollback.")
+        if not image_source in IMAGE_SOURCES:
+            raise ValueError("Unknown image-source {}; expected one of {}.".format(image_source, IMAGE_SOURCES))
+        self.image_family = image_family
+        self.image_retention = image_retention
+        self.image_source = image_source
+        self.flush_command = flush_command
+        self.guest_flush = guest_flush
+        # Background cleanup (image garbage collection, snapshot deletion)
+        self.cleanup = []
+
+        if not rollout in ['recreate', 'rolling']:
+            raise ValueError("Unknown rollout {}; use recreate or rolling.".format(rollout))
+        if rollout == 'rolling' and max_surge + max_unavailable < 1:
+            raise ValueError("Rolling rollout needs max-surge or max-unavailable above 0.")
+        self.rollout = rollout
+        self.max_surge = max_surge
+        self.max_unavailable = max_unavailable
+        self.stable_timeout = stable_timeout
+        self.stable_interval = stable_interval
+        self.refresh = refresh
+
         self.compute = compute
-        self.vars = {}
 
         # Read data from tfvars files into dictionary
-        for var_file in self.var_files:
-            with open(var_file, 'r') as fh:
-                new_vars = hcl.load(fh)
-                self.vars.update(new_vars)
+        if tfvars is None:
+            tfvars = TfvarsCache()
+        self.vars = tfvars.merged(self.var_files)
 
         self.project = self.vars['project']
         self.zone = self.vars['zone']
         self.instance_name = self.vars['instance_name']
         self.image_name = self.vars['template_image']
         self.instance_group = self.vars['instance_group']
+        if not self.network:
+            self.network = self.project
 
         self.source_disk = "zones/{}/disks/{}".format(
                                                       self.zone,
@@ -140,50 +1022,502 @@ class BalancerDeployment(BaseDeployment):
         """
         #pdb.set_trace()
         if dry_run:
-            sys.exit(0)
+            for step in self.balancer_steps():
+                self.log("Call: {}({})".format(step['name'], step.get('args', step.get('command'))))
+            return
         #compute = ComputeOperator(self.project, self.zone)
 
-        compute.stop_instance(
-                              name = self.instance_name,
-                              project = self.project,
-                              zone = self.zone)
-        compute.delete_image(
-                             image_name = self.image_name,
-                             project = self.project)
+        with metrics.span('phase', 'load-balancer', set = self.name):
+            self._load_to_balancer(compute)
+
+    def steps(self):
+        """ Terraform steps, then those of load_to_balancer if refresh is set.
+        """
+        steps = super().steps()
+        if self.refresh:
+            steps += self.balancer_steps()
+        return steps
+
+    def balancer_steps(self):
+        """ ComputeOperator calls of load_to_balancer.
+
+        Compute steps have kind "compute" and the call's arguments;
+        background steps (garbage collection) do not hold up the set.
+        A rolling rollout repeats its batch steps for every batch.
+        """
+        steps = []
+
+        def call(method, background=False, **args):
+            # Not "name"; stop_instance takes a name argument
+            steps.append({
+                          'phase': 'load-balancer',
+                          'kind': 'compute',
+                          'name': method,
+                          'args': args,
+                          'background': background})
+
+        zonal = {'project': self.project, 'zone': self.zone}
+        if self.image_source == 'snapshot':
+            call('create_snapshot', disk_name = self.instance_name, guest_flush = self.guest_flush, **zonal)
+        elif self.image_source == 'live':
+            arguments = self.flush_command
+            if isinstance(arguments, str):
+                arguments = ['sh', '-c', arguments]
+            if arguments:
+                steps.append({
+                              'phase': 'load-balancer',
+                              'kind': 'command',
+                              'name': 'flush',
+                              'command': arguments})
+        else:
+            call('stop_instance', name = self.instance_name, **zonal)
+        if self.image_family:
+            call('create_image', family = self.image_family, source_disk = self.source_disk, project = self.project)
+        else:
+            call('delete_image', image_name = self.image_name, project = self.project)
+            call('create_image', image_name = self.image_name, source_disk = self.source_disk, project = self.project)
+        if self.image_source == 'snapshot':
+            call('delete_snapshot', True, project = self.project)
+        if self.image_family:
+            call('collect_family_images', True, family = self.image_family, keep = self.image_retention)
+
+        group = dict(zonal, group_name = self.instance_group)
+        if self.rollout == 'rolling':
+            call('get_group_manager', **group)
+            call('list_managed_instances', **group)
+            if self.max_surge:
+                call('resize_group', **group)
+                call('wait_for_group_stable', **group)
+            call('delete_group_instances', **group)
+            call('resize_group', **group)
+            call('wait_for_group_stable', **group)
+        else:
+            call('get_group_manager', **group)
+            call('iter_managed_instances', **group)
+            call('delete_instances', **zonal)
+            call('wait_for_group_stable', **group)
+        return steps
+
+    def _load_to_balancer(self, compute):
+        self.bake_image(compute)
+        if self.image_family:
+            self._background(
+                             collect_family_images,
+                             compute,
+                             self.image_family,
+                             self.project,
+                             self.image_retention)
+        self.refresh_group(compute)
+
+    def _background(self, function, *args):
+        # Only unfinished cleanup is kept; a daemon runs sets indefinitely
+        self.cleanup = [future for future in self.cleanup if not future.done()]
+        self.cleanup.append(background.submit(function, *args))
+
+    def bake_image(self, compute):
+        """ Create the group's image from the source instance's boot disk.
+
+        With image_source "stopped" the source instance is stopped
+        first and stays down. "snapshot" and "live" leave it running.
+
+        returns:
+            name of the new image
+        """
+        options = {}
+        snapshot_name = None
+        if self.image_source == 'snapshot':
+            snapshot_name = unique_name(self.instance_name)
+            compute.create_snapshot(
+                                    disk_name = self.instance_name,
+                                    snapshot_name = snapshot_name,
+                                    project = self.project,
+                                    zone = self.zone,
+                                    guest_flush = self.guest_flush)
+            options['source_snapshot'] = 'global/snapshots/{}'.format(snapshot_name)
+        elif self.image_source == 'live':
+            self.flush_source()
+            options['force'] = True
+        else:
+            compute.stop_instance(
+                                  name = self.instance_name,
+                                  project = self.project,
+                                  zone = self.zone)
+
+        if self.image_family:
+            image_name = unique_name(self.image_family)
+            options['family'] = self.image_family
+        else:
+            image_name = self.image_name
+            compute.delete_image(
+                                 image_name = image_name,
+                                 project = self.project)
         compute.create_image(
-                             image_name = self.image_name,
+                             image_name = image_name,
                              source_disk = self.source_disk,
-                             project = self.project)
-        group_instances = compute.list_group_instances(
-                                                       group_name = self.instance_group,
-                                                       project = self.project,
-                                                       zone = self.zone)
-        for instance_dict in group_instances:
-            instance = instance_dict['instance']
-            instance_name = instance.split('/')[-1]
-            compute.delete_instance(
-                                    name = instance_name,
-                                    project = self.project,
-                                    zone = self.zone)
+                             project = self.project,
+                             **options)
+        if snapshot_name:
+            self._background(collect_snapshot, compute, snapshot_name, self.project)
+        return image_name
+
+    def flush_source(self, timeout=300):
+        """ Run flush_command so a live image has consistent filesystems.
+        """
+        if not self.flush_command:
+            self.log("WARNING: no flush-command; the live image is only crash-consistent.")
+            return
+        arguments = self.flush_command
+        if isinstance(arguments, str):
+            arguments = ['sh', '-c', arguments]
+        self.log("Flushing source instance: {}".format(arguments))
+        with metrics.span('phase', 'flush', set = self.name):
+            returncode = self._run_command(arguments, 'flush', timeout)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, arguments, output = "\n".join(self.output_tail))
+
+    def rollback_image(self, compute):
+        """ Point the image family back at the previous image and refresh the group.
+
+        The newest image is deprecated with the previous one as its
+        replacement, so new instances immediately boot the previous
+        image; it can be un-deprecated or superseded by the next bake.
+        """
+        if not self.image_family:
+            raise ValueError("Set {} has no image-family to roll back.".format(self.name))
+        images = [
+                  image for image in compute.list_family_images(self.image_family, self.project)
+                  if not 'deprecated' in image]
+        if len(images) < 2:
+            raise ValueError("No earlier image in family {} to roll back to.".format(self.image_family))
+        current, previous = images[-1], images[-2]
+        self.log("Rolling back image family {} from {} to {}.".format(
+                                                                        self.image_family,
+                                                                        current['name'],
+                                                                        previous['name']))
+        compute.deprecate_image(
+                                image_name = current['name'],
+                                project = self.project,
+                                state = 'DEPRECATED',
+                                replacement = previous['selfLink'])
+        with metrics.span('phase', 'rollback', set = self.name):
+            self.refresh_group(compute)
+
+    def refresh_group(self, compute):
+        """ Replace the instance group's instances so they boot the new image.
+
+        A recreate rollout deletes every instance and waits until the
+        group is back at its target size with RUNNING, healthy
+        replacements (see ComputeOperator.wait_for_group_stable).
+
+        returns:
+            the ready managed instances after a recreate rollout
+        """
+        if self.rollout == 'rolling':
+            self.rolling_replace(compute)
+            return
+
+        manager = compute.get_group_manager(
+                                            group_name = self.instance_group,
+                                            project = self.project,
+                                            zone = self.zone)
+        managed_instances = compute.iter_managed_instances(
+                                                           group_name = self.instance_group,
+                                                           project = self.project,
+                                                           zone = self.zone,
+                                                           page_size = 500,
+                                                           fields = MANAGED_INSTANCE_FIELDS)
+        old_ids = []
+
+        def instance_names():
+            # One listing gives names and ids; deletes start while
+            # later pages are still being listed
+            for instance in managed_instances:
+                if not instance.get('instance'):
+                    continue
+                old_ids.append(instance.get('id'))
+                yield instance['instance'].split('/')[-1]
+        compute.delete_instances(
+                                 names = instance_names(),
+                                 project = self.project,
+                                 zone = self.zone)
+        # The group recreates the deleted instances under the same names
+        return compute.wait_for_group_stable(
+                                             group_name = self.instance_group,
+                                             project = self.project,
+                                             zone = self.zone,
+                                             target_size = manager['targetSize'],
+                                             timeout = self.stable_timeout,
+                                             interval = self.stable_interval,
+                                             exclude_ids = [instance_id for instance_id in old_ids if instance_id])
+
+    def rolling_replace(self, compute):
+        """ Replace every instance in the managed instance group in batches.
+
+        Each batch of up to max_surge + max_unavailable old instances
+        first grows the group by max_surge, or by the batch size if the
+        batch is smaller, waits for the new instances, deletes the
+        batch and resizes back, then waits for the group to be
+        stable and healthy before starting the next batch. Serving
+        capacity never drops below group size - max_unavailable.
+
+        Every wait polls each stable_interval for up to stable_timeout
+        seconds and excludes the ids of the instances deleted so far,
+        so a group that still lists them, before their replacements
+        appear, is not taken as stable.
+
+        args:
+            compute (ComputeOperator): Google compute API operator
+        """
+        manager = compute.get_group_manager(
+                                            group_name = self.instance_group,
+                                            project = self.project,
+                                            zone = self.zone)
+        target_size = manager['targetSize']
+        ids = {
+               instance['instance']: instance.get('id') for instance in compute.list_managed_instances(
+                                                                                                        group_name = self.instance_group,
+                                                                                                        project = self.project,
+                                                                                                        zone = self.zone)}
+        old_instances = list(ids)
+        replaced_ids = []
+        batch_size = self.max_surge + self.max_unavailable
+        print("Rolling replace of {} instances in {}; surge {}, unavailable {}.".format(
+                                                                                        len(old_instances),
+                                                                                        self.instance_group,
+                                                                                        self.max_surge,
+                                                                                        self.max_unavailable))
+        while old_instances:
+            batch = old_instances[:batch_size]
+            old_instances = old_instances[batch_size:]
+            # A short last batch needs no more new instances than it replaces
+            surge = min(self.max_surge, len(batch))
+            if surge:
+                compute.resize_group(
+                                     group_name = self.instance_group,
+                                     size = target_size + surge,
+                                     project = self.project,
+                                     zone = self.zone)
+                compute.wait_for_group_stable(
+                                              group_name = self.instance_group,
+                                              project = self.project,
+                                              zone = self.zone,
+                                              target_size = target_size + surge,
+                                              timeout = self.stable_timeout,
+                                              interval = self.stable_interval,
+                                              exclude_ids = replaced_ids)
+
+            # deleteInstances also lowers the target size by len(batch)
+            compute.delete_group_instances(
+                                           group_name = self.instance_group,
+                                           instances = batch,
+                                           project = self.project,
+                                           zone = self.zone)
+            replaced_ids += [ids[instance] for instance in batch if ids[instance]]
+            compute.resize_group(
+                                 group_name = self.instance_group,
+                                 size = target_size,
+                                 project = self.project,
+                                 zone = self.zone)
+            compute.wait_for_group_stable(
+                                          group_name = self.instance_group,
+                                          project = self.project,
+                                          zone = self.zone,
+                                          target_size = target_size,
+                                          timeout = self.stable_timeout,
+                                          interval = self.stable_interval,
+                                          exclude_ids = replaced_ids)
+
+
+# Runs image garbage collection behind the rollout; main() waits for it
+background = ThreadPoolExecutor(max_workers = 2, thread_name_prefix = 'sprout-background')
+
+def unique_name(prefix):
+    """ Unique resource name, e.g. gims-20240501-130502-3fa2.
+    """
+    return "{}-{}-{}".format(prefix[:40], strftime('%Y%m%d-%H%M%S', gmtime()), uuid.uuid4().hex[:4])
 
+def collect_family_images(compute, family, project, keep):
+    """ Delete all but the newest keep images sprout baked into a family.
+
+    Only images named family-... are touched, so images added to the
+    family by other tools are left alone. Errors are printed, not
+    raised, since collection runs in the background.
+
+    returns:
+        names of deleted images
+    """
+    try:
+        images = [
+                  image for image in compute.list_family_images(family, project)
+                  if image['name'].startswith(family[:40] + '-')]
+        deleted = []
+        for image in images[:-keep]:
+            compute.delete_image(image_name = image['name'], project = project)
+            deleted.append(image['name'])
+        return deleted
+    except Exception as err:
+        print("WARNING: Image garbage collection for family {} failed: {}".format(family, err))
+        return []
+
+def collect_snapshot(compute, name, project):
+    """ Delete a snapshot an image was baked from, printing any error.
+    """
+    try:
+        compute.delete_snapshot(name, project)
+    except Exception as err:
+        print("WARNING: Deleting snapshot {} failed: {}".format(name, err))
+
+# Partial response for list_group_instances: instance URLs and paging only
+GROUP_INSTANCE_FIELDS = 'items/instance,nextPageToken'
+
+# Partial response for a recreate rollout: instance URLs and ids
+MANAGED_INSTANCE_FIELDS = 'managedInstances(instance,id),nextPageToken'
+
+COMPUTE_ROOT_URL = 'https://compute.googleapis.com/'
 
 class ComputeOperator:
 
-    def __init__(self):
+    def __init__(self, base_url=None, limiter=None, discovery_cache=None):
         """ 
 
+        Credentials and the API client are created on first use, so runs
+        that never call the Compute API need neither.
+
+        args:
+            base_url (str): Root URL of a Compute API stand-in such as
+                            fake_compute.py; requests are sent unauthenticated
+            limiter (RateLimiter): Defaults to the shared rate_limiter
+            discovery_cache (str): Directory with cached discovery
+                                   documents; see discovery_document
+
         Status: Untested.
         """
         
-        self.credentials = GoogleCredentials.get_application_default()
-        self.client = googleapiclient.discovery.build(
-                                                      'compute',
-                                                      'v1',
-                                                      credentials = self.credentials)
-                                       #'compute',
-                                       #'v1',
-                                       #credentials = self.credentials)
+        self.base_url = base_url
+        self.limiter = limiter if limiter is not None else rate_limiter
+        self.discovery_cache = discovery_cache
+        self._lock = threading.Lock()
+        self._client = None
+        self._credentials = None
+        self._credentials_loaded = bool(base_url)
+
+    @property
+    def credentials(self):
+        """ Application default credentials, or None for a stand-in.
+        """
+        if not self._credentials_loaded:
+            with self._lock:
+                if not self._credentials_loaded:
+                    from oauth2client.client import GoogleCredentials
+                    self._credentials = GoogleCredentials.get_application_default()
+                    self._credentials_loaded = True
+        return self._credentials
+
+    @credentials.setter
+    def credentials(self, credentials):
+        self._credentials = credentials
+        self._credentials_loaded = True
+
+    @property
+    def client(self):
+        """ Compute API client, built from the discovery document on first use.
+        """
+        if self._client is None:
+            document = self.discovery_document()
+            import googleapiclient.discovery
+            with self._lock:
+                if self._client is None:
+                    self._client = googleapiclient.discovery.build_from_document(document, http = self._http())
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    def discovery_document(self, max_age=7 * 24 * 3600):
+        """ The Compute v1 discovery document.
+
+        With discovery_cache it is read from
+        <discovery_cache>/compute-v1-<host>.json when that is newer than
+        max_age; otherwise it is downloaded and written there. A stale
+        copy is used if the download fails; without one, the first run
+        needs network access to the discovery service.
+
+        returns:
+            document as a JSON string
+        """
+        import httplib2
+        from googleapiclient.errors import HttpError
+
+        url = (self.base_url or 'https://www.googleapis.com/') + 'discovery/v1/apis/compute/v1/rest'
+        path = None
+        if self.discovery_cache:
+            host = urllib.parse.urlsplit(url).netloc.replace(':', '_')
+            path = os.path.join(self.discovery_cache, 'compute-v1-{}.json'.format(host))
+            if os.path.exists(path) and time() - os.path.getmtime(path) < max_age:
+                with open(path) as fh:
+                    return fh.read()
+        try:
+            count_request()
+            response, content = self._http().request(url)
+            if response.status >= 300:
+                raise HttpError(response, content, uri = url)
+        except (HttpError, OSError, httplib2.HttpLib2Error):
+            if path and os.path.exists(path):
+                print("WARNING: Could not refresh {}; using the cached copy.".format(url))
+                with open(path) as fh:
+                    return fh.read()
+            raise
+        document = content.decode('utf-8')
+        if path:
+            _write_atomic(path, document)
+        return document
+
+    def _http(self):
+        """ This thread's HTTP connection; httplib2.Http is not thread-safe.
+        """
+        local = self.__dict__.setdefault('_local', threading.local())
+        http = getattr(local, 'http', None)
+        if http is None:
+            import httplib2
+            http = httplib2.Http()
+            if self.credentials is not None:
+                http = self.credentials.authorize(http)
+            local.http = http
+        return http
+
+    def _execute(self, request, tries=5):
+        """ Execute an API request or batch request.
 
+        Requests first wait for the rate limiter, and 429 or 403
+        rateLimitExceeded responses back off the request's buckets and
+        are retried. Idempotent requests, GETs and calls carrying a
+        requestId (which the API runs at most once), are also retried
+        with backoff on other transient errors such as 5xx responses.
+        Batch requests are limited by their caller.
+        """
+        limiter = getattr(self, 'limiter', rate_limiter)
+        uri = getattr(request, 'uri', None)
+        keys = limiter.keys(uri) if isinstance(uri, str) else []
+        idempotent = isinstance(uri, str) and (getattr(request, 'method', None) == 'GET' or 'requestId=' in uri)
+        for attempt in range(tries):
+            limiter.acquire(keys)
+            count_request()
+            try:
+                return request.execute(http = self._http())
+            except Exception as err:
+                if attempt == tries - 1:
+                    raise
+                if is_rate_limited(err):
+                    delay = limiter.rate_limited(keys, attempt)
+                    if not keys:
+                        idle(delay)
+                elif idempotent and is_transient_error(err):
+                    idle(backoff_delay(attempt, base = 1, cap = 30))
+                else:
+                    raise
+
+    @timed_call
     def stop_instance(self, name, project, zone):
         """ Stop a running GCP instance.
 
@@ -195,18 +1529,17 @@ class ComputeOperator:
                                                 zone = zone,
                                                 instance = name,
                                                 requestId = request_id)
-        response = request.execute()
-        wait_for_status(
-                        request, 
-                        response, 
-                        status = 'DONE', 
-                        interval = 10)
+        response = self._execute(request)
+        wait_for_status(self, response)
 
+    @timed_call
     def delete_instance(self, name, project, zone):
         """ Delete a GCP compute instance.
 
         Status: Untested.
         """
+        from googleapiclient.errors import HttpError
+
         print("Deleting instance: {}".format(name))
         request_id = str(uuid.uuid4())
         request = self.client.instances().delete(
@@ -215,12 +1548,8 @@ class ComputeOperator:
                                                   instance = name,
                                                   requestId = request_id)
         try:
-            response = request.execute()
-            wait_for_status(
-                            request,
-                            response,
-                            status = 'DONE',
-                            interval = 10)
+            response = self._execute(request)
+            wait_for_status(self, response)
         except HttpError as err:
             if err.resp.status in [404]:
                 pprint("INFO: Skipping delete; instance does not exist.")
@@ -228,30 +1557,286 @@ class ComputeOperator:
             else:
                 raise
 
-    def list_group_instances(self, group_name, project, zone):
-        """Get a list of instances running in instance group
+    @timed_call
+    def delete_instances(self, names, project, zone, batch_size=50):
+        """ Delete several GCP compute instances at once.
+
+        Delete requests are sent as Compute API batch requests of up to
+        batch_size calls, then all resulting operations are awaited
+        together so the total time is that of the slowest delete. If
+        some deletes fail, the ones that started are still awaited
+        before one error naming the failed instances is raised.
+
+        args:
+            names (iterable): Instance names; a generator is consumed as
+                              it goes, so a batch is sent as soon as it
+                              is full, e.g. while list_group_instances
+                              is still fetching pages
+            batch_size (int): Maximum calls per batch request (API limit is 1000)
+
+        Status: Untested.
+        """
+        operations = []
+        limited = []
+        failed = []
+
+        def collect(name, response, exception):
+            if exception is None:
+                operations.append(response)
+            elif is_http_error(exception) and exception.resp.status in [404]:
+                pprint("INFO: Skipping delete; instance {} does not exist.".format(name))
+            elif is_rate_limited(exception):
+                limited.append((name, exception))
+            else:
+                failed.append((name, exception))
+
+        # Every call in a batch counts against the rate limits
+        limiter = getattr(self, 'limiter', rate_limiter)
+        keys = limiter.keys('/projects/{}/zones/{}/'.format(project, zone))
+
+        def send(chunk):
+            limiter.acquire(keys, len(chunk))
+            batch = self.client.new_batch_http_request(callback = collect)
+            for name in chunk:
+                print("Deleting instance: {}".format(name))
+                request_id = str(uuid.uuid4())
+                request = self.client.instances().delete(
+                                                          project = project,
+                                                          zone = zone,
+                                                          instance = name,
+                                                          requestId = request_id)
+                batch.add(request, request_id = name)
+            self._execute(batch)
+
+        def send_all(names):
+            chunk = []
+            for name in names:
+                chunk.append(name)
+                if len(chunk) == batch_size:
+                    send(chunk)
+                    chunk = []
+            if chunk:
+                send(chunk)
+
+        send_all(names)
+        attempt = 0
+        while limited:
+            if attempt == 4:
+                failed.extend(limited)
+                break
+            pending = [name for name, exception in limited]
+            del limited[:]
+            limiter.rate_limited(keys, attempt)
+            attempt += 1
+            send_all(pending)
+
+        try:
+            wait_for_status(self, operations)
+        except RuntimeError as err:
+            # Deletes that failed as operations join the failed calls
+            if not failed:
+                raise
+            failed.append(('operations', err))
+        if failed:
+            reasons = ["{} ({})".format(name, str(exception).splitlines()[0] if str(exception) else type(exception).__name__)
+                       for name, exception in failed]
+            raise RuntimeError("Failed to delete {} instances: {}".format(len(failed), "; ".join(reasons))) from failed[0][1]
+
+    def list_group_instances(self, group_name, project, zone, page_size=500, fields=GROUP_INSTANCE_FIELDS):
+        """Get the instances running in instance group
+
+        A generator: each page is fetched when the previous one has
+        been consumed, so callers can act on the first instances while
+        a large group is still being listed. Only the fields in the
+        fields mask are returned. Every page is timed as a
+        list_group_instances call.
 
         args:
             group_name (str): Name of instance group
+            page_size (int): Instances per page (API maximum is 500)
+            fields (str): Partial response mask; None for full payloads
 
-        returns:
-            list of dicts with instance metadata
+        yields:
+            dicts with instance metadata (by default just "instance", the URL)
         """
 
         #gcloud compute instance-groups managed list-instances gimscluster1 --project=cgstesting-0717
         #request_id = str(uuid.uuid4())
         request_body = {"instanceState": "RUNNING"}
-        request = self.client.instanceGroups().listInstances(
+        options = {'fields': fields} if fields else {}
+        groups = self.client.instanceGroups()
+        request = groups.listInstances(
+                                       project = project,
+                                       zone = zone,
+                                       instanceGroup = group_name,
+                                       body = request_body,
+                                       maxResults = page_size,
+                                       **options)
+        while request is not None:
+            with metrics.span('compute', 'list_group_instances'):
+                response = self._execute(request)
+            # An empty group has no items at all
+            for instance in response.get('items', []):
+                yield instance
+            request = groups.listInstances_next(request, response)
+
+    @timed_call
+    def get_group_manager(self, group_name, project, zone):
+        """ Get a managed instance group resource.
+
+        Status: Untested.
+        """
+        request = self.client.instanceGroupManagers().get(
+                                                          project = project,
+                                                          zone = zone,
+                                                          instanceGroupManager = group_name)
+        return self._execute(request)
+
+    @timed_call
+    def list_managed_instances(self, group_name, project, zone):
+        """ List the instances of a managed instance group with their status.
+
+        returns:
+            list of dicts with instance, id, instanceStatus,
+            currentAction and instanceHealth, from every page
+
+        Status: Untested.
+        """
+        return list(self.iter_managed_instances(group_name, project, zone))
+
+    def iter_managed_instances(self, group_name, project, zone, page_size=None, fields=None):
+        """ Managed instances of a group, fetched one page at a time.
+
+        A generator, like list_group_instances, so callers can act on
+        the first page while a large group is still being listed.
+
+        args:
+            page_size (int): Instances per page (API maximum is 500)
+            fields (str): Partial response mask; None for full payloads
+
+        yields:
+            managed instance dicts
+        """
+        managers = self.client.instanceGroupManagers()
+        options = {}
+        if page_size:
+            options['maxResults'] = page_size
+        if fields:
+            options['fields'] = fields
+        request = managers.listManagedInstances(
                                                 project = project,
                                                 zone = zone,
-                                                instanceGroup = group_name,
-                                                body = request_body)
-        response = request.execute()
-        return response['items']
+                                                instanceGroupManager = group_name,
+                                                **options)
+        while request is not None:
+            response = self._execute(request)
+            for instance in response.get('managedInstances', []):
+                yield instance
+            request = managers.listManagedInstances_next(request, response)
+
+    @timed_call
+    def resize_group(self, group_name, size, project, zone):
+        """ Set the target size of a managed instance group.
 
-    def create_image(self, image_name, source_disk, project, force=False):
+        Status: Untested.
+        """
+        print("Resizing instance group {} to {}.".format(group_name, size))
+        request = self.client.instanceGroupManagers().resize(
+                                                             project = project,
+                                                             zone = zone,
+                                                             instanceGroupManager = group_name,
+                                                             size = size,
+                                                             requestId = str(uuid.uuid4()))
+        response = self._execute(request)
+        wait_for_status(self, response)
+
+    @timed_call
+    def delete_group_instances(self, group_name, instances, project, zone):
+        """ Delete instances from a managed instance group.
+
+        The group's target size is reduced by the number of instances.
+
+        args:
+            instances (list): Instance URLs
+
+        Status: Untested.
+        """
+        print("Deleting {} instances from group {}.".format(len(instances), group_name))
+        request = self.client.instanceGroupManagers().deleteInstances(
+                                                                      project = project,
+                                                                      zone = zone,
+                                                                      instanceGroupManager = group_name,
+                                                                      body = {"instances": instances},
+                                                                      requestId = str(uuid.uuid4()))
+        response = self._execute(request)
+        wait_for_status(self, response)
+
+    @timed_call
+    def wait_for_group_stable(self, group_name, project, zone, target_size, timeout=1200, interval=10,
+                              exclude_ids=None):
+        """ Wait until a managed instance group is stable at target_size.
+
+        Stable means no instance has a pending action and at least
+        target_size instances are RUNNING and, where the group has
+        health checks, HEALTHY. The whole group is read with one
+        listManagedInstances poll per interval, and each poll prints
+        the group's progress.
+
+        args:
+            target_size (int): Instances that must be ready
+            timeout (int): Seconds to wait
+            interval (int): Seconds between polls
+            exclude_ids (list): Ids of instances being replaced; they do
+                                not count as ready and must be gone, so
+                                only replacements on the new image count
+
+        returns:
+            list of the ready managed instances
+
+        Status: Untested.
+        """
+        exclude_ids = set(str(instance_id) for instance_id in exclude_ids or [])
+        start = monotonic()
+        deadline = start + timeout
+        while True:
+            instances = self.list_managed_instances(group_name, project, zone)
+            ready = []
+            old = 0
+            actions = {}
+            for instance in instances:
+                if str(instance.get('id')) in exclude_ids:
+                    old += 1
+                    continue
+                action = instance.get('currentAction', 'NONE')
+                if action != 'NONE':
+                    actions[action] = actions.get(action, 0) + 1
+                healthy = all(
+                              health.get('detailedHealthState') == 'HEALTHY'
+                              for health in instance.get('instanceHealth', []))
+                if instance.get('instanceStatus') == 'RUNNING' and healthy:
+                    ready.append(instance)
+            settled = not actions and not old
+            progress = ["{}/{} instances ready".format(len(ready), target_size)]
+            progress += ["{} {}".format(count, action.lower()) for action, count in sorted(actions.items())]
+            if old:
+                progress.append("{} old".format(old))
+            print("Group {}: {} after {:.0f}s.".format(group_name, ", ".join(progress), monotonic() - start))
+            if settled and len(ready) >= target_size:
+                return ready
+            count_poll()
+            if monotonic() + interval > deadline:
+                raise TimeoutError("Instance group {} did not stabilize within {} seconds.".format(
+                                                                                                 group_name,
+                                                                                                 timeout))
+            idle(interval)
+
+    @timed_call
+    def create_image(self, image_name, source_disk, project, force=False, family=None, source_snapshot=None):
         """ Create a GCP instance image.
 
+        With source_snapshot the image is made from that snapshot
+        instead of source_disk.
+
         Images API methods:
             https://cloud.google.com/compute/docs/reference/latest/images
         Python Compute API example:
@@ -259,11 +1844,20 @@ class ComputeOperator:
 
         Status: Untested
         """
-        pprint("Creating image \"{}\" from source disk \"{}\".".format(image_name, source_disk))
-        config = {                  
-                  "name": image_name,
-                  "sourceDisk": source_disk 
-                 }
+        if source_snapshot:
+            pprint("Creating image \"{}\" from snapshot \"{}\".".format(image_name, source_snapshot))
+            config = {
+                      "name": image_name,
+                      "sourceSnapshot": source_snapshot
+                     }
+        else:
+            pprint("Creating image \"{}\" from source disk \"{}\".".format(image_name, source_disk))
+            config = {                  
+                      "name": image_name,
+                      "sourceDisk": source_disk 
+                     }
+        if family:
+            config['family'] = family
 
         # Throw error if source_disk instance is still running
         ## gcloud api probably throws error anyway
@@ -273,25 +1867,25 @@ class ComputeOperator:
                                           forceCreate = force,
                                           body = config,
                                           requestId = request_id)
-        response = request.execute()
-        wait_for_status(
-                        request, 
-                        response, 
-                        status = 'DONE', 
-                        interval = 10)
+        response = self._execute(request)
+        wait_for_status(self, response)
 
+    @timed_call
     def delete_image(self, image_name, project, timeout=300):
         """ Delete a GCP instance image.
 
         Status: Untested.
         """
+        from googleapiclient.errors import HttpError
+
         pprint("Deleting image: {}".format(image_name))
         request = self.client.images().delete(
                                               project = project,
-                                              image = image_name)
+                                              image = image_name,
+                                              requestId = str(uuid.uuid4()))
         try:
-            response = request.execute()
-            wait_for_status(request, response, 'DONE', timeout)
+            response = self._execute(request)
+            wait_for_status(self, response, timeout = timeout)
         except HttpError as err:
             if err.resp.status in [404]:
                 pprint("INFO: Skipping delete; image does not exist.")
@@ -299,47 +1893,775 @@ class ComputeOperator:
             else:
                 raise
 
-def wait_for_status(request, response, status='DONE', timeout=300, interval=5):
-    """ Wait for Google Cloud API request to complete.
+    @timed_call
+    def create_snapshot(self, disk_name, snapshot_name, project, zone, guest_flush=False):
+        """ Snapshot a persistent disk without stopping its instance.
+
+        Status: Untested.
+        """
+        pprint("Creating snapshot \"{}\" of disk \"{}\".".format(snapshot_name, disk_name))
+        request = self.client.disks().createSnapshot(
+                                                     project = project,
+                                                     zone = zone,
+                                                     disk = disk_name,
+                                                     guestFlush = guest_flush,
+                                                     body = {"name": snapshot_name},
+                                                     requestId = str(uuid.uuid4()))
+        response = self._execute(request)
+        wait_for_status(self, response)
+
+    @timed_call
+    def delete_snapshot(self, snapshot_name, project):
+        """ Delete a disk snapshot.
+
+        Status: Untested.
+        """
+        from googleapiclient.errors import HttpError
+
+        request = self.client.snapshots().delete(
+                                                 project = project,
+                                                 snapshot = snapshot_name,
+                                                 requestId = str(uuid.uuid4()))
+        try:
+            response = self._execute(request)
+            wait_for_status(self, response)
+        except HttpError as err:
+            if err.resp.status in [404]:
+                pprint("INFO: Skipping delete; snapshot does not exist.")
+            else:
+                raise
+
+    @timed_call
+    def list_family_images(self, family, project):
+        """ List the images in an image family, oldest first.
+
+        Status: Untested.
+        """
+        images = []
+        request = self.client.images().list(
+                                            project = project,
+                                            filter = 'family = "{}"'.format(family))
+        while request is not None:
+            response = self._execute(request)
+            images.extend(response.get('items', []))
+            request = self.client.images().list_next(request, response)
+        return sorted(images, key = lambda image: image['creationTimestamp'])
+
+    @timed_call
+    def deprecate_image(self, image_name, project, state='DEPRECATED', replacement=None):
+        """ Set the deprecation status of an image.
+
+        A deprecated image is skipped when its family is resolved; an
+        empty state makes it active again.
+
+        Status: Untested.
+        """
+        body = {'state': state}
+        if replacement:
+            body['replacement'] = replacement
+        request = self.client.images().deprecate(
+                                                 project = project,
+                                                 image = image_name,
+                                                 body = body,
+                                                 requestId = str(uuid.uuid4()))
+        response = self._execute(request)
+        wait_for_status(self, response)
+
+# Compute operations.wait returns after at most ~2 minutes even when the
+# operation is still running.
+OPERATION_WAIT_WINDOW = 120
+
+# Most operations long-polled at once by one wait_for_operations call
+OPERATION_WAIT_THREADS = 32
+
+def _operation_request(client, operation, method):
+    """ Build a get/wait request for a zonal, regional or global operation.
+    """
+    parts = operation['selfLink'].split('/')
+    project = parts[parts.index('projects') + 1]
+    if operation.get('zone'):
+        return getattr(client.zoneOperations(), method)(
+                                                        project = project,
+                                                        zone = operation['zone'].split('/')[-1],
+                                                        operation = operation['name'])
+    elif operation.get('region'):
+        return getattr(client.regionOperations(), method)(
+                                                          project = project,
+                                                          region = operation['region'].split('/')[-1],
+                                                          operation = operation['name'])
+    else:
+        return getattr(client.globalOperations(), method)(
+                                                          project = project,
+                                                          operation = operation['name'])
+
+def _operation_summary(operation):
+    return "{}: {}; {}.".format(
+                                operation['kind'],
+                                operation['operationType'],
+                                operation['status'])
+
+def _operation_failure(operations):
+    """ RuntimeError listing the errors of operations that finished DONE with one.
+    """
+    reasons = [
+               "{} {}: {}".format(
+                                  operation['operationType'],
+                                  operation.get('targetLink', operation['name']).split('/')[-1],
+                                  operation['error'].get('errors'))
+               for operation in operations]
+    return RuntimeError("{} operations failed: {}".format(len(operations), "; ".join(reasons)))
+
+def _long_poll_operations(compute, operations, deadline):
+    """ Long-poll operations with "wait" side by side until they are DONE.
+
+    Every operation has its own wait request in flight, so each one is
+    yielded as soon as it finishes, whatever its place in the list.
+    Each round waits at most min(remaining, OPERATION_WAIT_WINDOW)
+    seconds for one of them to return.
+
+    yields:
+        finished operation resources
+
+    returns:
+        operations that must be polled instead because the API answered
+        "wait" with 400, 404 or 501
+    """
+    from googleapiclient.errors import HttpError
+
+    def wait_one(operation):
+        count_poll()
+        return compute._execute(_operation_request(compute.client, operation, 'wait'))
+
+    def submit(operation):
+        # Polls count against the caller's metrics span
+        return executor.submit(contextvars.copy_context().run, wait_one, operation)
+
+    unavailable = []
+    executor = ThreadPoolExecutor(
+                                  max_workers = min(len(operations), OPERATION_WAIT_THREADS),
+                                  thread_name_prefix = 'sprout-wait')
+    futures = {submit(operation): operation for operation in operations}
+    try:
+        while futures:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                raise TimeoutError("Operation exceeded timeout period. " +
+                                   "; ".join(_operation_summary(op) for op in futures.values()))
+            done, _ = wait(futures, timeout = min(remaining, OPERATION_WAIT_WINDOW), return_when = FIRST_COMPLETED)
+            for future in done:
+                operation = futures.pop(future)
+                try:
+                    operation = future.result()
+                except HttpError as err:
+                    if not err.resp.status in [400, 404, 501]:
+                        raise
+                    pprint("INFO: operations.wait unavailable; polling instead.")
+                    unavailable.append(operation)
+                    continue
+                if operation['status'] == 'DONE':
+                    pprint("Operation complete. " + _operation_summary(operation))
+                    yield operation
+                elif unavailable:
+                    unavailable.append(operation)
+                else:
+                    pprint("Waiting for operation. " + _operation_summary(operation))
+                    futures[submit(operation)] = operation
+    finally:
+        # Waits still in flight return on their own within the window
+        executor.shutdown(wait = False, cancel_futures = True)
+    return unavailable
+
+def wait_for_operations(compute, operations, status='DONE', timeout=300, interval=5):
+    """ Wait for several Google Cloud operations, yielding each as it finishes.
+
+    Waiting for DONE long-polls every operation at once with the
+    zoneOperations/regionOperations/globalOperations "wait" endpoints,
+    which return as soon as the operation completes, so operations are
+    yielded in completion order. Other statuses, and APIs that reject
+    "wait", fall back to polling "get" with a backoff starting at one
+    second and growing to interval seconds.
+
+    Operations that finish DONE with an error are not yielded; once
+    the others have finished, a RuntimeError lists their errors.
+
+    args:
+        compute (ComputeOperator): Operator whose client issued the operations
+        operations (list): Operation resources returned by the API
+        status (str): PENDING, RUNNING, or DONE
+        timeout (int): Seconds to wait for all operations
+        interval (int): Maximum seconds between polls
+
+    yields:
+        operation resources that reached status
+    """
+    failed = []
+    for operation in _wait_for_operations(compute, operations, status, timeout, interval):
+        if operation['status'] == 'DONE' and 'error' in operation:
+            pprint("Operation failed. " + _operation_summary(operation))
+            failed.append(operation)
+        else:
+            yield operation
+    if failed:
+        raise _operation_failure(failed)
+
+def _wait_for_operations(compute, operations, status, timeout, interval):
+    valid_statuses = ['PENDING', 'RUNNING', 'DONE']
+    if not status in valid_statuses:
+        raise ValueError(
+                         '{} '.format(status) +
+                         'is not a valid status. ' +
+                         '{}'.format(valid_statuses))
+    rank = valid_statuses.index(status)
+
+    deadline = monotonic() + timeout
+    delay = min(1, interval)
+    pending = []
+    for operation in operations:
+        if valid_statuses.index(operation['status']) >= rank:
+            pprint("Operation complete. " + _operation_summary(operation))
+            yield operation
+        else:
+            pending.append(operation)
+
+    if status == 'DONE' and pending:
+        pending = yield from _long_poll_operations(compute, pending, deadline)
+
+    while pending:
+        if deadline - monotonic() <= 0:
+            raise TimeoutError("Operation exceeded timeout period. " +
+                               "; ".join(_operation_summary(op) for op in pending))
+
+        count_poll()
+        still_pending = []
+        for operation in pending:
+            operation = compute._execute(_operation_request(compute.client, operation, 'get'))
+            if valid_statuses.index(operation['status']) >= rank:
+                pprint("Operation complete. " + _operation_summary(operation))
+                yield operation
+            else:
+                pprint("Waiting for operation. " + _operation_summary(operation))
+                still_pending.append(operation)
+        pending = still_pending
+        if pending:
+            idle(max(0, min(delay, deadline - monotonic())))
+            delay = min(delay * 2, interval)
+
+def wait_for_status(compute, operations, status='DONE', timeout=300, interval=5):
+    """ Wait for Google Cloud API operations to complete.
 
     Possible status are PENDING, RUNNING, or DONE.
 
+    args:
+        compute (ComputeOperator): Operator whose client issued the operations
+        operations (dict or list): One operation resource or a list of them
+        status (str): Status to wait for
+        timeout (int): Seconds to wait for all operations
+        interval (int): Maximum seconds between polls when polling
+
+    returns:
+        the finished operation, or a list of them in completion order
+
     Status: Untested.
     """
+    single = isinstance(operations, dict)
+    if single:
+        operations = [operations]
+    finished = list(wait_for_operations(compute, operations, status, timeout, interval))
+    pprint("=================")
+    if single:
+        return finished[0]
+    return finished
+
+class AsyncHttpClient:
+
+    def __init__(self, max_connections=20, max_long_polls=50):
+        """ Minimal asyncio HTTP/1.1 client with keep-alive connection reuse.
+
+        Only what the Compute REST API needs: JSON request bodies and
+        Content-Length or chunked responses.
+
+        args:
+            max_connections (int): Maximum concurrent requests
+            max_long_polls (int): Maximum concurrent long-poll requests;
+                                  they are limited apart from other
+                                  requests, which they would otherwise
+                                  hold up for minutes
+        """
+        self.max_connections = max_connections
+        self.max_long_polls = max_long_polls
+        self.long_polls = 0
+        self._idle = {}
+        self._semaphore = None
+
+    def reserve_long_poll(self):
+        """ Claim one of the max_long_polls slots for a long-poll request.
+
+        returns:
+            False if every slot is in use
+        """
+        if self.long_polls >= self.max_long_polls:
+            return False
+        self.long_polls += 1
+        return True
+
+    def release_long_poll(self):
+        self.long_polls -= 1
+
+    async def _connect(self, key):
+        import asyncio
+        idle = self._idle.setdefault(key, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        scheme, host, port = key
+        ssl_context = None
+        if scheme == 'https':
+            import ssl
+            ssl_context = ssl.create_default_context()
+        reader, writer = await asyncio.open_connection(host, port, ssl = ssl_context)
+        return reader, writer, False
+
+    @staticmethod
+    async def _read_response(reader, method):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by server.")
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in [b'\r\n', b'\n', b'']:
+                break
+            key, value = line.decode('latin-1').split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        status = int(status)
+        if method == 'HEAD' or status in [204, 304]:
+            content = b''
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in [b'\r\n', b'\n', b'']:
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            content = b''.join(chunks)
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            content = await reader.read()
+            keep_alive = False
+        return status, reason, headers, content, keep_alive
+
+    async def request(self, method, url, headers=None, body=None, long_poll=False):
+        """ Send a request and read the whole response.
+
+        args:
+            long_poll (bool): The caller holds a reserve_long_poll slot,
+                              so max_connections does not apply
+
+        returns:
+            tuple of (status, reason, headers dict, body bytes)
+        """
+        import asyncio
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+
+        parsed = urllib.parse.urlsplit(url)
+        default_port = 443 if parsed.scheme == 'https' else 80
+        key = (parsed.scheme, parsed.hostname, parsed.port or default_port)
+        target = parsed.path or '/'
+        if parsed.query:
+            target += '?' + parsed.query
+
+        lines = ["{} {} HTTP/1.1".format(method, target), "Host: {}".format(parsed.netloc)]
+        for name, value in (headers or {}).items():
+            lines.append("{}: {}".format(name, value))
+        lines.append("Content-Length: {}".format(len(body) if body else 0))
+        lines.append("Connection: keep-alive")
+        payload = ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + (body or b'')
+
+        async with nullcontext() if long_poll else self._semaphore:
+            while True:
+                reader, writer, reused = await self._connect(key)
+                try:
+                    writer.write(payload)
+                    await writer.drain()
+                    status, reason, response_headers, content, keep_alive = await self._read_response(reader, method)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    # The server may have dropped an idle keep-alive
+                    # connection; retry once on a fresh one.
+                    if reused:
+                        continue
+                    raise
+                except asyncio.CancelledError:
+                    # A half-read response leaves the connection unusable
+                    writer.close()
+                    raise
+                break
+            if keep_alive:
+                self._idle[key].append((reader, writer))
+            else:
+                writer.close()
+        return status, reason, response_headers, content
+
+    async def close(self):
+        """ Close idle keep-alive connections.
+        """
+        for connections in self._idle.values():
+            for reader, writer in connections:
+                writer.close()
+        self._idle = {}
+
+
+def _http_error(status, reason, headers, content, uri):
+    """ Build a googleapiclient HttpError so callers can handle errors the same way.
+    """
+    from httplib2 import Response
+    from googleapiclient.errors import HttpError
+    info = dict(headers)
+    info.update({'status': status, 'reason': reason})
+    return HttpError(Response(info), content, uri = uri)
+
+def _operation_path(operation):
+    """ Path of an operation resource relative to the API base URL.
+    """
+    parts = operation['selfLink'].split('/')
+    return '/'.join(parts[parts.index('projects'):])
+
 
-    timeout_cycles = int(timeout)/interval
+class AsyncComputeOperator:
+
+    def __init__(self, credentials=None, base_url=None, max_connections=20, max_long_polls=50, limiter=None):
+        """ Asyncio variant of ComputeOperator.
+
+        Calls the Compute REST API directly from the running event
+        loop, so any number of in-flight operations share one thread
+        and a small pool of keep-alive connections.
+
+        args:
+            credentials (GoogleCredentials): Defaults to application default
+                                             credentials against the real API
+            base_url (str): Root URL of a Compute API stand-in, as for ComputeOperator
+            max_connections (int): Maximum concurrent HTTP requests
+            max_long_polls (int): Maximum concurrent operations.wait requests,
+                                  on top of max_connections; operations
+                                  beyond it are polled with get
+            limiter (RateLimiter): Defaults to the shared rate_limiter
 
+        Status: Untested.
+        """
+        self.limiter = limiter if limiter is not None else rate_limiter
+        if credentials is None and not base_url:
+            from oauth2client.client import GoogleCredentials
+            credentials = GoogleCredentials.get_application_default()
+        self.credentials = credentials
+        self.base_url = (base_url or COMPUTE_ROOT_URL) + 'compute/v1/'
+        self.http = AsyncHttpClient(
+                                    max_connections = max_connections,
+                                    max_long_polls = max_long_polls)
+
+    async def _call(self, method, path, params=None, body=None, tries=5, long_poll=False):
+        """ Make a Compute API request and decode the JSON response.
+
+        Requests wait for the rate limiter and rate limit responses, and
+        5xx responses to idempotent requests, are retried with backoff,
+        as in ComputeOperator._execute. Token refreshes happen
+        synchronously but only about once an hour.
+        long_poll requests use the HTTP client's separate long-poll limit.
+        """
+        url = self.base_url + path
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        headers = {'Accept': 'application/json'}
+        if self.credentials is not None:
+            token = self.credentials.get_access_token().access_token
+            headers['Authorization'] = 'Bearer {}'.format(token)
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+
+        keys = self.limiter.keys(url)
+        idempotent = method == 'GET' or 'requestId' in (params or {})
+        for attempt in range(tries):
+            await self.limiter.acquire_async(keys)
+            count_request()
+            status, reason, response_headers, content = await self.http.request(method, url, headers, data, long_poll = long_poll)
+            if status < 300:
+                break
+            error = _http_error(status, reason, response_headers, content, url)
+            if attempt == tries - 1:
+                raise error
+            if is_rate_limited(error):
+                self.limiter.rate_limited(keys, attempt)
+            elif idempotent and is_transient_error(error):
+                import asyncio
+                delay = backoff_delay(attempt, base = 1, cap = 30)
+                _count('sleep', delay)
+                await asyncio.sleep(delay)
+            else:
+                raise error
+        if not content:
+            return {}
+        return json.loads(content.decode('utf-8'))
+
+    async def close(self):
+        await self.http.close()
+
+    @async_timed_call
+    async def stop_instance(self, name, project, zone):
+        """ Stop a running GCP instance.
+
+        Status: Untested.
+        """
+        operation = await self._call(
+                                     'POST',
+                                     'projects/{}/zones/{}/instances/{}/stop'.format(project, zone, name),
+                                     params = {'requestId': str(uuid.uuid4())})
+        await async_wait_for_status(self, operation)
+
+    async def _delete_instance(self, name, project, zone):
+        print("Deleting instance: {}".format(name))
+        try:
+            return await self._call(
+                                    'DELETE',
+                                    'projects/{}/zones/{}/instances/{}'.format(project, zone, name),
+                                    params = {'requestId': str(uuid.uuid4())})
+        except Exception as err:
+            if is_http_error(err) and err.resp.status in [404]:
+                pprint("INFO: Skipping delete; instance {} does not exist.".format(name))
+                return None
+            raise
+
+    @async_timed_call
+    async def delete_instance(self, name, project, zone):
+        """ Delete a GCP compute instance.
+
+        Status: Untested.
+        """
+        operation = await self._delete_instance(name, project, zone)
+        if operation is not None:
+            await async_wait_for_status(self, operation)
+
+    @async_timed_call
+    async def delete_instances(self, names, project, zone):
+        """ Delete several GCP compute instances concurrently.
+
+        Requests are bounded by the HTTP client's max_connections;
+        operations are awaited together. As in ComputeOperator, failed
+        deletes are reported once the others have finished.
+
+        returns:
+            the finished delete operations, in completion order
+
+        Status: Untested.
+        """
+        import asyncio
+        names = list(names)
+        results = await asyncio.gather(*[
+                                         self._delete_instance(name, project, zone)
+                                         for name in names],
+                                       return_exceptions = True)
+        operations = [result for result in results if isinstance(result, dict)]
+        failed = [(name, result) for name, result in zip(names, results) if isinstance(result, BaseException)]
+        finished = []
+        try:
+            finished = await async_wait_for_status(self, operations)
+        except RuntimeError as err:
+            if not failed:
+                raise
+            failed.append(('operations', err))
+        if failed:
+            reasons = ["{} ({})".format(name, str(exception).splitlines()[0] if str(exception) else type(exception).__name__)
+                       for name, exception in failed]
+            raise RuntimeError("Failed to delete {} instances: {}".format(len(failed), "; ".join(reasons))) from failed[0][1]
+        return finished
+
+    async def list_group_instances(self, group_name, project, zone, page_size=500, fields=GROUP_INSTANCE_FIELDS):
+        """Get the instances running in instance group
+
+        An async generator that fetches each page once the previous one
+        has been consumed; see ComputeOperator.list_group_instances.
+
+        yields:
+            dicts with instance metadata
+        """
+        params = {'maxResults': page_size}
+        if fields:
+            params['fields'] = fields
+        while True:
+            with metrics.span('compute', 'list_group_instances'):
+                response = await self._call(
+                                            'POST',
+                                            'projects/{}/zones/{}/instanceGroups/{}/listInstances'.format(
+                                                                                                          project,
+                                                                                                          zone,
+                                                                                                          group_name),
+                                            params = params,
+                                            body = {"instanceState": "RUNNING"})
+            for instance in response.get('items', []):
+                yield instance
+            if not response.get('nextPageToken'):
+                return
+            params['pageToken'] = response['nextPageToken']
+
+    @async_timed_call
+    async def create_image(self, image_name, source_disk, project, force=False, family=None, source_snapshot=None):
+        """ Create a GCP instance image.
+
+        Status: Untested.
+        """
+        pprint("Creating image \"{}\" from \"{}\".".format(image_name, source_snapshot or source_disk))
+        config = {"name": image_name}
+        if source_snapshot:
+            config['sourceSnapshot'] = source_snapshot
+        else:
+            config['sourceDisk'] = source_disk
+        if family:
+            config['family'] = family
+        operation = await self._call(
+                                     'POST',
+                                     'projects/{}/global/images'.format(project),
+                                     params = {
+                                               'forceCreate': 'true' if force else 'false',
+                                               'requestId': str(uuid.uuid4())},
+                                     body = config)
+        await async_wait_for_status(self, operation)
+
+    @async_timed_call
+    async def delete_image(self, image_name, project, timeout=300):
+        """ Delete a GCP instance image.
+
+        Status: Untested.
+        """
+        pprint("Deleting image: {}".format(image_name))
+        try:
+            operation = await self._call(
+                                         'DELETE',
+                                         'projects/{}/global/images/{}'.format(project, image_name),
+                                         params = {'requestId': str(uuid.uuid4())})
+        except Exception as err:
+            if is_http_error(err) and err.resp.status in [404]:
+                pprint("INFO: Skipping delete; image does not exist.")
+                return
+            raise
+        await async_wait_for_status(self, operation, timeout = timeout)
+
+async def _async_wait_for_operation(compute, operation, status, deadline, interval):
+    """ Wait for a single operation; see wait_for_operations.
+    """
+    import asyncio
+    valid_statuses = ['PENDING', 'RUNNING', 'DONE']
+    rank = valid_statuses.index(status)
+    path = _operation_path(operation)
+    long_poll = status == 'DONE'
+    delay = min(1, interval)
+
+    while valid_statuses.index(operation['status']) < rank:
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Operation exceeded timeout period. " +
+                               _operation_summary(operation))
+        count_poll()
+        # Long-polls have their own connection limit; while it is all
+        # in use this operation is polled with get instead.
+        if long_poll and compute.http.reserve_long_poll():
+            try:
+                operation = await asyncio.wait_for(
+                                                   compute._call('POST', path + '/wait', long_poll = True),
+                                                   min(remaining, OPERATION_WAIT_WINDOW))
+            except asyncio.TimeoutError:
+                pass
+            except Exception as err:
+                if not is_http_error(err) or not err.resp.status in [400, 404, 501]:
+                    raise
+                pprint("INFO: operations.wait unavailable; polling instead.")
+                long_poll = False
+            finally:
+                compute.http.release_long_poll()
+            continue
+
+        operation = await compute._call('GET', path)
+        if valid_statuses.index(operation['status']) < rank:
+            pprint("Waiting for operation. " + _operation_summary(operation))
+            seconds = max(0, min(delay, deadline - monotonic()))
+            _count('sleep', seconds)
+            await asyncio.sleep(seconds)
+            delay = min(delay * 2, interval)
+    return operation
+
+async def async_wait_for_status(compute, operations, status='DONE', timeout=300, interval=5):
+    """ Asyncio variant of wait_for_status.
+
+    Every operation is awaited concurrently on the running event loop.
+    As in wait_for_operations, operations that finish DONE with an
+    error raise a RuntimeError once the others have finished.
+
+    args:
+        compute (AsyncComputeOperator): Operator that issued the operations
+        operations (dict or list): One operation resource or a list of them
+        status (str): PENDING, RUNNING, or DONE
+        timeout (int): Seconds to wait for all operations
+        interval (int): Maximum seconds between polls when polling
+
+    returns:
+        the finished operation, or a list of them in completion order
+
+    Status: Untested.
+    """
+    import asyncio
     valid_statuses = ['PENDING', 'RUNNING', 'DONE']
     if not status in valid_statuses:
         raise ValueError(
-                         '{} '.format(status) + 
-                         'is not a valid status. ' + 
+                         '{} '.format(status) +
+                         'is not a valid status. ' +
                          '{}'.format(valid_statuses))
 
-    # TODO: Test custom error and fully integrate status/timeout 
-    # variables into function.
-    n = 0
-    while response['status'] != status:
-        n += 1
-        if n >= timeout_cycles:
-            raise TimeoutError("Operation exceeded timeout period. " +
-                               "{}: {}.".format(op_kind, op_type))
-        sleep(interval)
-        response = request.execute()
-        op_kind = response['kind']
-        op_type = response['operationType']
-        op_status = response['status']
-        pprint("Waiting for operation. {}: {}; {}.".format(
-                                                          op_kind,
-                                                          op_type,
-                                                          op_status))
-    pprint("Operation complete. {}: {}; {}.".format(
-                                               op_kind,
-                                               op_type,
-                                               op_status))
+    single = isinstance(operations, dict)
+    if single:
+        operations = [operations]
+    deadline = monotonic() + timeout
+    tasks = [
+             asyncio.ensure_future(_async_wait_for_operation(compute, op, status, deadline, interval))
+             for op in operations]
+    finished = []
+    failed = []
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            operation = await next_done
+            if operation['status'] == 'DONE' and 'error' in operation:
+                pprint("Operation failed. " + _operation_summary(operation))
+                failed.append(operation)
+                continue
+            pprint("Operation complete. " + _operation_summary(operation))
+            finished.append(operation)
+    finally:
+        for task in tasks:
+            task.cancel()
     pprint("=================")
+    if failed:
+        raise _operation_failure(failed)
+    if single:
+        return finished[0]
+    return finished
+
+def _address_list(value):
+    # Config values may be a single address or a list
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return list(value)
 
-def get_deployment_object(config, compute):
+def get_deployment_object(config, compute, tfvars=None, mode='minimal'):
 
     root = config['root']
     state_file = os.path.join(root, config['state-file'])
@@ -351,12 +2673,1184 @@ def get_deployment_object(config, compute):
     # Same operation using a map function (less readable)
     # var_files = list(map(lambda var_file: os.path.join(config['root'], var_file), config['var-files']))
 
+    # Scheduling settings; "depends-on" may be a single name or a list
+    depends_on = config.get('depends-on', [])
+    if isinstance(depends_on, str):
+        depends_on = [depends_on]
+    options = {
+               'name': config.get('name'),
+               'depends_on': depends_on,
+               'network': config.get('network', config.get('project')),
+               'mode': config.get('mode', mode),
+               'replace': _address_list(config.get('replace')),
+               'target': _address_list(config.get('target'))
+              }
+
     if config['load-balancer']:
-        deployment = BalancerDeployment(compute, root, state_file, var_files)
+        options.update({
+                        'rollout': config.get('rollout', 'recreate'),
+                        'max_surge': config.get('max-surge', 1),
+                        'max_unavailable': config.get('max-unavailable', 0),
+                        'image_family': config.get('image-family'),
+                        'image_retention': config.get('image-retention', 3),
+                        'image_source': config.get('image-source', 'stopped'),
+                        'flush_command': config.get('flush-command'),
+                        'guest_flush': config.get('guest-flush', False),
+                        'stable_timeout': config.get('stable-timeout', 1200),
+                        'stable_interval': config.get('stable-interval', 10),
+                        'refresh': bool(config.get('refresh-group', False)),
+                        'tfvars': tfvars
+                       })
+        deployment = BalancerDeployment(compute, root, state_file, var_files, **options)
     else:
-        deployment = BaseDeployment(root, state_file, var_files)
+        deployment = BaseDeployment(root, state_file, var_files, **options)
     return deployment
 
+@lru_cache(maxsize=None)
+def terraform_version():
+    """ Output of "terraform version", looked up once per run.
+    """
+    result = subprocess.run(
+                            ['terraform', 'version'],
+                            stdout = subprocess.PIPE,
+                            universal_newlines = True,
+                            check = True)
+    return result.stdout.splitlines()[0]
+
+
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+RESOURCE_COUNTS = re.compile(r'(\d+) (to add|to change|to destroy|added|changed|destroyed)')
+
+def parse_resource_counts(line):
+    """ Resource counts from a Terraform plan/apply/destroy summary line.
+
+    returns:
+        dict with add, change and/or destroy counts; empty for other lines
+    """
+    line = ANSI_ESCAPE.sub('', line)
+    if not (line.startswith('Plan:') or ' complete! Resources:' in line):
+        return {}
+    keys = {
+            'to add': 'add', 'added': 'add',
+            'to change': 'change', 'changed': 'change',
+            'to destroy': 'destroy', 'destroyed': 'destroy'
+           }
+    return {keys[action]: int(count) for count, action in RESOURCE_COUNTS.findall(line)}
+
+
+class OutputWriter:
+
+    def __init__(self, log_dir=None, stream=None):
+        """ Write Terraform output from concurrent deployments.
+
+        Lines go to the console prefixed with the set name and, with
+        log_dir, to <log_dir>/<set>.log; events go to
+        <log_dir>/events.jsonl as JSON lines. All writing happens on one
+        background thread fed by an unbounded queue, so producers never
+        wait on disk or terminal I/O.
+
+        args:
+            log_dir (str): Directory for per-set logs and the event stream
+            stream (file): Console stream, sys.stdout by default
+        """
+        self.log_dir = log_dir
+        self.stream = stream if stream is not None else sys.stdout
+        self._queue = queue.Queue()
+        self._logs = {}
+        self._events = None
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+            self._events = open(os.path.join(log_dir, 'events.jsonl'), 'a')
+        self._thread = threading.Thread(target = self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, name, line):
+        self._queue.put(('line', name, line))
+
+    def event(self, name, event, **fields):
+        record = {'time': time(), 'set': name, 'event': event}
+        record.update(fields)
+        self._queue.put(('event', name, json.dumps(record)))
+
+    def _log(self, name):
+        if not name in self._logs:
+            filename = re.sub(r'[^A-Za-z0-9_.-]', '_', name) + '.log'
+            self._logs[name] = open(os.path.join(self.log_dir, filename), 'a')
+        return self._logs[name]
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            kind, name, text = item
+            if kind == 'line':
+                self.stream.write("[{}] {}\n".format(name, text))
+                if self.log_dir:
+                    self._log(name).write(ANSI_ESCAPE.sub('', text) + "\n")
+            elif self._events is not None:
+                self._events.write(text + "\n")
+            # Flush once the backlog is drained rather than per line
+            if self._queue.empty():
+                self._flush()
+        self._flush()
+
+    def _flush(self):
+        self.stream.flush()
+        for fh in self._logs.values():
+            fh.flush()
+        if self._events is not None:
+            self._events.flush()
+
+    def close(self):
+        """ Write everything still queued and close the log files.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        for fh in self._logs.values():
+            fh.close()
+        if self._events is not None:
+            self._events.close()
+
+
+class TerraformInit:
+
+    def __init__(self, plugin_cache_dir, provider_mirror=None, cli_config=None):
+        """ Run "terraform init" once per root, only when it is out of date.
+
+        Every root shares one plugin cache directory, so providers are
+        downloaded once and linked into each root. With provider_mirror
+        a Terraform CLI config is written that installs providers from
+        that local mirror before trying the registry.
+
+        args:
+            plugin_cache_dir (str): Shared TF_PLUGIN_CACHE_DIR
+            provider_mirror (str): Local filesystem mirror of providers
+            cli_config (str): Where to write the CLI config for the mirror
+        """
+        self.plugin_cache_dir = os.path.abspath(plugin_cache_dir)
+        self.provider_mirror = provider_mirror
+        self.cli_config = cli_config
+        if provider_mirror and not cli_config:
+            self.cli_config = os.path.join(os.path.dirname(self.plugin_cache_dir), 'terraformrc')
+        # Terraform's plugin cache is not safe for concurrent inits
+        self._lock = threading.Lock()
+        self._initialized = set()
+
+    def environment(self):
+        """ Environment variables for every Terraform command.
+        """
+        os.makedirs(self.plugin_cache_dir, exist_ok=True)
+        env = {
+               'TF_PLUGIN_CACHE_DIR': self.plugin_cache_dir,
+               'TF_IN_AUTOMATION': '1'
+              }
+        if self.provider_mirror:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cli_config)), exist_ok=True)
+            with open(self.cli_config, 'w') as fh:
+                fh.write(
+                         'plugin_cache_dir = "{}"\n'.format(self.plugin_cache_dir) +
+                         'provider_installation {\n' +
+                         '  filesystem_mirror {\n' +
+                         '    path = "{}"\n'.format(os.path.abspath(self.provider_mirror)) +
+                         '  }\n' +
+                         '  direct {}\n' +
+                         '}\n')
+            env['TF_CLI_CONFIG_FILE'] = os.path.abspath(self.cli_config)
+        return env
+
+    @staticmethod
+    def _stamp_path(root):
+        return os.path.join(root, '.terraform', 'sprout-init.sha256')
+
+    @staticmethod
+    def _digest(root):
+        """ Hash of what init depends on.
+
+        That is the dependency lock file, or the .tf files for Terraform
+        versions without one.
+        """
+        digest = hashlib.sha256()
+        lock_file = os.path.join(root, '.terraform.lock.hcl')
+        if os.path.exists(lock_file):
+            paths = [lock_file]
+        else:
+            paths = sorted(
+                           os.path.join(root, name) for name in os.listdir(root)
+                           if name.endswith('.tf'))
+        for path in paths:
+            with open(path, 'rb') as fh:
+                digest.update(fh.read())
+        return digest.hexdigest()
+
+    def is_current(self, root):
+        """ True if root was initialized against its current lock file.
+        """
+        try:
+            with open(self._stamp_path(root)) as fh:
+                return fh.read().strip() == self._digest(root)
+        except OSError:
+            return False
+
+    def ensure(self, deployment, dry_run, timeout=600):
+        """ Initialize the deployment's root unless it is up to date.
+
+        The root is only marked current once a real init succeeded; a
+        dry run leaves it as it was.
+        """
+        root = os.path.realpath(deployment.root)
+        with self._lock:
+            if root in self._initialized:
+                return
+            if not self.is_current(root):
+                deployment.log("Initializing {}".format(root))
+                deployment.init(dry_run, timeout)
+                if not dry_run:
+                    # init may create or update the lock file
+                    with open(self._stamp_path(root), 'w') as fh:
+                        fh.write(self._digest(root))
+            self._initialized.add(root)
+
+
+# Request ids kept per set to recognize replayed spool requests
+LEDGER_REQUEST_IDS = 100
+
+class RunLedger:
+
+    def __init__(self, path):
+        """ Record the fingerprint of each set's last successful run.
+
+        args:
+            path (str): JSON file holding the ledger
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as fh:
+                self.entries = json.load(fh)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def is_current(self, name, fingerprint):
+        """ True if the last successful run of name had this fingerprint.
+        """
+        with self._lock:
+            entry = self.entries.get(name)
+        return entry is not None and entry.get('fingerprint') == fingerprint
+
+    def served(self, name, request_id):
+        """ True if a successful run of name already served request_id.
+        """
+        with self._lock:
+            return request_id in self.entries.get(name, {}).get('requests', [])
+
+    def terraform(self, name):
+        """ Terraform version of the last successful run of name, if recorded.
+        """
+        with self._lock:
+            return self.entries.get(name, {}).get('terraform')
+
+    def record(self, name, fingerprint, terraform=None):
+        """ Store a successful run and write the ledger to disk.
+
+        args:
+            terraform (str): Terraform version the fingerprint was taken
+                             with, so --dry-run can check it without
+                             running Terraform
+        """
+        with self._lock:
+            entry = {'fingerprint': fingerprint, 'time': time()}
+            if terraform is not None:
+                entry['terraform'] = terraform
+            if 'requests' in self.entries.get(name, {}):
+                entry['requests'] = self.entries[name]['requests']
+            self.entries[name] = entry
+            self._save()
+
+    def record_requests(self, name, request_ids):
+        """ Store the spool requests a successful run of name served.
+
+        Only the last LEDGER_REQUEST_IDS ids are kept.
+        """
+        with self._lock:
+            entry = self.entries.setdefault(name, {})
+            entry['requests'] = (entry.get('requests', []) + list(request_ids))[-LEDGER_REQUEST_IDS:]
+            self._save()
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as fh:
+            json.dump(self.entries, fh, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+class RunJournal:
+
+    def __init__(self, path, resume=False):
+        """ Record the phases each set has completed in this run.
+
+        Written after every phase, so a failed run can be continued
+        from the phase that failed with --resume.
+
+        args:
+            path (str): JSON file holding the journal
+            resume (bool): Continue the journaled run instead of starting over
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.sets = {}
+        if resume:
+            try:
+                with open(path) as fh:
+                    self.sets = json.load(fh)['sets']
+            except (OSError, ValueError, KeyError):
+                print("WARNING: No journal at {}; starting a new run.".format(path))
+        self._save()
+
+    def completed(self, name):
+        """ Phases of name completed so far, in order.
+        """
+        with self._lock:
+            return list(self.sets.get(name, {}).get('completed', []))
+
+    def is_done(self, name):
+        with self._lock:
+            return self.sets.get(name, {}).get('done', False)
+
+    def record(self, name, phase):
+        """ Mark a phase of name as completed.
+        """
+        with self._lock:
+            entry = self.sets.setdefault(name, {'completed': []})
+            entry['completed'].append(phase)
+            entry.pop('failed', None)
+            entry.pop('error', None)
+            self._save()
+
+    def fail(self, name, phase, error):
+        """ Mark a phase of name as failed.
+        """
+        with self._lock:
+            entry = self.sets.setdefault(name, {'completed': []})
+            entry['failed'] = phase
+            entry['error'] = str(error).splitlines()[0] if str(error) else type(error).__name__
+            self._save()
+
+    def finish(self, name):
+        """ Mark name as done; a resumed run skips it.
+        """
+        with self._lock:
+            self.sets.setdefault(name, {'completed': []})['done'] = True
+            self._save()
+
+    def _save(self):
+        _write_atomic(self.path, json.dumps({'sets': self.sets, 'time': time()}, indent=2, sort_keys=True))
+
+# Estimates for phases with no recorded runs at all, in seconds
+DEFAULT_PHASE_SECONDS = {
+                         'init': 30,
+                         'plan': 60,
+                         'destroy': 300,
+                         'apply': 600,
+                         'flush': 30,
+                         'load-balancer': 600
+                        }
+
+class RunHistory:
+
+    def __init__(self, path, keep=10):
+        """ Durations of each set's phases and Compute calls over recent runs.
+
+        Terraform phases also keep the resource counts they reported,
+        under the kind "resources".
+
+        args:
+            path (str): JSON file holding the history
+            keep (int): Durations kept per set, kind and name
+        """
+        self.path = path
+        self.keep = keep
+        try:
+            with open(path) as fh:
+                self.sets = json.load(fh)['sets']
+        except (OSError, ValueError, KeyError):
+            self.sets = {}
+
+    def record(self, spans):
+        """ Add the phase and compute spans of a run and write the history.
+        """
+        for span in spans:
+            name = span['labels'].get('set')
+            if name is None or not span['kind'] in ['phase', 'compute'] or span['duration'] is None:
+                continue
+            entries = self.sets.setdefault(name, {})
+            values = {"{}:{}".format(span['kind'], span['name']): round(span['duration'], 3)}
+            if span.get('resources') is not None:
+                values["resources:{}".format(span['name'])] = span['resources']
+            for key, value in values.items():
+                entries.setdefault(key, []).append(value)
+                del entries[key][:-self.keep]
+        _write_atomic(self.path, json.dumps({'sets': self.sets, 'time': time()}, indent=2, sort_keys=True))
+
+    def estimate(self, kind, name, set_name, default=None):
+        """ Expected seconds (or resource count) for a phase or call of a set.
+
+        The median of the set's own recent runs, else the median over
+        every set, else default.
+
+        returns:
+            (seconds, source) with source "history", "other sets",
+            "default" or None when there is no estimate
+        """
+        key = "{}:{}".format(kind, name)
+        durations = self.sets.get(set_name, {}).get(key)
+        if durations:
+            return _median(durations), 'history'
+        durations = [duration for entries in self.sets.values() for duration in entries.get(key, [])]
+        if durations:
+            return _median(durations), 'other sets'
+        if default is not None:
+            return default, 'default'
+        return None, None
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def run_deployment(deployment, dry_run, ledger=None, force=False, initializer=None, journal=None):
+    """ Run one deployment inside a timing span; see _run_deployment.
+    """
+    with metrics.span('set', deployment.name, set = deployment.name):
+        _run_deployment(deployment, dry_run, ledger, force, initializer, journal)
+
+def _run_deployment(deployment, dry_run, ledger=None, force=False, initializer=None, journal=None):
+    """ Run the plan, destroy, apply and load balancer phases for a single deployment.
+
+    Sets whose plan has no changes skip apply. In minimal mode the saved
+    plan, with any -replace/-target options, is applied in place. In
+    full mode the set is destroyed, planned again into the saved plan
+    file (the first plan is stale once the state is destroyed) and that
+    exact plan is applied. Load balancer sets with refresh set then bake
+    their image and refresh the instance group; that phase is not
+    retried as a whole, since it deletes instances.
+
+    With a ledger, sets whose fingerprint matches their last successful
+    run are skipped entirely unless force is set. With a journal, each
+    completed phase is recorded, and phases a resumed run already
+    completed are skipped; the saved plan is made again before apply.
+
+    args:
+        deployment (BaseDeployment): Deployment to run
+        dry_run (bool): If true will just print commands
+        ledger (RunLedger): Fingerprints of previous successful runs
+        force (bool): Run even if the ledger says nothing changed
+        initializer (TerraformInit): Runs terraform init when needed
+        journal (RunJournal): Phases completed in this run
+    """
+    completed = []
+    if journal is not None and not dry_run:
+        if journal.is_done(deployment.name):
+            deployment.log("Completed in the resumed run; skipping.")
+            return
+        completed = journal.completed(deployment.name)
+        if completed:
+            deployment.log("Resuming after {}.".format(", ".join(completed)))
+    else:
+        journal = None
+
+    def phase(name, function):
+        if name in completed:
+            return None
+        try:
+            result = function()
+        except BaseException as err:
+            if journal is not None:
+                journal.fail(deployment.name, name, err)
+            raise
+        if journal is not None:
+            journal.record(deployment.name, name)
+        return result
+
+    def finish():
+        if use_ledger:
+            # Fingerprint again; apply bumps the state serial
+            ledger.record(deployment.name, deployment.fingerprint(), terraform = terraform_version())
+        if journal is not None:
+            journal.finish(deployment.name)
+
+    if initializer is not None:
+        initializer.ensure(deployment, dry_run)
+    use_ledger = ledger is not None and not dry_run
+    if use_ledger and not force and not completed:
+        if ledger.is_current(deployment.name, deployment.fingerprint()):
+            deployment.log("Unchanged since last successful run; skipping.")
+            if deployment.output is not None:
+                deployment.output.event(deployment.name, 'skipped', reason = 'unchanged')
+            if journal is not None:
+                journal.finish(deployment.name)
+            return
+
+    if isinstance(deployment, BalancerDeployment):
+        deployment.log("Launching load balancer deployment")
+    elif isinstance(deployment, BaseDeployment):
+        deployment.log("Launching base deployment")
+
+    # A journaled plan always had changes; unchanged sets finish at once
+    changed = phase('plan', lambda: deployment.plan(dry_run, timeout=60, plan_file=deployment.plan_file))
+    if changed is False:
+        deployment.log("No changes; skipping apply.")
+        deployment.remove_plan(deployment.plan_file)
+        finish()
+        return
+
+    def apply():
+        if deployment.mode == 'full' or 'plan' in completed:
+            deployment.plan(dry_run, timeout=60, plan_file=deployment.plan_file)
+        deployment.apply(dry_run, timeout=1200, plan_file=deployment.plan_file)
+
+    if deployment.mode == 'full':
+        phase('destroy', lambda: deployment.destroy(dry_run, timeout=300))
+    phase('apply', apply)
+    if isinstance(deployment, BalancerDeployment) and deployment.refresh:
+        phase('load-balancer', lambda: deployment.load_to_balancer(deployment.compute, dry_run))
+    finish()
+
+
+class DeploymentScheduler:
+
+    def __init__(self, deployments, max_parallel=1, max_per_network=None):
+        """ Run deployments as a dependency graph.
+
+        Deployments start as soon as everything they depend on has
+        finished, up to max_parallel at a time and max_per_network at
+        a time against the same network/project. Deployments sharing a
+        Terraform root or a state file never run at the same time.
+        With max_parallel=1 deployments run one at a time in config
+        order, as sprout always has.
+
+        args:
+            deployments (list): Deployment objects in config order
+            max_parallel (int): Global concurrency cap
+            max_per_network (int): Per network/project concurrency cap
+        """
+        if max_parallel < 1:
+            raise ValueError("max_parallel must be at least 1.")
+        if max_per_network is not None and max_per_network < 1:
+            raise ValueError("max_per_network must be at least 1.")
+
+        self.deployments = deployments
+        self.max_parallel = max_parallel
+        self.max_per_network = max_per_network
+        self._validate()
+
+    def _validate(self):
+        """ Check for duplicate names, unknown dependencies and cycles.
+        """
+        names = [deployment.name for deployment in self.deployments]
+        duplicates = sorted(set(name for name in names if names.count(name) > 1))
+        if duplicates:
+            raise ValueError("Duplicate terraform_sets names: {}".format(duplicates))
+
+        for deployment in self.deployments:
+            for dependency in deployment.depends_on:
+                if not dependency in names:
+                    raise ValueError(
+                                     "{} depends on unknown set {}.".format(
+                                                                           deployment.name,
+                                                                           dependency))
+
+        # Kahn's algorithm; anything left over is part of a cycle
+        remaining = {deployment.name: set(deployment.depends_on) for deployment in self.deployments}
+        while remaining:
+            ready = [name for name, dependencies in remaining.items() if not dependencies]
+            if not ready:
+                raise ValueError("Dependency cycle between sets: {}".format(sorted(remaining)))
+            for name in ready:
+                del remaining[name]
+            for dependencies in remaining.values():
+                dependencies.difference_update(ready)
+
+    @staticmethod
+    def _lock_keys(deployment):
+        """ Resources a deployment needs exclusive use of.
+        """
+        return set([
+                    ('root', os.path.realpath(deployment.root)),
+                    ('state', os.path.realpath(deployment.state_file))])
+
+    def _can_start(self, deployment, finished, running):
+        if not all(dependency in finished for dependency in deployment.depends_on):
+            return False
+        locks = self._lock_keys(deployment)
+        for other in running:
+            if locks & self._lock_keys(other):
+                return False
+        if self.max_per_network and deployment.network:
+            same_network = [other for other in running if other.network == deployment.network]
+            if len(same_network) >= self.max_per_network:
+                return False
+        return True
+
+    def run(self, task):
+        """ Call task(deployment) for every deployment in dependency order.
+
+        After the first failure no new deployments are started; the
+        running ones are allowed to finish and the error is re-raised.
+
+        args:
+            task (callable): Function taking a single deployment object
+
+        returns:
+            list of deployment names in the order they finished
+        """
+        pending = list(self.deployments)
+        running = {}
+        finished = []
+        error = None
+
+        with ThreadPoolExecutor(max_workers = self.max_parallel) as executor:
+            while pending or running:
+                if error is None:
+                    for deployment in list(pending):
+                        if len(running) >= self.max_parallel:
+                            break
+                        if self._can_start(deployment, finished, running.values()):
+                            pending.remove(deployment)
+                            future = executor.submit(task, deployment)
+                            running[future] = deployment
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when = FIRST_COMPLETED)
+                for future in done:
+                    deployment = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as err:
+                        print("ERROR: deployment {} failed: {}".format(deployment.name, err))
+                        if error is None:
+                            error = err
+                    else:
+                        finished.append(deployment.name)
+
+        if error is not None:
+            if pending:
+                print("Skipped: ", [deployment.name for deployment in pending])
+            raise error
+        return finished
+
+
+class ExecutionPlan:
+
+    def __init__(self, scheduler, history, initializer=None, ledger=None, force=False):
+        """ Everything a run would do, with expected durations, for --dry-run.
+
+        Nothing is executed. Each set lists its phases, Terraform
+        command lines and ComputeOperator calls, assuming every plan
+        has changes. Durations come from the run history, and the
+        scheduler is simulated with them to predict when each set
+        starts and finishes and which chain of sets decides the
+        makespan (the critical path).
+
+        args:
+            scheduler (DeploymentScheduler): Deployments and concurrency caps of the run
+            history (RunHistory): Durations of past runs
+            initializer (TerraformInit): Adds init to the first set of stale roots
+            ledger (RunLedger): Marks unchanged sets as skipped
+            force (bool): Ignore the ledger, as --force does
+        """
+        self.scheduler = scheduler
+        self.history = history
+        self.sets = []
+        roots = set()
+        for deployment in scheduler.deployments:
+            steps = []
+            root = os.path.realpath(deployment.root)
+            if initializer is not None and not root in roots and not initializer.is_current(root):
+                steps.append({
+                              'phase': 'init',
+                              'kind': 'terraform',
+                              'name': 'init',
+                              'command': deployment.command(
+                                                            ['init', '-input=false'],
+                                                            use_var_files = False,
+                                                            use_state = False)})
+            roots.add(root)
+            status = 'changed'
+            if ledger is not None and not force:
+                status = self._ledger_status(deployment, ledger)
+            skipped = status == 'unchanged'
+            if not skipped:
+                steps += deployment.steps()
+            self.sets.append(self._estimate(deployment, steps, skipped))
+            self.sets[-1]['ledger'] = status
+        self._simulate()
+
+    @staticmethod
+    def _ledger_status(deployment, ledger):
+        """ "unchanged", "changed" or "unknown", without running Terraform.
+
+        The fingerprint is taken with the Terraform version the ledger
+        recorded for the set's last successful run instead of running
+        "terraform version". Entries without one, and sets whose files
+        cannot be read, are unknown; they are planned as if changed.
+        """
+        if not 'fingerprint' in ledger.entries.get(deployment.name, {}):
+            return 'changed'
+        version = ledger.terraform(deployment.name)
+        if version is None:
+            return 'unknown'
+        try:
+            if ledger.is_current(deployment.name, deployment.fingerprint(version)):
+                return 'unchanged'
+        except OSError:
+            return 'unknown'
+        return 'changed'
+
+    def _estimate(self, deployment, steps, skipped):
+        """ Annotate steps with estimates and total them per phase.
+        """
+        phases = {}
+        for step in steps:
+            if step['kind'] == 'compute':
+                seconds, source = self.history.estimate('compute', step['name'], deployment.name)
+            else:
+                seconds, source = self.history.estimate(
+                                                        'phase',
+                                                        step['name'],
+                                                        deployment.name,
+                                                        DEFAULT_PHASE_SECONDS.get(step['name']))
+            step['estimate'] = seconds
+            step['source'] = source
+            if step['phase'] != 'load-balancer':
+                phases[step['phase']] = phases.get(step['phase'], 0) + (seconds or 0)
+
+        calls = [step for step in steps if step['phase'] == 'load-balancer']
+        if calls:
+            # The phase as a whole is timed, including every rolling batch
+            seconds, source = self.history.estimate('phase', 'load-balancer', deployment.name)
+            if seconds is None:
+                known = [
+                         step['estimate'] for step in calls
+                         if step['estimate'] is not None and not step.get('background')]
+                seconds = sum(known) if known else DEFAULT_PHASE_SECONDS['load-balancer']
+                source = 'calls' if known else 'default'
+            phases['load-balancer'] = seconds
+            phases['load-balancer source'] = source
+        return {
+                'name': deployment.name,
+                'mode': deployment.mode,
+                'depends_on': deployment.depends_on,
+                'skipped': skipped,
+                'steps': steps,
+                'phases': phases,
+                'estimate': sum(value for key, value in phases.items() if not key.endswith(' source'))}
+
+    def _simulate(self):
+        """ Run the scheduler's start rules against the estimates.
+
+        Sets start, in config order, whenever their dependencies are
+        done and the concurrency caps and root/state locks allow, just
+        as DeploymentScheduler.run starts them.
+        """
+        scheduler = self.scheduler
+        by_name = {deployment.name: deployment for deployment in scheduler.deployments}
+        entries = {entry['name']: entry for entry in self.sets}
+        pending = list(scheduler.deployments)
+        running = {}
+        finished = []
+        now = 0.0
+        while pending:
+            for deployment in list(pending):
+                if len(running) >= scheduler.max_parallel:
+                    break
+                if scheduler._can_start(deployment, finished, [by_name[name] for name in running]):
+                    pending.remove(deployment)
+                    entry = entries[deployment.name]
+                    entry['start'] = now
+                    entry['finish'] = now + entry['estimate']
+                    running[deployment.name] = entry['finish']
+            now = min(running.values())
+            for name in [name for name, finish in running.items() if finish == now]:
+                del running[name]
+                finished.append(name)
+        self.makespan = max([entry['finish'] for entry in self.sets] + [0])
+
+        # With unlimited parallelism only dependencies hold sets back
+        earliest = {}
+        def chain(name):
+            if not name in earliest:
+                entry = entries[name]
+                earliest[name] = max([chain(dependency) for dependency in entry['depends_on']] + [0]) + entry['estimate']
+            return earliest[name]
+        self.lower_bound = max([chain(name) for name in entries] + [0])
+
+        # Walk back from the last set to finish through whatever it waited for
+        self.critical_path = []
+        current = max(self.sets, key = lambda entry: entry['finish']) if self.sets else None
+        while current is not None:
+            self.critical_path.insert(0, current['name'])
+            if current['start'] <= 0:
+                break
+            blockers = [entries[name] for name in current['depends_on'] if entries[name]['finish'] == current['start']]
+            if not blockers:
+                blockers = [entry for entry in self.sets if entry['finish'] == current['start'] and entry is not current]
+            current = blockers[0] if blockers else None
+
+    def to_dict(self):
+        return {
+                'max_parallel': self.scheduler.max_parallel,
+                'max_per_network': self.scheduler.max_per_network,
+                'makespan': self.makespan,
+                'lower_bound': self.lower_bound,
+                'critical_path': self.critical_path,
+                'sets': self.sets
+               }
+
+    def render(self, stream=None):
+        """ Print the plan as indented text.
+        """
+        stream = stream if stream is not None else sys.stdout
+        lines = [
+                 "Execution plan: {} sets, up to {} at a time{}.".format(
+                                                                        len(self.sets),
+                                                                        self.scheduler.max_parallel,
+                                                                        ", {} per network".format(self.scheduler.max_per_network)
+                                                                        if self.scheduler.max_per_network else ''),
+                 "Every plan is assumed to have changes."]
+        for entry in self.sets:
+            after = "after {}; ".format(", ".join(entry['depends_on'])) if entry['depends_on'] else ''
+            lines.append("")
+            lines.append("[{}] {}mode {}; +{} to +{} (~{}){}".format(
+                                                                     entry['name'],
+                                                                     after,
+                                                                     entry['mode'],
+                                                                     format_seconds(entry['start']),
+                                                                     format_seconds(entry['finish']),
+                                                                     format_seconds(entry['estimate']),
+                                                                     {'unchanged': "; unchanged, skipped",
+                                                                      'unknown': "; ledger unknown, assumed changed"}.get(entry['ledger'], '')))
+            for step in entry['steps']:
+                if step['kind'] == 'compute':
+                    text = "{}({})".format(
+                                           step['name'],
+                                           ", ".join("{}={}".format(key, value) for key, value in sorted(step['args'].items())))
+                    if step['background']:
+                        text += " in the background"
+                else:
+                    text = " ".join(step['command'])
+                estimate = '?'
+                if step['estimate'] is not None:
+                    estimate = "~{} ({})".format(format_seconds(step['estimate']), step['source'])
+                lines.append("  {:<14} {}  {}".format(step['phase'], text, estimate))
+            if 'load-balancer' in entry['phases']:
+                lines.append("  {:<14} ~{} ({})".format(
+                                                        'load-balancer',
+                                                        format_seconds(entry['phases']['load-balancer']),
+                                                        entry['phases']['load-balancer source']))
+        lines.append("")
+        lines.append("Critical path: {}".format(" -> ".join(self.critical_path)))
+        lines.append("Estimated makespan ~{}; ~{} with unlimited parallelism.".format(
+                                                                                      format_seconds(self.makespan),
+                                                                                      format_seconds(self.lower_bound)))
+        stream.write("\n".join(lines) + "\n")
+
+def format_seconds(seconds):
+    """ Duration as 1h02m03s, 2m10s or 12s.
+    """
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return "{}h{:02d}m{:02d}s".format(hours, minutes, seconds)
+    if minutes:
+        return "{}m{:02d}s".format(minutes, seconds)
+    return "{}s".format(seconds)
+
+
+class SpoolDaemon:
+
+    def __init__(self, spool, deployments, task, max_parallel=1, max_per_network=None,
+                 poll_interval=2.0, offset_file=None, ledger=None):
+        """ Run deployment requests from a spool as they arrive.
+
+        The spool is a JSON-lines file that is appended to, or a
+        directory of *.json/*.jsonl files. Each request is a JSON
+        object naming terraform_sets by "set" or "sets", with optional
+        "id", "revision" and "force".
+
+        A request is acknowledged (the saved offset moves past it, or
+        its file is moved to done/) only once every run it was merged
+        into has finished, so requests read before a crash are read
+        again. Replays are harmless: the ledger skips sets that have
+        not changed, and requests whose id the ledger lists as served
+        are dropped.
+
+        Requests for a set are coalesced: a request for a queued set is
+        merged into the queued run, and a request for a running set is
+        merged into that run if it has the same revision, otherwise all
+        of them become one follow-up run once the current run finishes.
+        Sets start under the same root/state locks and concurrency
+        caps as DeploymentScheduler; a queued set waits for queued or
+        running sets it depends on.
+
+        args:
+            spool (str): JSON-lines file or directory of request files
+            deployments (list): Deployment objects from the config
+            task (callable): Called as task(deployment, request) to run a set
+            max_parallel (int): Sets run at once
+            max_per_network (int): Sets run at once per network/project
+            poll_interval (float): Seconds between spool reads
+            offset_file (str): Where to keep the read offset of a spool file
+            ledger (RunLedger): Records the ids of served requests
+        """
+        self.spool = spool
+        self.scheduler = DeploymentScheduler(deployments, max_parallel, max_per_network)
+        self.deployments = {deployment.name: deployment for deployment in deployments}
+        self.task = task
+        self.poll_interval = poll_interval
+        self.offset_file = offset_file
+        self.ledger = ledger
+        self.offset = 0
+        if offset_file:
+            try:
+                with open(offset_file) as fh:
+                    self.offset = json.load(fh).get(os.path.abspath(spool), 0)
+            except (OSError, ValueError):
+                pass
+        # Requests by set name, in arrival order
+        self.queued = {}
+        self.running = {}
+        self.follow_up = {}
+        self._futures = {}
+        # Unacknowledged sources: line start offsets or file paths, with
+        # the number of reads and runs still holding each
+        self._holds = {}
+        self._acked = self.offset
+
+    def read(self):
+        """ Requests added to the spool since the last read.
+
+        Each request holds its source until release() is called for it.
+
+        returns:
+            list of (request, source) pairs
+        """
+        if os.path.isdir(self.spool):
+            return self._read_directory()
+        if not os.path.exists(self.spool):
+            return []
+        if os.path.getsize(self.spool) < self.offset:
+            print("WARNING: Spool {} was truncated; reading from the start.".format(self.spool))
+            self.offset = 0
+            self._holds = {}
+        with open(self.spool, 'rb') as fh:
+            fh.seek(self.offset)
+            data = fh.read()
+        # Leave a partly written last line for the next read
+        complete = data[:data.rfind(b'\n') + 1]
+        requests = []
+        for line in complete.splitlines(keepends=True):
+            request = self._parse(line.decode('utf-8'), self.spool)
+            if request is not None:
+                self._hold(self.offset)
+                requests.append((request, self.offset))
+            self.offset += len(line)
+        return requests
+
+    def _read_directory(self):
+        requests = []
+        for filename in sorted(os.listdir(self.spool)):
+            path = os.path.join(self.spool, filename)
+            if not filename.endswith(('.json', '.jsonl')) or not os.path.isfile(path) or path in self._holds:
+                continue
+            with open(path) as fh:
+                lines = [self._parse(line, path) for line in fh.read().splitlines()]
+            for request in lines:
+                if request is not None:
+                    self._hold(path)
+                    requests.append((request, path))
+            if not path in self._holds:
+                self._acknowledge([path])
+        return requests
+
+    @staticmethod
+    def _parse(line, source):
+        if not line.strip():
+            return None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("not a JSON object")
+        except ValueError as err:
+            print("WARNING: Skipping bad request in {}: {}".format(source, err))
+            return None
+        return request
+
+    def _hold(self, source):
+        self._holds[source] = self._holds.get(source, 0) + 1
+
+    def release(self, sources):
+        """ Drop one hold on each source and acknowledge the ones left without any.
+        """
+        finished = []
+        for source in sources:
+            if not source in self._holds:
+                continue
+            self._holds[source] -= 1
+            if not self._holds[source]:
+                del self._holds[source]
+                finished.append(source)
+        self._acknowledge(finished)
+
+    def _acknowledge(self, sources):
+        if os.path.isdir(self.spool):
+            done = os.path.join(self.spool, 'done')
+            for path in sources:
+                os.makedirs(done, exist_ok=True)
+                os.replace(path, os.path.join(done, os.path.basename(path)))
+            return
+        # Everything before the oldest request still held is finished
+        acked = min(self._holds, default=self.offset)
+        if acked != self._acked and self.offset_file:
+            _write_atomic(self.offset_file, json.dumps({os.path.abspath(self.spool): acked}))
+        self._acked = acked
+
+    def submit(self, request, source=None):
+        """ Queue or coalesce a request for each set it names.
+
+        Every run the request is merged into holds source until it
+        finishes.
+        """
+        names = request.get('sets', [])
+        if isinstance(names, str):
+            names = [names]
+        if 'set' in request:
+            names = [request['set']] + list(names)
+        request_id = request.get('id', str(uuid.uuid4()))
+        for name in names:
+            if not name in self.deployments:
+                print("WARNING: Request {} names unknown set {}; skipping.".format(request_id, name))
+                continue
+            if 'id' in request and self.ledger is not None and self.ledger.served(name, request_id):
+                print("Request {} for {} was already served; skipping.".format(request_id, name))
+                continue
+            entry = {
+                     'set': name,
+                     'ids': [request_id],
+                     'revision': request.get('revision'),
+                     'force': bool(request.get('force', False)),
+                     'sources': []}
+            if source is not None:
+                self._hold(source)
+                entry['sources'].append(source)
+            running = self.running.get(name)
+            if name in self.queued:
+                self._merge(self.queued[name], entry)
+            elif running is not None and entry['revision'] is not None and entry['revision'] == running['revision']:
+                self._merge(running, entry)
+            elif running is not None:
+                if name in self.follow_up:
+                    self._merge(self.follow_up[name], entry)
+                else:
+                    self.follow_up[name] = entry
+            else:
+                self.queued[name] = entry
+
+    @staticmethod
+    def _merge(entry, newer):
+        # The newest revision supersedes the ones before it
+        entry['ids'] += newer['ids']
+        entry['sources'] += newer['sources']
+        entry['force'] = entry['force'] or newer['force']
+        if newer['revision'] is not None:
+            entry['revision'] = newer['revision']
+
+    def _dispatch(self, executor):
+        busy = set(self.queued) | set(self.running)
+        finished = [name for name in self.deployments if not name in busy]
+        for name in list(self.queued):
+            if len(self.running) >= self.scheduler.max_parallel:
+                break
+            deployment = self.deployments[name]
+            others = [self.deployments[other] for other in self.running]
+            if self.scheduler._can_start(deployment, finished, others):
+                entry = self.queued.pop(name)
+                self.running[name] = entry
+                self._futures[executor.submit(self.task, deployment, entry)] = name
+
+    def _reap(self, done):
+        for future in done:
+            name = self._futures.pop(future)
+            entry = self.running.pop(name)
+            try:
+                future.result()
+            except Exception as err:
+                print("ERROR: deployment {} failed for requests {}: {}".format(name, entry['ids'], err))
+            else:
+                print("Deployment {} finished requests {}.".format(name, entry['ids']))
+                if self.ledger is not None:
+                    self.ledger.record_requests(name, entry['ids'])
+            self.release(entry['sources'])
+            if name in self.follow_up:
+                follow_up = self.follow_up.pop(name)
+                if name in self.queued:
+                    self._merge(self.queued[name], follow_up)
+                else:
+                    self.queued[name] = follow_up
+
+    def run(self, stop):
+        """ Serve requests until stop is set, then let running sets finish.
+
+        Queued and follow-up requests that never started are written
+        back to the spool, so the next daemon picks them up.
+
+        args:
+            stop (threading.Event): Set to shut down
+        """
+        print("Watching {} for deployment requests.".format(self.spool))
+        with ThreadPoolExecutor(max_workers = self.scheduler.max_parallel) as executor:
+            while not stop.is_set():
+                requests = self.read()
+                for request, source in requests:
+                    self.submit(request, source)
+                self.release([source for request, source in requests])
+                self._dispatch(executor)
+                if self._futures:
+                    done, _ = wait(self._futures, timeout = self.poll_interval, return_when = FIRST_COMPLETED)
+                    self._reap(done)
+                else:
+                    stop.wait(self.poll_interval)
+            if self._futures:
+                print("Waiting for {} to finish.".format(sorted(self.running)))
+                self._reap(wait(self._futures)[0])
+        self._requeue(list(self.queued.values()) + list(self.follow_up.values()))
+
+    def _requeue(self, entries):
+        if not entries:
+            return
+        lines = "".join(
+                        json.dumps({
+                                    'set': entry['set'],
+                                    'id': ",".join(entry['ids']),
+                                    'revision': entry['revision'],
+                                    'force': entry['force']}) + "\n"
+                        for entry in entries)
+        if os.path.isdir(self.spool):
+            path = os.path.join(self.spool, unique_name('requeued') + '.jsonl')
+            _write_atomic(path, lines)
+        else:
+            with open(self.spool, 'a') as fh:
+                fh.write(lines)
+        print("Returned {} unstarted requests to {}.".format(len(entries), self.spool))
+        self.release([source for entry in entries for source in entry['sources']])
+
 def parse_args(args):
 
     parser = argparse.ArgumentParser()
@@ -370,7 +3864,134 @@ def parse_args(args):
                         dest = 'dry_run',
                         default = False,
                         action = 'store_true',
-                        help = 'Do not make system calls when running.')
+                        help = 'Print every set\'s phases, commands and Compute calls with estimated '
+                               'durations and the critical path, without running anything.')
+    parser.add_argument(
+                        '--parallel',
+                        dest = 'parallel',
+                        default = 1,
+                        type = int,
+                        help = 'Maximum number of sets to deploy concurrently.')
+    parser.add_argument(
+                        '--parallel-per-network',
+                        dest = 'parallel_per_network',
+                        default = None,
+                        type = int,
+                        help = 'Maximum number of concurrent sets per network/project.')
+    parser.add_argument(
+                        '--state-dir',
+                        dest = 'state_dir',
+                        default = '.sprout',
+                        type = str,
+                        help = 'Directory for sprout run records.')
+    parser.add_argument(
+                        '--force',
+                        dest = 'force',
+                        default = False,
+                        action = 'store_true',
+                        help = 'Run sets even if nothing changed since their last successful run.')
+    parser.add_argument(
+                        '--plugin-cache-dir',
+                        dest = 'plugin_cache_dir',
+                        default = None,
+                        type = str,
+                        help = 'Provider cache shared by all roots (default <state-dir>/plugin-cache).')
+    parser.add_argument(
+                        '--provider-mirror',
+                        dest = 'provider_mirror',
+                        default = None,
+                        type = str,
+                        help = 'Local filesystem mirror to install providers from.')
+    parser.add_argument(
+                        '--skip-init',
+                        dest = 'skip_init',
+                        default = False,
+                        action = 'store_true',
+                        help = 'Do not run terraform init; roots must already be initialized.')
+    parser.add_argument(
+                        '--log-dir',
+                        dest = 'log_dir',
+                        default = None,
+                        type = str,
+                        help = 'Directory for per-set logs and events.jsonl (default <state-dir>/logs).')
+    parser.add_argument(
+                        '--metrics-dir',
+                        dest = 'metrics_dir',
+                        default = None,
+                        type = str,
+                        help = 'Directory for metrics.json and sprout.prom (default <state-dir>).')
+    parser.add_argument(
+                        '--resume',
+                        dest = 'resume',
+                        default = False,
+                        action = 'store_true',
+                        help = 'Continue the last run from the phase each set failed in, skipping finished sets.')
+    parser.add_argument(
+                        '--rollback',
+                        dest = 'rollback',
+                        default = [],
+                        action = 'append',
+                        metavar = 'SET',
+                        help = 'Point the image family of a load balancer set back at its previous image '
+                               'and refresh the instance group, instead of deploying. Repeatable.')
+    parser.add_argument(
+                        '--parallelism-budget',
+                        dest = 'parallelism_budget',
+                        default = None,
+                        type = int,
+                        help = 'Concurrent Terraform resource operations shared by all running sets; each plan, '
+                               'apply and destroy gets a -parallelism sized to its resource count from this budget.')
+    parser.add_argument(
+                        '--max-parallelism',
+                        dest = 'max_parallelism',
+                        default = None,
+                        type = int,
+                        help = 'Largest -parallelism for one set (default the whole --parallelism-budget).')
+    parser.add_argument(
+                        '--daemon',
+                        dest = 'daemon',
+                        default = None,
+                        type = str,
+                        metavar = 'SPOOL',
+                        help = 'Keep running and deploy the sets named by requests appended to this JSON-lines '
+                               'file or dropped into this directory, coalescing requests for the same set.')
+    parser.add_argument(
+                        '--poll-interval',
+                        dest = 'poll_interval',
+                        default = 2.0,
+                        type = float,
+                        help = 'Seconds between reads of the --daemon spool.')
+    parser.add_argument(
+                        '--mode',
+                        dest = 'mode',
+                        default = 'minimal',
+                        choices = DEPLOY_MODES,
+                        help = 'Default for sets without a "mode" key: "minimal" applies changes in place '
+                               '(with each set\'s "replace"/"target" lists), "full" destroys and rebuilds.')
+    parser.add_argument(
+                        '--api-rate',
+                        dest = 'api_rate',
+                        default = 20.0,
+                        type = float,
+                        help = 'Compute API requests per second per project (0 for no limit).')
+    parser.add_argument(
+                        '--api-region-rate',
+                        dest = 'api_region_rate',
+                        default = None,
+                        type = float,
+                        help = 'Compute API requests per second per project and region.')
+    parser.add_argument(
+                        '--api-burst',
+                        dest = 'api_burst',
+                        default = None,
+                        type = int,
+                        help = 'Requests allowed at once before the API rate applies (default one second\'s worth).')
+    parser.add_argument(
+                        '--compute-url',
+                        dest = 'compute_url',
+                        default = None,
+                        type = str,
+                        help = 'Root URL of a Compute API stand-in, e.g. http://127.0.0.1:8089/ for fake_compute.py.')
 
     if len(args) < 1:
         parser.print_help(sys.stderr)
@@ -384,42 +4005,139 @@ def main():
     if sys.version_info[0] < 3:
         raise "Must be using Python 3"
 
-    # Create Google compute API service object
-    #compute = googleapiclient.discovery.build('compute', 'v1')
-    compute = ComputeOperator()
-
     # Parse command-line arguments
     args = parse_args(sys.argv[1:])
     config_file = args.config_file
     dry_run = args.dry_run
 
+    # Create Google compute API service object; it connects on first use
+    #compute = googleapiclient.discovery.build('compute', 'v1')
+    rate_limiter.configure(args.api_rate, args.api_region_rate, args.api_burst)
+    compute = ComputeOperator(
+                              base_url = args.compute_url,
+                              discovery_cache = os.path.join(args.state_dir, 'discovery'))
+
+    import yaml
     with open(config_file) as config_fh:
-        config = yaml.load(config_fh)
+        config = yaml.safe_load(config_fh)
     deployment_sets = config['terraform_sets']
 
     # Create deployment objects from config file
+    tfvars = TfvarsCache(os.path.join(args.state_dir, 'tfvars-cache.json'))
     deployments = []
     for config in deployment_sets:
         # Config object is a dictionary with deployment info
         #print(config, "\n")
-        deployment = get_deployment_object(config, compute)
+        deployment = get_deployment_object(config, compute, tfvars, args.mode)
         deployments.append(deployment)
     #print(deployments)
+    if not dry_run:
+        tfvars.save()
 
     # Make system calls to run Terraform
+    scheduler = DeploymentScheduler(
+                                    deployments,
+                                    max_parallel = args.parallel,
+                                    max_per_network = args.parallel_per_network)
+    initializer = None
+    if not args.skip_init:
+        plugin_cache_dir = args.plugin_cache_dir
+        if not plugin_cache_dir:
+            plugin_cache_dir = os.path.join(args.state_dir, 'plugin-cache')
+        initializer = TerraformInit(
+                                    plugin_cache_dir,
+                                    provider_mirror = args.provider_mirror,
+                                    cli_config = os.path.join(args.state_dir, 'terraformrc'))
+        # environment() writes the CLI config and creates the cache
+        if not dry_run:
+            env = initializer.environment()
+            for deployment in deployments:
+                deployment.env.update(env)
+    metrics_dir = args.metrics_dir
+    if not metrics_dir:
+        metrics_dir = args.state_dir
+    history = RunHistory(os.path.join(args.state_dir, 'history.json'))
+    if args.parallelism_budget:
+        budget = ParallelismBudget(
+                                   args.parallelism_budget,
+                                   concurrency = args.parallel,
+                                   maximum = args.max_parallelism,
+                                   history = history)
+        for deployment in deployments:
+            deployment.parallelism = budget
+    if dry_run:
+        plan = ExecutionPlan(
+                             scheduler,
+                             history,
+                             initializer = initializer,
+                             ledger = None if args.force else RunLedger(os.path.join(args.state_dir, 'ledger.json')))
+        plan.render()
+        _write_atomic(os.path.join(metrics_dir, 'execution-plan.json'), json.dumps(plan.to_dict(), indent=2))
+        return
+    log_dir = args.log_dir
+    if not log_dir:
+        log_dir = os.path.join(args.state_dir, 'logs')
+    output = OutputWriter(log_dir)
     for deployment in deployments:
-        print(deployment)
-        if isinstance(deployment, BalancerDeployment):
-            print("Launching load balancer deployment")
-            deployment.plan(dry_run, timeout=60)
-            deployment.destroy(dry_run, timeout=300)
-            deployment.apply(dry_run, timeout=1200)
-            #deployment.load_to_balancer(compute, dry_run)
-        elif isinstance(deployment, BaseDeployment):
-            print("Launching base deployment")
-            deployment.plan(dry_run, timeout=60)
-            deployment.destroy(dry_run, timeout=300)
-            deployment.apply(dry_run, timeout=1200)
+        deployment.output = output
+    if args.rollback:
+        # Roll image families back instead of deploying
+        by_name = {deployment.name: deployment for deployment in deployments}
+        try:
+            for name in args.rollback:
+                if not name in by_name:
+                    raise ValueError("Unknown terraform set {}.".format(name))
+                by_name[name].rollback_image(compute)
+        finally:
+            output.close()
+        return
+    ledger = RunLedger(os.path.join(args.state_dir, 'ledger.json'))
+    save_lock = threading.Lock()
+
+    def save_metrics():
+        # Summaries cover the whole process; spans are written and
+        # recorded in the history once, then dropped
+        with save_lock:
+            metrics.write_json(os.path.join(metrics_dir, 'metrics.json'))
+            metrics.write_prometheus(os.path.join(metrics_dir, 'sprout.prom'))
+            history.record(metrics.drain())
+
+    def serve(deployment, request):
+        try:
+            run_deployment(deployment, dry_run, ledger, args.force or request['force'], initializer)
+        finally:
+            save_metrics()
+
+    try:
+        if args.daemon:
+            # Finish running sets on Ctrl-C or SIGTERM; queued requests go back to the spool
+            stop = threading.Event()
+            for signum in [signal.SIGINT, signal.SIGTERM]:
+                signal.signal(signum, lambda signum, frame: stop.set())
+            daemon = SpoolDaemon(
+                                 args.daemon,
+                                 deployments,
+                                 serve,
+                                 max_parallel = args.parallel,
+                                 max_per_network = args.parallel_per_network,
+                                 poll_interval = args.poll_interval,
+                                 offset_file = os.path.join(args.state_dir, 'spool-offset.json'),
+                                 ledger = ledger)
+            daemon.run(stop)
+        else:
+            journal = RunJournal(os.path.join(args.state_dir, 'journal.json'), resume = args.resume)
+            scheduler.run(lambda deployment: run_deployment(
+                                                            deployment,
+                                                            dry_run,
+                                                            ledger,
+                                                            args.force,
+                                                            initializer,
+                                                            journal))
+    finally:
+        # Let background image garbage collection finish
+        wait([future for deployment in deployments for future in getattr(deployment, 'cleanup', [])])
+        output.close()
+        save_metrics()
 
 if __name__ == "__main__":
     main()
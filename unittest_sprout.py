@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
 
+import io
+import os
+import sys
 import mock
+import json
 import uuid
 import yaml
+import asyncio
 import unittest
+import tempfile
+import threading
+import subprocess
 
 from time import sleep
 from pprint import pprint
@@ -12,14 +20,50 @@ import googleapiclient.discovery as googleapi
 from googleapiclient.errors import HttpError
 from oauth2client.client import GoogleCredentials
 
+from sprout import main
 from sprout import parse_args
-from sprout import TerraformDeployment
+from sprout import get_deployment_object
+from sprout import BaseDeployment
+from sprout import BalancerDeployment
+from sprout import DeploymentScheduler
+from sprout import run_deployment
+from sprout import RunLedger
+from sprout import RunJournal
+from sprout import RunHistory
+from sprout import ExecutionPlan
+from sprout import SpoolDaemon
+from sprout import ParallelismBudget
+from sprout import TfvarsCache
+from sprout import TerraformInit
+from sprout import OutputWriter
+from sprout import RunMetrics
+from sprout import RateLimiter
+from sprout import is_transient_error
+from sprout import wait_for_status as sprout_wait_for_status
+from sprout import async_wait_for_status
+from sprout import AsyncComputeOperator
 from sprout import ComputeOperator
 
-class TestTerraformDeployment(unittest.TestCase):
+from fake_compute import ApiError, FakeCompute, start_server
 
-    @mock.patch('sprout.call')
-    def test_basic_tf_plan_call(self, mock_call):
+def fake_popen(returncode, output=b''):
+    """ subprocess.Popen stand-in for terraform.
+
+    returncode and output may be functions of the command arguments.
+    """
+    def popen(arguments, **kwargs):
+        process = mock.Mock()
+        process.stdout = io.BytesIO(output(arguments) if callable(output) else output)
+        process.returncode = returncode(arguments) if callable(returncode) else returncode
+        process.wait.return_value = process.returncode
+        return process
+    return popen
+
+
+class TestBaseDeployment(unittest.TestCase):
+
+    @mock.patch('sprout.subprocess.Popen', side_effect=fake_popen(0))
+    def test_basic_tf_plan_call(self, mock_popen):
         name = 'development'
         var_files = ['test.tfvars']
         state_file = 'tfstate-files/test.tfstate'
@@ -31,12 +75,13 @@ class TestTerraformDeployment(unittest.TestCase):
                            "-var-file={}".format(var_files[0]),
                            "-state={}".format(state_file)]
 
-        deployment = TerraformDeployment(
-                                         name = name,
-                                         var_files = var_files, 
-                                         state_file = state_file)
-        deployment.plan(dry_run = False)
-        mock_call.assert_called_with(basic_plan_call)
+        deployment = BaseDeployment(
+                                    root = '.',
+                                    name = name,
+                                    var_files = var_files,
+                                    state_file = state_file)
+        deployment.plan(dry_run = False, timeout = 60)
+        self.assertTrue(mock_popen.call_args[0][0] == basic_plan_call)
 
     def test_read_yaml_config(self):
         """ Test formatting of sprout config file.
@@ -44,7 +89,7 @@ class TestTerraformDeployment(unittest.TestCase):
         config_file = 'sprout_unittest.yaml'
 
         with open(config_file) as config_fh:
-            config = yaml.load(config_fh)
+            config = yaml.safe_load(config_fh)
         self.assertTrue(len(config['terraform_sets']) == 1)
 
         dev_set = config['terraform_sets'][0]
@@ -287,6 +332,1183 @@ class ParseArgsTestCase(unittest.TestCase):
         args = parse_args(['--config', 'sprout_unittest.yaml'])
         self.assertTrue(args.config_file == "sprout_unittest.yaml")
 
+    def test_parallel_args(self):
+        args = parse_args(['--config', 'sprout_unittest.yaml', '--parallel', '4'])
+        self.assertTrue(args.parallel == 4)
+        self.assertTrue(args.parallel_per_network is None)
+
+
+class TestImportTime(unittest.TestCase):
+
+    # Cumulative microseconds for "import sprout"; measured ~60 ms
+    # with the Compute API imports deferred, ~150 ms before.
+    BUDGET = 250000
+    DEFERRED = ['googleapiclient', 'oauth2client', 'httplib2', 'hcl', 'yaml', 'pdb']
+
+    def test_import_budget(self):
+        here = os.path.dirname(os.path.abspath(__file__))
+        result = subprocess.run(
+                                [sys.executable, '-X', 'importtime', '-c',
+                                 "import sprout; sprout.parse_args(['--config', 'sprout.yaml', '--dry-run'])"],
+                                cwd = here,
+                                stdout = subprocess.PIPE,
+                                stderr = subprocess.PIPE,
+                                universal_newlines = True,
+                                check = True)
+        cumulative = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, total, name = line.split('|')
+            cumulative[name.strip()] = int(total)
+        for module in cumulative:
+            self.assertFalse(module.split('.')[0] in self.DEFERRED, module)
+        self.assertTrue(cumulative['sprout'] < self.BUDGET, cumulative['sprout'])
+
+
+class TestSavedPlan(unittest.TestCase):
+
+    def deployment(self, **options):
+        return BaseDeployment('/tmp', '/tmp/dev.tfstate', ['dev.tfvars'], name='dev', **options)
+
+    @mock.patch('sprout.subprocess.Popen', side_effect=fake_popen(0))
+    def test_no_changes_skips_apply(self, mock_run):
+        run_deployment(self.deployment(), dry_run=False)
+        self.assertTrue(mock_run.call_count == 1)
+        arguments = mock_run.call_args[0][0]
+        self.assertTrue(arguments[:4] == ['terraform', 'plan', '-detailed-exitcode', '-out=/tmp/dev.tfplan'])
+
+    @mock.patch('sprout.subprocess.Popen', side_effect=fake_popen(lambda arguments: 2 if arguments[1] == 'plan' else 0))
+    def test_changes_apply_saved_plan(self, mock_run):
+        run_deployment(self.deployment(mode='full'), dry_run=False)
+        commands = [call[0][0] for call in mock_run.call_args_list]
+        self.assertTrue([command[1] for command in commands] == ['plan', 'destroy', 'plan', 'apply'])
+        self.assertTrue(commands[-1] == ['terraform', 'apply', '-state=/tmp/dev.tfstate', '/tmp/dev.tfplan'])
+
+    @mock.patch('sprout.subprocess.Popen', side_effect=fake_popen(lambda arguments: 2 if arguments[1] == 'plan' else 0))
+    def test_minimal_replaces_in_place(self, mock_run):
+        deployment = self.deployment(replace=['google_compute_instance.node[0]'], target=['module.web'])
+        run_deployment(deployment, dry_run=False)
+        commands = [call[0][0] for call in mock_run.call_args_list]
+        self.assertTrue([command[1] for command in commands] == ['plan', 'apply'])
+        self.assertTrue(commands[0][2:6] == [
+                                             '-detailed-exitcode',
+                                             '-out=/tmp/dev.tfplan',
+                                             '-replace=google_compute_instance.node[0]',
+                                             '-target=module.web'])
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            self.deployment(mode='rebuild')
+
+    @mock.patch('sprout.subprocess.Popen', side_effect=fake_popen(1))
+    def test_plan_error(self, mock_run):
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.deployment().plan(dry_run=False, timeout=60, plan_file='/tmp/dev.tfplan')
+
+
+class TestRunLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.root = self.tempdir.name
+        with open(os.path.join(self.root, 'main.tf'), 'w') as fh:
+            fh.write('resource "null_resource" "a" {}\n')
+        with open(os.path.join(self.root, 'dev.tfvars'), 'w') as fh:
+            fh.write('version = "1"\n')
+        self.deployment = BaseDeployment(self.root, 'dev.tfstate', ['dev.tfvars'], name='dev')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    @mock.patch('sprout.terraform_version', return_value='Terraform v0.11.14')
+    def test_fingerprint_changes(self, mock_version):
+        before = self.deployment.fingerprint()
+        self.assertTrue(before == self.deployment.fingerprint())
+        with open(os.path.join(self.root, 'dev.tfvars'), 'w') as fh:
+            fh.write('version = "2"\n')
+        self.assertTrue(before != self.deployment.fingerprint())
+
+    @mock.patch('sprout.terraform_version', return_value='Terraform v0.11.14')
+    @mock.patch('sprout.subprocess.Popen', side_effect=fake_popen(0))
+    def test_unchanged_set_is_skipped(self, mock_run, mock_version):
+        ledger = RunLedger(os.path.join(self.root, '.sprout', 'ledger.json'))
+        run_deployment(self.deployment, dry_run=False, ledger=ledger)
+        self.assertTrue(mock_run.call_count == 1)
+
+        ledger = RunLedger(os.path.join(self.root, '.sprout', 'ledger.json'))
+        run_deployment(self.deployment, dry_run=False, ledger=ledger)
+        self.assertTrue(mock_run.call_count == 1)
+        run_deployment(self.deployment, dry_run=False, ledger=ledger, force=True)
+        self.assertTrue(mock_run.call_count == 2)
+
+    @mock.patch('sprout.subprocess.run')
+    @mock.patch('sprout.subprocess.Popen')
+    def test_dry_run_uses_recorded_version(self, mock_popen, mock_run):
+        state_dir = os.path.join(self.root, '.sprout')
+        ledger = RunLedger(os.path.join(state_dir, 'ledger.json'))
+        ledger.record('dev', self.deployment.fingerprint('Terraform v0.15.5'), terraform='Terraform v0.15.5')
+        ledger.record('old', 'abc')
+        config = os.path.join(self.root, 'sets.yaml')
+        with open(config, 'w') as fh:
+            fh.write('terraform_sets:\n' + ''.join(
+                                                   '- {{root: {}, state-file: dev.tfstate, var-files: [dev.tfvars], load-balancer: false, name: {}}}\n'.format(self.root, name)
+                                                   for name in ['dev', 'old', 'new']))
+        before = sorted(os.listdir(state_dir))
+        argv = ['sprout.py', '--config', config, '--state-dir', state_dir, '--dry-run']
+        with mock.patch('sys.argv', argv), mock.patch('sys.stdout'):
+            main()
+        self.assertFalse(mock_run.called or mock_popen.called)
+        # Only the plan is written; no CLI config, plugin cache or tfvars cache
+        self.assertTrue(sorted(os.listdir(state_dir)) == sorted(before + ['execution-plan.json']))
+        with open(os.path.join(state_dir, 'execution-plan.json')) as fh:
+            sets = {entry['name']: entry for entry in json.load(fh)['sets']}
+        self.assertTrue(sets['dev']['skipped'] and sets['dev']['ledger'] == 'unchanged')
+        self.assertTrue(sets['old']['ledger'] == 'unknown' and not sets['old']['skipped'])
+        self.assertTrue(sets['new']['ledger'] == 'changed')
+
+
+class TestRetries(unittest.TestCase):
+
+    def deployment(self, **options):
+        return BaseDeployment('/tmp', '/tmp/dev.tfstate', ['dev.tfvars'], name='dev', **options)
+
+    @mock.patch('sprout.idle')
+    def test_state_lock_is_retried(self, mock_idle):
+        returncodes = [1, 0]
+        output = lambda arguments: b'Error: Error acquiring the state lock\n' if returncodes[0] else b''
+        with mock.patch('sprout.subprocess.Popen', side_effect=fake_popen(lambda arguments: returncodes.pop(0), output)) as mock_run:
+            self.deployment().destroy(dry_run=False, timeout=60)
+        self.assertTrue(mock_run.call_count == 2)
+        self.assertTrue(mock_idle.call_count == 1)
+
+    @mock.patch('sprout.idle')
+    @mock.patch('sprout.subprocess.Popen', side_effect=fake_popen(1, b'Error: Invalid reference\n'))
+    def test_permanent_error_fails_fast(self, mock_run, mock_idle):
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.deployment().destroy(dry_run=False, timeout=60)
+        self.assertTrue(mock_run.call_count == 1)
+        self.assertTrue(mock_idle.call_count == 0)
+
+    @mock.patch('sprout.idle')
+    def test_apply_retry_plans_with_plan_timeout(self, mock_idle):
+        returncodes = [2, 1, 2, 0]
+        output = lambda arguments: b'Error: Error acquiring the state lock\n' if arguments[1] == 'apply' else b''
+        deployment = self.deployment()
+        with mock.patch('sprout.subprocess.Popen', side_effect=fake_popen(lambda arguments: returncodes.pop(0), output)):
+            with mock.patch.object(deployment, '_run_command', wraps=deployment._run_command) as mock_command:
+                deployment.plan(dry_run=False, timeout=900, plan_file='/tmp/dev.tfplan')
+                deployment.apply(dry_run=False, timeout=1200, plan_file='/tmp/dev.tfplan')
+        timeouts = [(call[0][1], call[0][2]) for call in mock_command.call_args_list]
+        self.assertTrue(timeouts == [('plan', 900), ('apply', 1200), ('plan', 900), ('apply', 1200)])
+
+
+class TestRunJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'journal.json')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_resume_from_failed_phase(self):
+        deployment = BaseDeployment('/tmp', '/tmp/dev.tfstate', ['dev.tfvars'], name='dev', mode='full')
+        failing = fake_popen(lambda arguments: {'plan': 2, 'apply': 1}.get(arguments[1], 0))
+        with mock.patch('sprout.subprocess.Popen', side_effect=failing):
+            with self.assertRaises(subprocess.CalledProcessError):
+                run_deployment(deployment, dry_run=False, journal=RunJournal(self.path))
+        journal = RunJournal(self.path, resume=True)
+        self.assertTrue(journal.completed('dev') == ['plan', 'destroy'])
+        self.assertTrue(journal.sets['dev']['failed'] == 'apply')
+
+        passing = fake_popen(lambda arguments: 2 if arguments[1] == 'plan' else 0)
+        with mock.patch('sprout.subprocess.Popen', side_effect=passing) as mock_run:
+            run_deployment(deployment, dry_run=False, journal=journal)
+        commands = [call[0][0][1] for call in mock_run.call_args_list]
+        self.assertTrue(commands == ['plan', 'apply'])
+        self.assertTrue(RunJournal(self.path, resume=True).is_done('dev'))
+        self.assertTrue(not RunJournal(self.path).is_done('dev'))
+
+    def test_load_balancer_phase_follows_apply(self):
+        tfvars = mock.Mock()
+        tfvars.merged.return_value = {
+                                      'project': 'p',
+                                      'zone': 'z',
+                                      'instance_name': 'source',
+                                      'template_image': 'image',
+                                      'instance_group': 'group'}
+        deployment = BalancerDeployment(mock.Mock(), '/tmp', '/tmp/lb.tfstate', ['lb.tfvars'], name='lb', tfvars=tfvars)
+        passing = fake_popen(lambda arguments: 2 if arguments[1] == 'plan' else 0)
+        # The phase only runs for sets that opt in with refresh-group
+        with mock.patch('sprout.subprocess.Popen', side_effect=passing):
+            with mock.patch.object(deployment, 'load_to_balancer') as mock_load:
+                run_deployment(deployment, dry_run=False)
+        self.assertFalse(mock_load.called)
+
+        deployment.refresh = True
+        with mock.patch('sprout.subprocess.Popen', side_effect=passing):
+            with mock.patch.object(deployment, 'load_to_balancer', side_effect=ConnectionError('reset')) as mock_load:
+                with self.assertRaises(ConnectionError):
+                    run_deployment(deployment, dry_run=False, journal=RunJournal(self.path))
+        # Baking and refreshing the group is not repeated on errors
+        self.assertTrue(mock_load.call_count == 1)
+        journal = RunJournal(self.path, resume=True)
+        self.assertTrue(journal.completed('lb') == ['plan', 'apply'])
+        self.assertTrue(journal.sets['lb']['failed'] == 'load-balancer')
+
+        with mock.patch('sprout.subprocess.Popen', side_effect=passing) as mock_run:
+            with mock.patch.object(deployment, 'load_to_balancer') as mock_load:
+                run_deployment(deployment, dry_run=False, journal=journal)
+        self.assertFalse(mock_run.called)
+        mock_load.assert_called_once_with(deployment.compute, False)
+
+
+class TestTfvarsCache(unittest.TestCase):
+
+    @mock.patch('hcl.load', side_effect=lambda fh: {'file': fh.name})
+    def test_files_parsed_once(self, mock_load):
+        cache = TfvarsCache()
+        first = cache.merged(['test_a.tfvars', 'test_b.tfvars'])
+        second = cache.merged(['test_a.tfvars', 'test_b.tfvars'])
+        cache.merged(['test_b.tfvars'])
+        self.assertTrue(first is second)
+        self.assertTrue(first['file'] == 'test_b.tfvars')
+        self.assertTrue(mock_load.call_count == 2)
+
+    @mock.patch('hcl.load', return_value={'aws_region': 'us-east-1'})
+    def test_persisted_between_runs(self, mock_load):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'tfvars-cache.json')
+            cache = TfvarsCache(path)
+            cache.load('test_a.tfvars')
+            cache.save()
+
+            cache = TfvarsCache(path)
+            self.assertTrue(cache.load('test_a.tfvars') == {'aws_region': 'us-east-1'})
+            self.assertTrue(mock_load.call_count == 1)
+
+
+class TestOutputWriter(unittest.TestCase):
+
+    @mock.patch('sprout.subprocess.Popen', side_effect=fake_popen(0, output=(
+                                                                             b'Refreshing state...\n'
+                                                                             b'\x1b[1mApply complete! Resources: 2 added, 0 changed, 1 destroyed.\x1b[0m\n')))
+    def test_prefixed_output_and_events(self, mock_popen):
+        with tempfile.TemporaryDirectory() as log_dir:
+            console = io.StringIO()
+            output = OutputWriter(log_dir, stream=console)
+            deployment = BaseDeployment('/tmp', '/tmp/dev.tfstate', [], name='dev')
+            deployment.output = output
+            deployment.apply(dry_run=False, timeout=60)
+            output.close()
+
+            self.assertTrue('[dev] Refreshing state...' in console.getvalue())
+            with open(os.path.join(log_dir, 'dev.log')) as fh:
+                self.assertTrue('Apply complete! Resources: 2 added' in fh.read())
+            with open(os.path.join(log_dir, 'events.jsonl')) as fh:
+                events = [json.loads(line) for line in fh]
+            self.assertTrue([event['event'] for event in events] == ['phase_start', 'phase_end'])
+            self.assertTrue(events[1]['exit_code'] == 0)
+            self.assertTrue(events[1]['resources'] == {'add': 2, 'change': 0, 'destroy': 1})
+
+
+class TestTerraformInit(unittest.TestCase):
+
+    @mock.patch('sprout.subprocess.Popen')
+    def test_init_once_per_root(self, mock_run):
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, 'main.tf'), 'w') as fh:
+                fh.write('provider "google" {}\n')
+
+            def terraform(arguments, **kwargs):
+                os.makedirs(os.path.join(root, '.terraform'), exist_ok=True)
+                self.assertTrue(kwargs['env']['TF_PLUGIN_CACHE_DIR'].endswith('plugin-cache'))
+                return fake_popen(0)(arguments)
+            mock_run.side_effect = terraform
+
+            initializer = TerraformInit(os.path.join(root, 'plugin-cache'))
+            dev = BaseDeployment(root, 'dev.tfstate', [], name='dev')
+            staging = BaseDeployment(root, 'staging.tfstate', [], name='staging')
+            for deployment in [dev, staging]:
+                deployment.env.update(initializer.environment())
+                initializer.ensure(deployment, dry_run=False)
+            self.assertTrue(mock_run.call_count == 1)
+            self.assertTrue(mock_run.call_args[0][0] == ['terraform', 'init', '-input=false'])
+
+            # A later run skips init until the lock file changes
+            initializer = TerraformInit(os.path.join(root, 'plugin-cache'))
+            initializer.ensure(dev, dry_run=False)
+            self.assertTrue(mock_run.call_count == 1)
+            with open(os.path.join(root, '.terraform.lock.hcl'), 'w') as fh:
+                fh.write('provider "registry.terraform.io/hashicorp/google" {}\n')
+            TerraformInit(os.path.join(root, 'plugin-cache')).ensure(dev, dry_run=False)
+            self.assertTrue(mock_run.call_count == 2)
+
+    @mock.patch('sprout.subprocess.Popen')
+    def test_dry_run_does_not_mark_root_current(self, mock_run):
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, 'main.tf'), 'w') as fh:
+                fh.write('provider "google" {}\n')
+            initializer = TerraformInit(os.path.join(root, 'plugin-cache'))
+            initializer.ensure(BaseDeployment(root, 'dev.tfstate', [], name='dev'), dry_run=True)
+            self.assertFalse(mock_run.called)
+            self.assertFalse(initializer.is_current(root))
+            self.assertFalse(os.path.exists(os.path.join(root, '.terraform')))
+
+
+class TestDeleteInstances(unittest.TestCase):
+
+    @mock.patch('sprout.wait_for_status')
+    def test_batched_delete(self, mock_wait):
+        batches = []
+
+        class FakeBatch:
+            def __init__(self, callback):
+                self.callback = callback
+                self.calls = []
+                batches.append(self)
+            def add(self, request, request_id):
+                self.calls.append(request_id)
+            def execute(self, http=None):
+                for request_id in self.calls:
+                    self.callback(request_id, {'name': request_id, 'status': 'RUNNING'}, None)
+
+        compute = ComputeOperator.__new__(ComputeOperator)
+        compute.credentials = None
+        compute.client = mock.MagicMock()
+        compute.client.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback)
+
+        names = ['node-{}'.format(n) for n in range(5)]
+        compute.delete_instances(names, 'project', 'us-central1-a', batch_size=2)
+        self.assertTrue([len(batch.calls) for batch in batches] == [2, 2, 1])
+        # All operations are awaited together
+        self.assertTrue(mock_wait.call_count == 1)
+        operations = mock_wait.call_args[0][1]
+        self.assertTrue([op['name'] for op in operations] == names)
+
+    @mock.patch('sprout.wait_for_status')
+    def test_failed_deletes_are_reported_after_waiting(self, mock_wait):
+        class FakeBatch:
+            def __init__(self, callback):
+                self.callback = callback
+                self.calls = []
+            def add(self, request, request_id):
+                self.calls.append(request_id)
+            def execute(self, http=None):
+                for request_id in self.calls:
+                    if request_id == 'node-1':
+                        self.callback(request_id, None, PermissionError('denied'))
+                    else:
+                        self.callback(request_id, {'name': request_id, 'status': 'RUNNING'}, None)
+
+        compute = ComputeOperator.__new__(ComputeOperator)
+        compute.credentials = None
+        compute.client = mock.MagicMock()
+        compute.client.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback)
+
+        with self.assertRaises(RuntimeError) as error:
+            compute.delete_instances(['node-0', 'node-1', 'node-2'], 'project', 'us-central1-a')
+        self.assertTrue('node-1 (denied)' in str(error.exception))
+        # The deletes that started are still awaited
+        operations = mock_wait.call_args[0][1]
+        self.assertTrue([op['name'] for op in operations] == ['node-0', 'node-2'])
+
+
+class TestWaitForStatus(unittest.TestCase):
+
+    def operation(self, name, status):
+        return {
+                'kind': 'compute#operation',
+                'name': name,
+                'operationType': 'delete',
+                'status': status,
+                'zone': 'https://www.googleapis.com/compute/v1/projects/p/zones/us-central1-a',
+                'selfLink': 'https://www.googleapis.com/compute/v1/projects/p/zones/us-central1-a/operations/' + name}
+
+    def compute(self):
+        compute = mock.MagicMock()
+        compute._execute.side_effect = lambda request: request.execute()
+        return compute
+
+    def test_long_poll_wait(self):
+        compute = self.compute()
+        seconds = {'a': 0.3, 'b': 0.05}
+
+        def wait_request(project, zone, operation):
+            request = mock.Mock()
+            request.execute.side_effect = lambda: sleep(seconds[operation]) or self.operation(operation, 'DONE')
+            return request
+        compute.client.zoneOperations().wait.side_effect = wait_request
+        operations = [self.operation('a', 'RUNNING'), self.operation('b', 'PENDING')]
+        # Both are long-polled at once and come back in completion order,
+        # even with a timeout shorter than the long-poll window
+        finished = sprout_wait_for_status(compute, operations, timeout=60)
+        self.assertTrue([op['name'] for op in finished] == ['b', 'a'])
+        compute.client.zoneOperations().get.assert_not_called()
+
+    @mock.patch('sprout.sleep')
+    def test_polling_fallback(self, mock_sleep):
+        compute = self.compute()
+        compute.client.zoneOperations().wait().execute.side_effect = HttpError(mock.Mock(status=501), b'')
+        compute.client.zoneOperations().get().execute.side_effect = [
+                                                                      self.operation('a', 'RUNNING'),
+                                                                      self.operation('a', 'DONE')]
+        # APIs without operations.wait are polled
+        finished = sprout_wait_for_status(compute, self.operation('a', 'PENDING'), timeout=60, interval=4)
+        self.assertTrue(finished['status'] == 'DONE')
+        mock_sleep.assert_called_once_with(1)
+
+    @mock.patch('sprout.monotonic')
+    def test_timeout(self, mock_monotonic):
+        compute = self.compute()
+        mock_monotonic.side_effect = [0, 61]
+        with self.assertRaises(TimeoutError):
+            sprout_wait_for_status(compute, self.operation('a', 'RUNNING'), timeout=60)
+
+
+class TestRunMetrics(unittest.TestCase):
+
+    @mock.patch('sprout.sleep')
+    def test_span_counts_and_export(self, mock_sleep):
+        compute = ComputeOperator.__new__(ComputeOperator)
+        compute.credentials = None
+        compute.client = mock.MagicMock()
+        compute.client.instanceGroupManagers().listManagedInstances().execute.side_effect = [
+                                                                                             {'managedInstances': []},
+                                                                                             {'managedInstances': [{
+                                                                                                                    'instanceStatus': 'RUNNING',
+                                                                                                                    'currentAction': 'NONE'}]}]
+        compute.client.instanceGroupManagers().listManagedInstances_next.return_value = None
+        run_metrics = RunMetrics()
+        with mock.patch('sprout.metrics', run_metrics):
+            with run_metrics.span('phase', 'load-balancer', set='staging'):
+                compute.wait_for_group_stable('group', 'project', 'zone', target_size=1, interval=2)
+
+        summary = {total['name']: total for total in run_metrics.summary()}
+        self.assertTrue(summary['wait_for_group_stable']['labels'] == {'set': 'staging'})
+        self.assertTrue(summary['load-balancer']['requests'] == 2)
+        self.assertTrue(summary['load-balancer']['polls'] == 1)
+        self.assertTrue(summary['load-balancer']['sleep'] == 2)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'sprout.prom')
+            run_metrics.write_prometheus(path)
+            with open(path) as fh:
+                text = fh.read()
+        self.assertTrue('sprout_span_api_requests{kind="compute",name="wait_for_group_stable",set="staging"} 2' in text)
+
+    def test_drain_keeps_totals(self):
+        run_metrics = RunMetrics()
+        for attempt in range(3):
+            with run_metrics.span('phase', 'plan', set='dev'):
+                pass
+        self.assertTrue(len(run_metrics.drain()) == 3)
+        with run_metrics.span('phase', 'plan', set='dev'):
+            pass
+        self.assertTrue(len(run_metrics.spans) == 1)
+        self.assertTrue(run_metrics.summary()[0]['count'] == 4)
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'metrics.json')
+            run_metrics.write_json(path)
+            with open(path) as fh:
+                report = json.load(fh)
+        self.assertTrue(len(report['spans']) == 1 and report['summary'][0]['count'] == 4)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_buckets(self):
+        limiter = RateLimiter(project_rate=10, region_rate=2, burst=2)
+        keys = limiter.keys('https://compute.googleapis.com/compute/v1/projects/p/zones/us-central1-a/instances/x')
+        self.assertTrue(keys == [('project', 'p'), ('region', 'p/us-central1')])
+        waits = [limiter.reserve(keys) for _ in range(4)]
+        self.assertTrue(waits[:2] == [0, 0])
+        self.assertTrue(0.4 < waits[2] <= 0.5 and 0.9 < waits[3] <= 1.0)
+        # Other projects are not throttled
+        self.assertTrue(limiter.reserve([('project', 'q')]) == 0)
+
+    @mock.patch('sprout.sleep')
+    def test_execute_backs_off(self, mock_sleep):
+        limiter = RateLimiter(project_rate=100)
+        compute = ComputeOperator.__new__(ComputeOperator)
+        compute.credentials = None
+        compute.limiter = limiter
+        request = mock.MagicMock()
+        request.uri = 'https://compute.googleapis.com/compute/v1/projects/p/global/images'
+        request.execute.side_effect = [HttpError(mock.Mock(status=429), b'rateLimitExceeded'), {'items': []}]
+        run_metrics = RunMetrics()
+        with mock.patch('sprout.metrics', run_metrics):
+            with run_metrics.span('compute', 'list'):
+                self.assertTrue(compute._execute(request) == {'items': []})
+        span = run_metrics.spans[0]
+        self.assertTrue(span['rate_limited'] == 1 and span['throttle'] > 0)
+        self.assertTrue(mock_sleep.call_count == 1)
+
+    @mock.patch('sprout.sleep')
+    def test_execute_retries_idempotent_calls(self, mock_sleep):
+        compute = ComputeOperator.__new__(ComputeOperator)
+        compute.credentials = None
+        compute.limiter = RateLimiter(project_rate=100)
+        request = mock.MagicMock()
+        request.method = 'POST'
+        request.uri = 'https://compute.googleapis.com/compute/v1/projects/p/zones/z/instances/x/stop?requestId=1'
+        request.execute.side_effect = [HttpError(mock.Mock(status=503), b'backendError'), {'status': 'RUNNING'}]
+        self.assertTrue(compute._execute(request) == {'status': 'RUNNING'})
+
+        # Without a requestId the call might run twice
+        request.uri = 'https://compute.googleapis.com/compute/v1/projects/p/zones/z/instances/x/stop'
+        request.execute.side_effect = [HttpError(mock.Mock(status=503), b'backendError'), {'status': 'RUNNING'}]
+        with self.assertRaises(HttpError):
+            compute._execute(request)
+        self.assertFalse(is_transient_error(TimeoutError('Instance group did not stabilize')))
+
+
+class TestAsyncComputeOperator(unittest.TestCase):
+
+    def test_delete_instances_waits_together(self):
+        def operation(name, status):
+            return {
+                    'kind': 'compute#operation',
+                    'name': name,
+                    'operationType': 'delete',
+                    'status': status,
+                    'selfLink': 'https://compute.googleapis.com/compute/v1/projects/p/zones/z/operations/' + name}
+
+        async def call(method, path, params=None, body=None, long_poll=False):
+            name = path.split('/')[-1] if method == 'DELETE' else path.split('/')[-2]
+            if method == 'DELETE':
+                return operation(name, 'RUNNING')
+            # operations.wait; finish "b" first
+            await asyncio.sleep(0.01 if name == 'b' else 0.05)
+            return operation(name, 'DONE')
+
+        compute = AsyncComputeOperator(credentials=mock.MagicMock())
+        compute._call = call
+        deleted = asyncio.run(compute.delete_instances(['a', 'b'], 'p', 'z'))
+        self.assertTrue([op['name'] for op in deleted] == ['b', 'a'])
+        self.assertTrue(all(op['status'] == 'DONE' for op in deleted))
+
+        finished = asyncio.run(async_wait_for_status(
+                                                     compute,
+                                                     [operation('a', 'RUNNING'), operation('b', 'RUNNING')],
+                                                     timeout=60))
+        self.assertTrue([op['name'] for op in finished] == ['b', 'a'])
+
+
+class TestFakeCompute(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeCompute(operation_seconds=0.05, boot_seconds=0)
+        self.server = start_server(self.fake)
+        self.fake.add_instance('p', 'z', 'source')
+        self.fake.add_group('p', 'z', 'group', 3)
+        self.compute = ComputeOperator(base_url=self.server.root_url)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_image_from_stopped_source(self):
+        with self.assertRaises(HttpError) as error:
+            self.compute.create_image('image', 'zones/z/disks/source', 'p')
+        self.assertTrue(error.exception.resp.status == 400)
+
+        self.compute.stop_instance('source', 'p', 'z')
+        self.compute.create_image('image', 'zones/z/disks/source', 'p')
+        self.assertTrue(('p', 'image') in self.fake.images)
+
+    def test_failed_operation_raises(self):
+        self.compute.stop_instance('source', 'p', 'z')
+        failure = ApiError(403, 'quotaExceeded', "Quota 'IMAGES' exceeded")
+        with mock.patch.object(self.fake, 'add_image', side_effect=failure):
+            with self.assertRaises(RuntimeError) as error:
+                self.compute.create_image('image', 'zones/z/disks/source', 'p')
+            self.assertTrue('QUOTAEXCEEDED' in str(error.exception))
+
+            async def create():
+                compute = AsyncComputeOperator(base_url=self.server.root_url)
+                try:
+                    await compute.create_image('async-image', 'zones/z/disks/source', 'p')
+                finally:
+                    await compute.close()
+            with self.assertRaises(RuntimeError) as error:
+                asyncio.run(create())
+            self.assertTrue('QUOTAEXCEEDED' in str(error.exception))
+        self.assertFalse(('p', 'image') in self.fake.images)
+
+    def test_group_instances_are_recreated(self):
+        instances = self.compute.list_group_instances('group', 'p', 'z')
+        names = [instance['instance'].split('/')[-1] for instance in instances]
+        ids = [self.fake.instances[('p', 'z', name)]['id'] for name in names]
+        self.compute.delete_instances(names + ['missing'], 'p', 'z')
+        self.fake.tick()
+        self.assertTrue([self.fake.instances[('p', 'z', name)]['id'] for name in names] != ids)
+        self.assertTrue(self.fake.stats['methods']['instances.delete'] == 4)
+
+    def test_group_instances_are_paged_and_masked(self):
+        instances = list(self.compute.list_group_instances('group', 'p', 'z', page_size=2))
+        self.assertTrue(len(instances) == 3)
+        self.assertTrue(all(set(instance) == {'instance'} for instance in instances))
+        self.assertTrue(self.fake.stats['methods']['instanceGroups.listInstances'] == 2)
+
+        full = list(self.compute.list_group_instances('group', 'p', 'z', fields=None))
+        self.assertTrue(all(set(instance) == {'instance', 'status'} for instance in full))
+
+        self.fake.add_group('p', 'z', 'empty', 0)
+        self.assertTrue(list(self.compute.list_group_instances('empty', 'p', 'z')) == [])
+
+    def test_deletes_stream_while_listing(self):
+        self.fake.add_group('p', 'z', 'large', 5)
+        requests = []
+        execute = self.compute._execute
+
+        def logged(request, *args, **kwargs):
+            uri = getattr(request, 'uri', None)
+            requests.append('batch' if uri is None else 'list' if 'listInstances' in uri else 'other')
+            return execute(request, *args, **kwargs)
+
+        with mock.patch.object(self.compute, '_execute', side_effect=logged):
+            names = (instance['instance'].split('/')[-1] for instance in
+                     self.compute.list_group_instances('large', 'p', 'z', page_size=2))
+            self.compute.delete_instances(names, 'p', 'z', batch_size=2)
+        self.assertTrue(requests.count('list') == 3)
+        self.assertTrue(requests.index('batch') < len(requests) - 1 - requests[::-1].index('list'))
+        self.assertTrue(self.fake.stats['methods']['instances.delete'] == 5)
+
+    @mock.patch('sprout.backoff_delay', return_value=0.1)
+    def test_rate_limit_and_quota(self, mock_delay):
+        self.fake.rate_limit = 5
+        self.fake.burst = 1
+        self.fake._tokens = 1
+        list(self.compute.list_group_instances('group', 'p', 'z'))
+        list(self.compute.list_group_instances('group', 'p', 'z'))
+        self.assertTrue(self.fake.stats['rate_limited'] >= 1)
+
+        self.fake.rate_limit = None
+        self.fake.quotas = {'images': 0}
+        with self.assertRaises(HttpError) as error:
+            self.compute.create_image('image', 'zones/z/disks/source', 'p', force=True)
+        self.assertTrue(error.exception.resp.status == 403)
+        self.assertTrue(b'quotaExceeded' in error.exception.content)
+
+    @mock.patch('oauth2client.client.GoogleCredentials.get_application_default', side_effect=AssertionError('no credentials'))
+    def test_lazy_client_and_discovery_cache(self, mock_credentials):
+        ComputeOperator()
+        with tempfile.TemporaryDirectory() as cache:
+            compute = ComputeOperator(base_url=self.server.root_url, discovery_cache=cache)
+            list(compute.list_group_instances('group', 'p', 'z'))
+            self.assertTrue(len(os.listdir(cache)) == 1)
+
+            # A fresh operator builds its client from the cache
+            with mock.patch('httplib2.Http.request', side_effect=AssertionError('network')):
+                client = ComputeOperator(base_url=self.server.root_url, discovery_cache=cache).client
+            self.assertTrue(client.instanceGroups is not None)
+
+    def test_async_operator(self):
+        compute = AsyncComputeOperator(base_url=self.server.root_url)
+
+        async def run():
+            await compute.stop_instance('source', 'p', 'z')
+            await compute.create_image('image', 'zones/z/disks/source', 'p')
+            instances = [instance async for instance in compute.list_group_instances('group', 'p', 'z', page_size=2)]
+            await compute.close()
+            return instances
+        self.assertTrue(len(asyncio.run(run())) == 3)
+        self.assertTrue(('p', 'image') in self.fake.images)
+
+    def test_async_long_polls_have_their_own_limit(self):
+        self.fake.operation_seconds = 0.3
+        for name in ['a', 'b', 'c']:
+            self.fake.add_instance('p', 'z', name)
+        compute = AsyncComputeOperator(base_url=self.server.root_url, max_connections=1, max_long_polls=1)
+
+        async def run():
+            deleted = await compute.delete_instances(['a', 'b', 'c'], 'p', 'z')
+            await compute.close()
+            return deleted
+        self.assertTrue(len(asyncio.run(run())) == 3)
+        # While one operation long-polls, the others are polled with get
+        # rather than waiting for its slot or the only connection
+        methods = self.fake.stats['methods']
+        self.assertTrue(methods['zoneOperations.wait'] >= 1)
+        self.assertTrue(methods['zoneOperations.get'] >= 2)
+
+
+class TestImageFamily(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeCompute(operation_seconds=0.01, boot_seconds=0)
+        self.server = start_server(self.fake)
+        self.fake.add_instance('p', 'z', 'source')
+        self.fake.add_group('p', 'z', 'group', 2)
+        self.compute = ComputeOperator(base_url=self.server.root_url)
+        self.tempdir = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.tempdir.name, 'lb.tfvars'), 'w') as fh:
+            fh.write('project = "p"\nzone = "z"\ninstance_name = "source"\n'
+                     'template_image = "unused"\ninstance_group = "group"\n')
+        self.deployment = self.balancer(image_family='gims', image_retention=2)
+
+    def balancer(self, **options):
+        return BalancerDeployment(
+                                  self.compute,
+                                  self.tempdir.name,
+                                  'lb.tfstate',
+                                  [os.path.join(self.tempdir.name, 'lb.tfvars')],
+                                  name='lb',
+                                  stable_interval=0.05,
+                                  **options)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tempdir.cleanup()
+
+    def test_cleanup_keeps_unfinished_futures(self):
+        release = threading.Event()
+        for attempt in range(3):
+            self.deployment._background(sleep, 0)
+            self.deployment.cleanup[-1].result()
+        self.deployment._background(release.wait, 5)
+        self.assertTrue(len(self.deployment.cleanup) == 1)
+        release.set()
+        self.deployment.cleanup[0].result()
+
+    def family(self):
+        return self.compute.client.images().getFromFamily(project='p', family='gims').execute()['name']
+
+    def test_bake_collect_and_rollback(self):
+        baked = []
+        for _ in range(3):
+            self.deployment.load_to_balancer(self.compute, dry_run=False)
+            for future in self.deployment.cleanup:
+                future.result()
+            baked.append(self.family())
+        self.assertTrue(len(set(baked)) == 3)
+        self.assertTrue(sorted(name for project, name in self.fake.images) == sorted(baked[1:]))
+
+        self.deployment.rollback_image(self.compute)
+        self.assertTrue(self.family() == baked[1])
+        with self.assertRaises(ValueError):
+            self.deployment.rollback_image(self.compute)
+
+    def test_bake_without_stopping_source(self):
+        snapshot = self.balancer(image_family='gims', image_source='snapshot')
+        snapshot.bake_image(self.compute)
+        for future in snapshot.cleanup:
+            future.result()
+        self.assertTrue(self.fake.snapshots == {})
+
+        live = self.balancer(image_family='gims', image_source='live', flush_command='sync')
+        live.bake_image(self.compute)
+        self.assertTrue(len(self.fake.images) == 2)
+        self.assertTrue(self.fake.instances[('p', 'z', 'source')]['status'] == 'RUNNING')
+
+    def group_ids(self):
+        return [self.fake.instances.get(('p', 'z', name), {}).get('id') for name in self.fake.groups[('p', 'z', 'group')]['members']]
+
+    def test_recreate_waits_for_replacements(self):
+        self.fake.boot_seconds = 0.2
+        old = self.group_ids()
+        with mock.patch.object(self.compute, 'delete_instances', wraps=self.compute.delete_instances) as mock_delete:
+            with mock.patch.object(self.compute, 'wait_for_group_stable', wraps=self.compute.wait_for_group_stable) as mock_wait:
+                ready = self.deployment.refresh_group(self.compute)
+        self.fake.tick()
+        self.assertTrue(len(ready) == 2)
+        # Names and ids of the old instances come from one masked listing
+        self.assertTrue(sorted(mock_wait.call_args[1]['exclude_ids']) == sorted(old))
+        self.assertFalse('instanceGroups.listInstances' in self.fake.stats['methods'])
+        self.assertTrue(mock_delete.call_count == 1)
+        self.assertFalse(set(old) & set(self.group_ids()))
+        self.assertTrue(sorted(instance['id'] for instance in ready) == sorted(self.group_ids()))
+
+        self.fake.boot_seconds = 60
+        with self.assertRaises(TimeoutError):
+            self.balancer(stable_timeout=0.2).refresh_group(self.compute)
+
+
+class TestRollingReplace(unittest.TestCase):
+
+    class FakeGroup:
+        """ Managed instance group that creates and deletes instances instantly.
+        """
+        def __init__(self, size):
+            self.counter = 0
+            self.instances = []
+            self.capacity = []
+            self.resize_group(None, size, None, None)
+
+        def get_group_manager(self, group_name, project, zone):
+            return {'targetSize': len(self.instances)}
+
+        def list_managed_instances(self, group_name, project, zone):
+            return [{'instance': url, 'id': url.split('-')[-1], 'instanceStatus': 'RUNNING', 'currentAction': 'NONE'}
+                    for url in self.instances]
+
+        def resize_group(self, group_name, size, project, zone):
+            while len(self.instances) < size:
+                self.counter += 1
+                self.instances.append('zones/z/instances/node-{}'.format(self.counter))
+            del self.instances[size:]
+            self.capacity.append(len(self.instances))
+
+        def delete_group_instances(self, group_name, instances, project, zone):
+            self.instances = [url for url in self.instances if not url in instances]
+            self.capacity.append(len(self.instances))
+
+        def wait_for_group_stable(self, group_name, project, zone, target_size, timeout, interval, exclude_ids):
+            assert len(self.instances) == target_size
+
+    class LaggingGroup(FakeGroup):
+        """ Group whose listing shows deleted instances, and not their
+        replacements, for one more poll.
+        """
+        def __init__(self, size):
+            super().__init__(size)
+            self.stale = None
+            self.polls = 0
+
+        def list_managed_instances(self, group_name, project, zone):
+            self.polls += 1
+            listing = super().list_managed_instances(group_name, project, zone)
+            if self.stale is not None:
+                listing, self.stale = self.stale, None
+            return listing
+
+        def delete_group_instances(self, group_name, instances, project, zone):
+            self.stale = super().list_managed_instances(group_name, project, zone)
+            super().delete_group_instances(group_name, instances, project, zone)
+
+        wait_for_group_stable = ComputeOperator.wait_for_group_stable
+
+    def deployment(self, max_surge, max_unavailable):
+        deployment = BalancerDeployment.__new__(BalancerDeployment)
+        deployment.instance_group = 'group'
+        deployment.project = 'project'
+        deployment.zone = 'zone'
+        deployment.max_surge = max_surge
+        deployment.max_unavailable = max_unavailable
+        deployment.stable_timeout = 5
+        deployment.stable_interval = 0.01
+        return deployment
+
+    def test_surge_keeps_capacity(self):
+        group = self.FakeGroup(5)
+        old = list(group.instances)
+        self.deployment(max_surge=2, max_unavailable=0).rolling_replace(group)
+        self.assertTrue(len(group.instances) == 5)
+        self.assertFalse(set(old) & set(group.instances))
+        self.assertTrue(min(group.capacity) >= 5)
+        # The last batch replaces one instance, so it surges by one
+        self.assertTrue(group.capacity == [5, 7, 5, 5, 7, 5, 5, 6, 5, 5])
+
+    def test_max_unavailable(self):
+        group = self.FakeGroup(4)
+        old = list(group.instances)
+        self.deployment(max_surge=0, max_unavailable=1).rolling_replace(group)
+        self.assertFalse(set(old) & set(group.instances))
+        self.assertTrue(min(group.capacity[1:]) == 3)
+
+    @mock.patch('sprout.idle')
+    def test_stale_listing_is_not_stable(self, mock_idle):
+        # Right after a batch is deleted the group still lists it, all
+        # RUNNING at the target size, before the replacements appear
+        group = self.LaggingGroup(2)
+        deployment = self.deployment(max_surge=0, max_unavailable=1)
+        with mock.patch('sys.stdout'):
+            deployment.rolling_replace(group)
+        # One extra poll per batch, at the configured interval
+        self.assertTrue(group.polls == 1 + 2 * 2)
+        self.assertTrue([call[0][0] for call in mock_idle.call_args_list] == [0.01, 0.01])
+
+    def test_stable_settings_from_config(self):
+        config = {
+                  'root': 'gims',
+                  'state-file': 'dev.tfstate',
+                  'var-files': [],
+                  'load-balancer': True,
+                  'stable-timeout': 600,
+                  'stable-interval': 5}
+        tfvars = mock.Mock()
+        tfvars.merged.return_value = {
+                                      'project': 'p',
+                                      'zone': 'z',
+                                      'instance_name': 'source',
+                                      'template_image': 'image',
+                                      'instance_group': 'group'}
+        deployment = get_deployment_object(config, mock.Mock(), tfvars)
+        self.assertTrue(deployment.stable_timeout == 600 and deployment.stable_interval == 5)
+
+
+class TestDeploymentScheduler(unittest.TestCase):
+
+    def test_dependency_order(self):
+        deployments = [
+                       BaseDeployment('app', 'app.tfstate', [], name='app', depends_on=['network']),
+                       BaseDeployment('network', 'network.tfstate', [], name='network'),
+                       BaseDeployment('db', 'db.tfstate', [], name='db', depends_on=['network'])]
+        scheduler = DeploymentScheduler(deployments, max_parallel=3)
+        finished = scheduler.run(lambda deployment: sleep(0.01))
+        self.assertTrue(finished[0] == 'network')
+        self.assertTrue(sorted(finished[1:]) == ['app', 'db'])
+
+    def test_shared_root_is_serialized(self):
+        deployments = [
+                       BaseDeployment('gims', 'dev.tfstate', [], name='dev'),
+                       BaseDeployment('gims', 'staging.tfstate', [], name='staging')]
+        running = []
+        overlaps = []
+
+        def task(deployment):
+            running.append(deployment.name)
+            overlaps.append(len(running))
+            sleep(0.05)
+            running.remove(deployment.name)
+
+        DeploymentScheduler(deployments, max_parallel=2).run(task)
+        self.assertTrue(max(overlaps) == 1)
+
+    def test_dependency_cycle(self):
+        deployments = [
+                       BaseDeployment('a', 'a.tfstate', [], name='a', depends_on=['b']),
+                       BaseDeployment('b', 'b.tfstate', [], name='b', depends_on=['a'])]
+        with self.assertRaises(ValueError):
+            DeploymentScheduler(deployments)
+
+
+class TestExecutionPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.history = RunHistory(os.path.join(self.directory.name, 'history.json'))
+        self.history.sets = {
+                             'network': {'phase:plan': [10, 30, 20], 'phase:apply': [100]},
+                             'app': {'phase:apply': [50]}}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_schedule_and_critical_path(self):
+        deployments = [
+                       BaseDeployment('network', 'network.tfstate', [], name='network'),
+                       BaseDeployment('app', 'app.tfstate', [], name='app', depends_on=['network']),
+                       BaseDeployment('db', 'db.tfstate', [], name='db')]
+        plan = ExecutionPlan(DeploymentScheduler(deployments, max_parallel=2), self.history)
+        sets = {entry['name']: entry for entry in plan.sets}
+        self.assertTrue(sets['network']['estimate'] == 120)
+        # Sets without history of a phase use the median over all sets
+        self.assertTrue(sets['app']['steps'][0]['source'] == 'other sets')
+        self.assertTrue(sets['app']['start'] == 120 and sets['app']['finish'] == 190)
+        self.assertTrue(sets['db']['estimate'] == 95 and sets['db']['start'] == 0)
+        self.assertTrue(plan.critical_path == ['network', 'app'])
+        self.assertTrue(plan.makespan == 190 and plan.lower_bound == 190)
+
+        serial = ExecutionPlan(DeploymentScheduler(deployments, max_parallel=1), self.history)
+        self.assertTrue(serial.makespan == 285)
+        self.assertTrue(serial.critical_path == ['network', 'app', 'db'])
+
+    def test_full_mode_steps(self):
+        deployment = BaseDeployment('network', 'network.tfstate', ['dev.tfvars'], name='network', mode='full')
+        plan = ExecutionPlan(DeploymentScheduler([deployment]), self.history)
+        steps = plan.sets[0]['steps']
+        self.assertTrue([step['name'] for step in steps] == ['plan', 'destroy', 'plan', 'apply'])
+        self.assertTrue(steps[1]['command'] == ['terraform', 'destroy', '-auto-approve', '-var-file=dev.tfvars', '-state=network.tfstate'])
+        self.assertTrue(steps[1]['source'] == 'default')
+
+    @mock.patch('sprout.subprocess.Popen')
+    def test_dry_run_runs_nothing(self, mock_popen):
+        run_deployment(BaseDeployment('network', 'network.tfstate', [], name='network', mode='full'), dry_run=True)
+        self.assertFalse(mock_popen.called)
+
+    @mock.patch('sprout.subprocess.Popen')
+    def test_load_balancer_steps(self, mock_popen):
+        tfvars = mock.Mock()
+        tfvars.merged.return_value = {
+                                      'project': 'p',
+                                      'zone': 'z',
+                                      'instance_name': 'source',
+                                      'template_image': 'image',
+                                      'instance_group': 'group'}
+        first = {'stopped': 'stop_instance', 'snapshot': 'create_snapshot', 'live': 'flush'}
+        for image_source in ['stopped', 'snapshot', 'live']:
+            for rollout in ['recreate', 'rolling']:
+                compute = mock.Mock()
+                deployment = BalancerDeployment(
+                                                compute,
+                                                '/tmp',
+                                                '/tmp/lb.tfstate',
+                                                ['lb.tfvars'],
+                                                name = 'lb',
+                                                image_source = image_source,
+                                                flush_command = 'sync',
+                                                rollout = rollout,
+                                                refresh = True,
+                                                tfvars = tfvars)
+                plan = ExecutionPlan(DeploymentScheduler([deployment]), self.history)
+                names = [step['name'] for step in plan.sets[0]['steps'] if step['phase'] == 'load-balancer']
+                self.assertTrue(names[0] == first[image_source])
+                self.assertTrue(names[-1] == 'wait_for_group_stable')
+                with mock.patch('sys.stdout'):
+                    deployment.load_to_balancer(compute, dry_run=True)
+                self.assertFalse(compute.method_calls)
+        self.assertFalse(mock_popen.called)
+
+
+class TestParallelismBudget(unittest.TestCase):
+
+    def test_want_and_share(self):
+        budget = ParallelismBudget(20, concurrency=2)
+        self.assertTrue(budget.want(100) == 20)
+        self.assertTrue(budget.want(3) == 3)
+        self.assertTrue(budget.want(0) == 10)
+        granted = []
+
+        def second():
+            with budget.share(10) as parallelism:
+                granted.append(parallelism)
+
+        with budget.share(15) as parallelism:
+            self.assertTrue(parallelism == 15)
+            thread = threading.Thread(target=second)
+            thread.start()
+            sleep(0.05)
+            # Only 5 are free, less than the fair share of 10
+            self.assertTrue(granted == [])
+        thread.join(5)
+        self.assertTrue(granted == [10] and budget.in_use == 0)
+
+    def test_history_fallback(self):
+        with tempfile.TemporaryDirectory() as directory:
+            history = RunHistory(os.path.join(directory, 'history.json'))
+            history.record([{
+                             'kind': 'phase',
+                             'name': 'destroy',
+                             'labels': {'set': 'big'},
+                             'duration': 30.0,
+                             'resources': 40}])
+            budget = ParallelismBudget(50, history=history)
+            self.assertTrue(budget.want(0, 'big', 'destroy') == 40)
+            self.assertTrue(budget.want(0, 'small', 'destroy') == 10)
+
+    def test_launch_passes_parallelism(self):
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, 'dev.tfstate'), 'w') as fh:
+                json.dump({'resources': [{'instances': [{}] * 20}, {'instances': [{}] * 5}]}, fh)
+            deployment = BaseDeployment(root, 'dev.tfstate', [], name='dev')
+            deployment.parallelism = ParallelismBudget(30, maximum=25)
+            output = lambda arguments: b'Plan: 4 to add, 0 to change, 0 to destroy.\n'
+            with mock.patch('sprout.subprocess.Popen', side_effect=fake_popen(2, output)) as mock_popen:
+                deployment.plan(dry_run=False, timeout=60, plan_file='dev.tfplan')
+            self.assertTrue('-parallelism=25' in mock_popen.call_args[0][0])
+            with mock.patch('sprout.subprocess.Popen', side_effect=fake_popen(0)) as mock_popen:
+                with mock.patch.object(deployment, 'log') as mock_log:
+                    deployment.apply(dry_run=False, timeout=60, plan_file='dev.tfplan')
+            arguments = mock_popen.call_args[0][0]
+            self.assertTrue(arguments == ['terraform', 'apply', '-parallelism=4', '-state=dev.tfstate', 'dev.tfplan'])
+            # The command is logged once, as run
+            commands = [call[0][0] for call in mock_log.call_args_list if call[0][0].startswith('Command:')]
+            self.assertTrue(commands == ["Command: {} cwd= {}".format(arguments, root)])
+
+
+class TestSpoolDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.runs = []
+        self.started = {'dev': threading.Event(), 'prod': threading.Event()}
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.directory.cleanup()
+
+    def task(self, deployment, request):
+        self.started[deployment.name].set()
+        self.release.wait(5)
+        self.runs.append((deployment.name, list(request['ids']), request['revision']))
+
+    def start(self, spool, deployments, **kwargs):
+        stop = threading.Event()
+        daemon = SpoolDaemon(spool, deployments, self.task, max_parallel=2, poll_interval=0.01, **kwargs)
+        thread = threading.Thread(target=daemon.run, args=(stop,))
+        thread.start()
+        return stop, thread
+
+    def test_coalescing(self):
+        spool = os.path.join(self.directory.name, 'requests.jsonl')
+        deployments = [
+                       BaseDeployment('dev', 'dev.tfstate', [], name='dev'),
+                       BaseDeployment('prod', 'prod.tfstate', [], name='prod')]
+        with open(spool, 'w') as fh:
+            fh.write('{"set": "dev", "id": "1"}\n{"set": "dev", "id": "2"}\n{"sets": ["prod"], "id": "3"}\n')
+        stop, thread = self.start(spool, deployments)
+        self.assertTrue(self.started['dev'].wait(5))
+        with open(spool, 'a') as fh:
+            fh.write('{"set": "dev", "id": "4", "revision": "a"}\n{"set": "dev", "id": "5", "revision": "b"}\n')
+        sleep(0.1)
+        self.release.set()
+        for attempt in range(500):
+            if len(self.runs) == 3:
+                break
+            sleep(0.01)
+        stop.set()
+        thread.join(5)
+        dev = [(ids, revision) for name, ids, revision in self.runs if name == 'dev']
+        self.assertTrue(dev == [(['1', '2'], None), (['4', '5'], 'b')])
+        self.assertTrue([run for run in self.runs if run[0] == 'prod'] == [('prod', ['3'], None)])
+
+    def test_requeue_on_stop(self):
+        spool = os.path.join(self.directory.name, 'spool')
+        os.makedirs(spool)
+        # Sets sharing a root never run at once
+        deployments = [
+                       BaseDeployment('gims', 'dev.tfstate', [], name='dev'),
+                       BaseDeployment('gims', 'prod.tfstate', [], name='prod')]
+        with open(os.path.join(spool, 'push.json'), 'w') as fh:
+            fh.write('{"sets": ["dev", "prod"], "id": "1"}\n')
+        stop, thread = self.start(spool, deployments)
+        self.assertTrue(self.started['dev'].wait(5))
+        stop.set()
+        self.release.set()
+        thread.join(5)
+        self.assertTrue(self.runs == [('dev', ['1'], None)])
+        self.assertTrue(os.listdir(os.path.join(spool, 'done')) == ['push.json'])
+        requeued = [name for name in os.listdir(spool) if name.endswith('.jsonl')]
+        with open(os.path.join(spool, requeued[0])) as fh:
+            self.assertTrue(json.loads(fh.read())['set'] == 'prod')
+
+    def test_acknowledge_after_run(self):
+        spool = os.path.join(self.directory.name, 'requests.jsonl')
+        offset_file = os.path.join(self.directory.name, 'spool-offset.json')
+        ledger = RunLedger(os.path.join(self.directory.name, 'ledger.json'))
+        deployments = [BaseDeployment('dev', 'dev.tfstate', [], name='dev')]
+        with open(spool, 'w') as fh:
+            fh.write('not json\n{"set": "dev", "id": "1"}\n')
+        stop, thread = self.start(spool, deployments, offset_file=offset_file, ledger=ledger)
+        self.assertTrue(self.started['dev'].wait(5))
+        sleep(0.1)
+        # The bad line is passed, the running request is not
+        with open(offset_file) as fh:
+            self.assertTrue(list(json.load(fh).values()) == [len('not json\n')])
+        self.release.set()
+        for attempt in range(500):
+            if self.runs:
+                break
+            sleep(0.01)
+        stop.set()
+        thread.join(5)
+        with open(offset_file) as fh:
+            self.assertTrue(list(json.load(fh).values()) == [os.path.getsize(spool)])
+        self.assertTrue(ledger.served('dev', '1'))
+
+        # A replay of a served request does not run again
+        os.remove(offset_file)
+        stop, thread = self.start(spool, deployments, offset_file=offset_file, ledger=ledger)
+        sleep(0.1)
+        stop.set()
+        thread.join(5)
+        self.assertTrue(self.runs == [('dev', ['1'], None)])
+
 
 def wait_for_status(request, response, status, timeout):
     """ Wait for Google Cloud API request to complete.